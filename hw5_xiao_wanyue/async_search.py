@@ -0,0 +1,214 @@
+"""
+asyncio version of evaluate.get_response for the production serving mode (serve.py)
+all ES and embedding calls of a worker process run on one event loop in a background thread (IOLoop), the Flask request
+threads submit coroutines to it and wait for the result, so one worker overlaps many in-flight searches over a shared
+connection pool instead of tying up one blocking connection per thread
+the searches without an asyncio version (paragraph re-ranking, cascades, topic filters, entity boost, local indices) run
+evaluate.get_response in a thread pool instead
+"""
+from typing import Any, Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import asyncio
+import contextvars
+import threading
+
+from elasticsearch import AsyncElasticsearch  # type: ignore
+from elasticsearch_dsl import Search  # type: ignore
+from elasticsearch_dsl.query import Ids, Query  # type: ignore
+from elasticsearch_dsl.response import Response  # type: ignore
+
+from budget import DEGRADED, Budget, Degraded, current as current_budget, partial_response
+from embedding_service.client import AsyncEmbeddingClient
+from es_service.connection import ESConfig, connect_async, default_config
+from evaluate import EMBEDDING_TYPES, FALLBACK_REASONS, LOCAL_INDICES, budgeted_response, generate_script_score_query, \
+    get_response as sync_get_response, match_query
+from fusion import FusionConfig, fuse
+from instrumentation import span
+
+
+class IOLoop(object):
+    """
+    an asyncio event loop running in a daemon thread, it must be started after fork
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="io-loop", daemon=True)
+
+    def start(self) -> "IOLoop":
+        self.thread.start()
+        return self
+
+    def run(self, coro, timeout: Optional[float] = None) -> Any:
+        """
+        run a coroutine on the loop from any other thread and wait for its result
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def stop(self) -> None:
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+class AsyncSearcher(object):
+    def __init__(self, config: Optional[ESConfig] = None, embedding_host: str = "localhost"):
+        """
+        :param config: ES connection settings, config.maxsize is the number of concurrent ES requests of this process
+        :param embedding_host: host of the embedding servers
+        """
+        self.config = config or default_config()
+        self.embedding_host = embedding_host
+        self.es: Optional[AsyncElasticsearch] = None
+        self.es_no_retry: Optional[AsyncElasticsearch] = None  # client of the budgeted searches, see ESConfig.no_retry
+        self.encoders: Dict[str, AsyncEmbeddingClient] = {}
+        # blocking searches of the modes without an asyncio version, one thread per ES connection
+        self.sync_searches = ThreadPoolExecutor(max_workers=self.config.maxsize, thread_name_prefix="sync-search")
+
+    def _es(self, retry: bool = True) -> AsyncElasticsearch:
+        # created on first use so that the client binds to the running loop of the worker process
+        if not retry:
+            if self.es_no_retry is None:
+                self.es_no_retry = connect_async(self.config.no_retry())
+            return self.es_no_retry
+        if self.es is None:
+            self.es = connect_async(self.config)
+        return self.es
+
+    def _encoder(self, embedding: str) -> AsyncEmbeddingClient:
+        if embedding not in EMBEDDING_TYPES:
+            raise NotImplementedError(embedding)
+        if embedding not in self.encoders:
+            self.encoders[embedding] = AsyncEmbeddingClient(host=self.embedding_host, embedding_type=EMBEDDING_TYPES[embedding])
+        return self.encoders[embedding]
+
+    async def search(self, index_name: str, query: Query, top_k: int) -> List[Any]:
+        s = Search(index=index_name).query(query)[:top_k]
+        params = {"request_timeout": self.config.search_timeout}
+        budget = current_budget()
+        if budget is not None:
+            params.update(budget.es_params())
+            if budget.terminate_after:
+                params["terminate_after"] = budget.terminate_after
+        raw = await self._es(retry=budget is None).search(index=index_name, body=s.to_dict(), **params)
+        partial_response(raw.get("timed_out", False), raw.get("_shards", {}).get("failed", 0))
+        return list(Response(s, raw))
+
+    async def encode(self, query_text: str, embedding: str) -> List[float]:
+        budget = current_budget()
+        timeout_ms = budget.check("the query embedding") if budget is not None else None
+        with span("query_encoding"):
+            return (await self._encoder(embedding).encode([query_text], pooling="mean", timeout_ms=timeout_ms)).tolist()[0]
+
+    @staticmethod
+    def runs_async(index_name: str, search_type: str, embedding: str, **kwargs) -> bool:
+        """
+        :return: whether the search has an asyncio version, kwargs are the extra options of evaluate.get_response
+        """
+        if index_name in LOCAL_INDICES or any(value for value in kwargs.values()):
+            return False
+        if search_type == "vector":
+            return embedding == "bm25" or embedding in EMBEDDING_TYPES
+        return search_type in ("rerank", "hybrid") and embedding in EMBEDDING_TYPES
+
+    async def get_response(self, index_name: str, query_text: str, english_analyzer: bool, search_type: str, embedding: str,
+                           k: int, debug: bool = False, fusion: Optional[FusionConfig] = None, budget: Optional[Budget] = None,
+                           **kwargs) -> List[Any]:
+        """
+        same parameters, ranking and BM25 fallback within the budget as evaluate.get_response
+        :param kwargs: ner_boost, topic_filter, cascade of evaluate.get_response, such searches run in self.sync_searches
+        """
+        if not self.runs_async(index_name, search_type, embedding, **kwargs):
+            if budget is None:
+                search = partial(sync_get_response, index_name, query_text, english_analyzer, search_type, embedding, k, debug, fusion=fusion, **kwargs)
+            else:
+                search = partial(budgeted_response, budget, index_name, query_text, english_analyzer, search_type, embedding, k, debug,
+                                 fusion=fusion, **kwargs)
+            # the thread runs in a copy of the context of the request (its spans)
+            return await asyncio.get_running_loop().run_in_executor(self.sync_searches, contextvars.copy_context().run, search)
+        if budget is None:
+            return await self._ranked(index_name, query_text, english_analyzer, search_type, embedding, k, debug, fusion)
+        # the tasks of the search copy the context, so they all see the budget
+        with budget.activate():
+            try:
+                response = await self._ranked(index_name, query_text, english_analyzer, search_type, embedding, k, debug, fusion)
+                return Degraded(response, "es_partial") if budget.partial else response
+            except tuple(FALLBACK_REASONS) as e:
+                reason = next(reason for error, reason in FALLBACK_REASONS.items() if isinstance(e, error))
+                DEGRADED.inc(reason=reason)
+                if search_type == "vector" and embedding == "bm25":
+                    error = e
+                elif getattr(e, "bm25_hits", None) is not None:
+                    if debug: print("Falling back to the bm25 leg ({}): {}".format(reason, e))
+                    return Degraded(e.bm25_hits[:k], reason)
+                else:
+                    if debug: print("Falling back to bm25 ({}): {}".format(reason, e))
+                    budget.release_reserve()
+                    try:
+                        with span("first_stage_search"):
+                            return Degraded(await self.search(index_name, match_query(query_text, english_analyzer), k), reason)
+                    except tuple(FALLBACK_REASONS) as fallback_error:
+                        error = fallback_error
+            DEGRADED.inc(reason="fallback_failed")
+            if debug: print("No BM25 results within the budget: {}".format(error))
+            return Degraded([], "fallback_failed")
+
+    async def _ranked(self, index_name: str, query_text: str, english_analyzer: bool, search_type: str, embedding: str,
+                      k: int, debug: bool = False, fusion: Optional[FusionConfig] = None) -> List[Any]:
+        q_basic = match_query(query_text, english_analyzer)
+        if debug: print("embedding:", embedding, "  search type:", search_type, "  query text:", query_text)
+
+        if search_type == "vector":
+            if embedding == "bm25":
+                with span("first_stage_search"):
+                    return await self.search(index_name, q_basic, k)
+            q_vector = generate_script_score_query(await self.encode(query_text, embedding), embedding)
+            with span("vector_search"):
+                return await self.search(index_name, q_vector, k)
+
+        if search_type == "rerank":
+            assert query_text, f"Reranking with {embedding} can only happen if query text is not empty!"
+            # the query encoding does not depend on the first stage, run both concurrently
+            with span("first_stage_search"):
+                response, query_vector = await asyncio.gather(self.search(index_name, q_basic, k), self.encode(query_text, embedding))
+            q_c = Ids(values=[hit.meta.id for hit in response]) & generate_script_score_query(query_vector, embedding)
+            with span("rerank_search"):
+                return await self.search(index_name, q_c, k)
+
+        if search_type == "hybrid":
+            fusion = fusion or FusionConfig()
+            bm25_leg = asyncio.ensure_future(self._bm25_leg(index_name, q_basic, fusion.bm25_depth))
+            try:
+                vector_hits = await self._vector_leg(index_name, query_text, embedding, fusion.vector_depth)
+            except tuple(FALLBACK_REASONS) as e:
+                # as in evaluate.hybrid_search, the fallback answers with the hits of the BM25 leg
+                try:
+                    e.bm25_hits = await bm25_leg
+                except tuple(FALLBACK_REASONS):
+                    pass
+                raise
+            bm25_hits = await bm25_leg
+            with span("fusion"):
+                return fuse(bm25_hits, vector_hits, fusion, k)
+        raise NotImplementedError(search_type)
+
+    async def _bm25_leg(self, index_name: str, query: Query, depth: int) -> List[Any]:
+        with span("first_stage_search"):
+            return await self.search(index_name, query, depth)
+
+    async def _vector_leg(self, index_name: str, query_text: str, embedding: str, depth: int) -> List[Any]:
+        q_vector = generate_script_score_query(await self.encode(query_text, embedding), embedding)
+        with span("vector_search"):
+            return await self.search(index_name, q_vector, depth)
+
+    async def close(self) -> None:
+        for es in (self.es, self.es_no_retry):
+            if es is not None:
+                await es.close()
+        for encoder in self.encoders.values():
+            encoder.terminate()
+        self.sync_searches.shutdown(wait=False)
+
+
+if __name__ == "__main__":
+    pass
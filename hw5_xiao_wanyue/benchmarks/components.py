@@ -0,0 +1,231 @@
+"""
+micro-benchmarks of the hot paths, they run offline on pa5_data/wapo_test.jl and synthetic data
+"""
+from typing import Dict, Iterator, List
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+import os
+import re
+import tempfile
+
+import numpy as np  # type: ignore
+
+from benchmarks.harness import benchmark
+
+DATA_DIR = Path(__file__).parent.parent.joinpath("pa5_data")
+WAPO_PATH = DATA_DIR.joinpath("wapo_test.jl")
+
+
+def load_test_docs() -> List[Dict]:
+    from utils import load_clean_wapo_with_embedding
+
+    return list(load_clean_wapo_with_embedding(WAPO_PATH))
+
+
+def synthetic_vocabulary() -> Dict[str, int]:
+    """
+    word counts of the test docs, every word is made frequent enough to be a correction candidate
+    """
+    counts = Counter()
+    for doc in load_test_docs():
+        counts.update(re.findall(r"[a-z]{3,}", (doc["title"] + " " + doc["content_str"]).lower()))
+    return {word: count + 3 for word, count in counts.items()}
+
+
+def synthetic_vec_file(words: List[str], dim: int = 300, seed: int = 0) -> str:
+    """
+    write a small fastText .vec file (header line, then word and vector per line) and return its path
+    """
+    rng = np.random.default_rng(seed)
+    fd, path = tempfile.mkstemp(suffix=".vec")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(f"{len(words)} {dim}\n")
+        for word in words:
+            f.write(word + " " + " ".join(f"{v:.4f}" for v in rng.standard_normal(dim)) + "\n")
+    return path
+
+
+def synthetic_large_vocabulary(n_words: int = 300000, seed: int = 0) -> Dict[str, int]:
+    """
+    random words with English-like letter frequencies and Zipf counts, about the size of the corpus vocabulary
+    """
+    rng = np.random.default_rng(seed)
+    letters = np.array(list("etaoinshrdlcumwfgypbvkjxqz"))
+    p = 1.0 / np.arange(1, len(letters) + 1)
+    p /= p.sum()
+    vocabulary = {}
+    while len(vocabulary) < n_words:
+        word = "".join(rng.choice(letters, rng.integers(3, 12), p=p))
+        vocabulary[word] = int(rng.zipf(1.5))
+    return vocabulary
+
+
+def _spell_corrector():
+    from spell_corrector import SpellCorrector
+
+    return SpellCorrector(vocabulary=synthetic_vocabulary())
+
+
+@benchmark("spell_corrector.correct[known]")
+def bench_correct_known():
+    sc = _spell_corrector()
+    words = ["caucus", "church", "soap", "voters"]
+    return lambda: [sc.correct(w) for w in words], len(words)
+
+
+@benchmark("spell_corrector.correct[edit1]")
+def bench_correct_edit1():
+    sc = _spell_corrector()
+    words = ["cacus", "chrch", "sopa", "votres"]
+    return lambda: [sc.correct(w) for w in words], len(words)
+
+
+@benchmark("spell_corrector.correct[edit2]")
+def bench_correct_edit2():
+    sc = _spell_corrector()
+    words = ["cacsu", "chrhc"]
+    return lambda: [sc.correct(w) for w in words], len(words)
+
+
+@contextmanager
+def _suggester() -> Iterator["Suggester"]:
+    from suggest import Suggester, build_index
+
+    with tempfile.TemporaryDirectory(prefix="suggest_index") as index_dir:
+        build_index(synthetic_large_vocabulary(), index_dir)
+        yield Suggester(index_dir)
+
+
+@benchmark("suggest.suggest[short prefix]")
+def bench_suggest_short_prefix():
+    with _suggester() as suggester:
+        prefixes = ["e", "t", "a", "o"]
+        yield lambda: [suggester.suggest(p) for p in prefixes], len(prefixes)
+
+
+@benchmark("suggest.suggest[long prefix]")
+def bench_suggest_long_prefix():
+    with _suggester() as suggester:
+        prefixes = ["etao", "tain", "shrd", "zq"]
+        yield lambda: [suggester.suggest(p) for p in prefixes], len(prefixes)
+
+
+def _paragraph_index(n_docs: int, seed: int = 0):
+    from paragraph_index import ParagraphIndex
+
+    rng = np.random.default_rng(seed)
+    docs = ((i, rng.standard_normal((30, 768)).astype(np.float32)) for i in range(n_docs))
+    return ParagraphIndex.build(docs, "sbert"), rng
+
+
+@benchmark("paragraph_index.maxsim[500 docs x 30 paragraphs]")
+def bench_paragraph_rerank():
+    index, rng = _paragraph_index(5000)
+    query = rng.standard_normal(768).astype(np.float32)
+    candidates = [str(i) for i in rng.choice(5000, size=500, replace=False)]
+    return lambda: index.rerank(query, candidates), 1
+
+
+@benchmark("paragraph_index.search[5000 docs x 30 paragraphs]")
+def bench_paragraph_search():
+    index, rng = _paragraph_index(5000)
+    query = rng.standard_normal(768).astype(np.float32)
+    return lambda: index.search(query, 20), 1
+
+
+@contextmanager
+def _bm25_index(replicate: int = 500) -> Iterator["BM25Index"]:
+    from bm25_index import BM25Index, build_index
+
+    with tempfile.TemporaryDirectory(prefix="bm25_index") as index_dir:
+        build_index((doc for _ in range(replicate) for doc in load_test_docs()), index_dir)
+        yield BM25Index(index_dir)
+
+
+@benchmark("bm25_index.top_k[3000 docs, english analyzer]")
+def bench_bm25_top_k():
+    with _bm25_index() as index:
+        queries = ["tunnel disaster injuries", "washington post president story", "soap recycling hotel"]
+        yield lambda: [index.top_k("stemmed_content", q, 100) for q in queries], len(queries)
+
+
+@benchmark("doc_store.get[3000 docs, document page fields]")
+def bench_doc_store_get():
+    from doc_store import DocStore, build_store
+
+    with tempfile.TemporaryDirectory(prefix="doc_store") as store_dir:
+        corpus_path = os.path.join(store_dir, "corpus.jl")
+        with open(WAPO_PATH, "rb") as f:
+            lines = f.read().splitlines(keepends=True)
+        with open(corpus_path, "wb") as f:
+            for _ in range(500):
+                f.writelines(lines)
+        build_store(corpus_path, store_dir)
+        store = DocStore(store_dir)
+        es_ids = np.random.default_rng(0).integers(0, store.n_docs, 100)
+        yield lambda: [store.get(int(es_id), ["title", "author", "date", "content"]) for es_id in es_ids], len(es_ids)
+
+
+@benchmark("text_processing.get_valid_tokens")
+def bench_get_valid_tokens():
+    from embedding_service.text_processing import TextProcessing
+
+    tp = TextProcessing.from_nltk()
+    doc = load_test_docs()[0]
+    n_tokens = len(tp.get_valid_tokens(doc["title"], doc["content_str"]))
+    return lambda: tp.get_valid_tokens(doc["title"], doc["content_str"]), n_tokens
+
+
+@benchmark("fasttext_embedding.encode")
+def bench_fasttext_encode():
+    from embedding_service.embed import FastTextEmbedding
+
+    vocab = sorted(synthetic_vocabulary())
+    path = synthetic_vec_file(vocab)
+    try:
+        model = FastTextEmbedding(path)
+    finally:
+        os.remove(path)
+    texts = [doc["content_str"][:2000] for doc in load_test_docs()]
+    return lambda: model.encode(texts), len(texts)
+
+
+@benchmark("metrics.Score.eval")
+def bench_score_eval():
+    from metrics import Score
+
+    rng = np.random.default_rng(0)
+    relevance = list(rng.choice(3, size=20, p=[0.6, 0.25, 0.15]))
+    ideal = sorted(rng.choice(3, size=100), reverse=True)
+    return lambda: Score.eval(relevance, ideal, 20), 1
+
+
+@benchmark("metrics.batch_eval[100 runs x 100 ranks]")
+def bench_batch_eval():
+    from metrics import batch_eval
+
+    rng = np.random.default_rng(0)
+    relevance = rng.choice(3, size=(100, 100), p=[0.6, 0.25, 0.15])
+    ideal = -np.sort(-rng.choice(3, size=(100, 100)), axis=1)
+    return lambda: batch_eval(relevance, ideal, range(1, 101)), 100
+
+
+@benchmark("utils.load_clean_wapo_with_embedding")
+def bench_load_wapo():
+    from utils import load_clean_wapo_with_embedding
+
+    n_docs = len(load_test_docs())
+    return lambda: list(load_clean_wapo_with_embedding(WAPO_PATH)), n_docs
+
+
+@benchmark("es_index._populate_doc")
+def bench_populate_doc():
+    from es_service.index import ESIndex
+
+    docs = load_test_docs()
+    return lambda: [d.to_dict(include_meta=True, skip_empty=False) for d in ESIndex._populate_doc(docs)], len(docs)
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,129 @@
+"""
+minimal benchmark harness
+a benchmark is a setup function registered with @benchmark, it prepares its data and returns (op, items)
+where op is the callable being timed and items is the number of items (words, docs, queries ...) processed per call.
+a setup that needs cleaning up (e.g. the temporary directory of an index) is a generator instead: it yields (op, items)
+once from inside its with blocks, and is closed after the measurement
+"""
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
+from contextlib import ExitStack
+import inspect
+import json
+import platform
+import re
+import time
+
+import numpy as np  # type: ignore
+
+Prepared = Tuple[Callable[[], Any], int]
+Setup = Callable[[], Union[Prepared, Iterator[Prepared]]]
+BENCHMARKS: Dict[str, Setup] = {}
+
+
+def benchmark(name: str):
+    def register(setup: Setup):
+        if name in BENCHMARKS:
+            raise ValueError(f"benchmark {name} is already registered")
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+def measure(op: Callable[[], Any], items: int = 1, repeat: int = 7, min_time: float = 0.1) -> Dict[str, float]:
+    """
+    time op, each of the repeat samples calls op as many times as needed to last at least min_time seconds
+    :return: per-call statistics in microseconds and the item throughput
+    """
+    op()  # warm up caches and lazy initialization
+    number = 1
+    while True:
+        st = time.perf_counter()
+        for _ in range(number):
+            op()
+        elapsed = time.perf_counter() - st
+        if elapsed >= min_time or number >= 1 << 20:
+            break
+        number *= 2 if elapsed <= 0 else max(2, min(10, int(min_time / elapsed) + 1))
+
+    samples = []
+    for _ in range(repeat):
+        st = time.perf_counter()
+        for _ in range(number):
+            op()
+        samples.append((time.perf_counter() - st) / number)
+    samples = np.asarray(samples) * 1e6
+    median = float(np.median(samples))
+    return {"median_us": median, "mean_us": float(samples.mean()), "min_us": float(samples.min()), "std_us": float(samples.std()),
+            "calls": number * repeat, "items_per_call": items, "items_per_sec": items / median * 1e6 if median > 0 else float("inf")}
+
+
+def run(pattern: Optional[str] = None, repeat: int = 7, min_time: float = 0.1) -> Dict[str, Any]:
+    """
+    run every registered benchmark whose name matches the regex pattern
+    a benchmark whose optional dependency or data is missing (ImportError, FileNotFoundError, LookupError e.g. for the nltk
+    corpora) is skipped, any other exception of its setup or of its op is recorded as a failure
+    """
+    results, skipped, failed = {}, {}, {}
+    for name, setup in BENCHMARKS.items():
+        if pattern is not None and not re.search(pattern, name):
+            continue
+        with ExitStack() as cleanup:
+            try:
+                prepared = setup()
+                if inspect.isgenerator(prepared):
+                    cleanup.callback(prepared.close)
+                    prepared = next(prepared)
+                op, items = prepared
+            except (ImportError, FileNotFoundError, LookupError) as e:
+                skipped[name] = repr(e)
+                print(f"{name:45s} skipped: {e!r}")
+                continue
+            try:
+                results[name] = measure(op, items, repeat, min_time)
+            except Exception as e:
+                failed[name] = repr(e)
+                print(f"{name:45s} FAILED: {e!r}")
+                continue
+        stats = results[name]
+        print(f"{name:45s} {stats['median_us']:12.2f} us/call {stats['items_per_sec']:14.1f} items/s")
+    return {"machine": platform.platform(), "python": platform.python_version(), "time": time.time(), "filter": pattern,
+            "benchmarks": results, "skipped": skipped, "failed": failed}
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], threshold: float = 0.2) -> List[str]:
+    """
+    compare the medians with a stored baseline
+    a benchmark of the baseline (among the ones selected by the filter of the run) that did not run is flagged too, with
+    the reason it was skipped or failed
+    :param threshold: relative slowdown above which a benchmark is flagged, 0.2 flags anything more than 20% slower
+    :return: descriptions of the flagged benchmarks
+    """
+    regressions = []
+    pattern = results.get("filter")
+    for name in baseline["benchmarks"]:
+        if name in results["benchmarks"] or (pattern is not None and not re.search(pattern, name)):
+            continue
+        reason = results.get("failed", {}).get(name) or results.get("skipped", {}).get(name) or "not registered anymore"
+        regressions.append(f"{name}: in the baseline but did not run ({reason})")
+        print(f"{name:45s} {baseline['benchmarks'][name]['median_us']:12.2f} -> {'missing':>12s}          <-- MISSING")
+    for name, stats in results["benchmarks"].items():
+        base = baseline["benchmarks"].get(name)
+        if base is None:
+            continue
+        ratio = stats["median_us"] / base["median_us"]
+        marker = ""
+        if ratio > 1 + threshold:
+            marker = "  <-- REGRESSION"
+            regressions.append(f"{name}: {base['median_us']:.2f} -> {stats['median_us']:.2f} us/call ({ratio:.2f}x)")
+        print(f"{name:45s} {base['median_us']:12.2f} -> {stats['median_us']:12.2f} us/call {ratio:6.2f}x{marker}")
+    return regressions
+
+
+def dump(results: Dict[str, Any], path: str) -> None:
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def load(path: str) -> Dict[str, Any]:
+    with open(path, "r") as f:
+        return json.load(f)
@@ -0,0 +1,50 @@
+"""
+run the benchmark suite and compare it with a stored baseline
+
+python -m benchmarks.run --output bench.json --baseline benchmarks/baseline.json --threshold 0.2
+python -m benchmarks.run --filter spell_corrector --save_baseline benchmarks/baseline.json
+"""
+import argparse
+import sys
+
+from benchmarks import harness
+import benchmarks.components  # noqa: F401  (registers the benchmarks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="component micro-benchmarks")
+    parser.add_argument("--filter", required=False, type=str, default=None, help="regex selecting the benchmarks to run")
+    parser.add_argument("--repeat", required=False, type=int, default=7, help="number of timed samples per benchmark")
+    parser.add_argument("--min_time", required=False, type=float, default=0.1, help="minimum duration of each sample in seconds")
+    parser.add_argument("--output", required=False, type=str, default=None, help="write the results to this json file")
+    parser.add_argument("--baseline", required=False, type=str, default=None, help="json results to compare against")
+    parser.add_argument("--threshold", required=False, type=float, default=0.2, help="flag benchmarks slower than the baseline by more than this ratio")
+    parser.add_argument("--save_baseline", required=False, type=str, default=None, help="write the results as the new baseline")
+    args = parser.parse_args()
+
+    results = harness.run(args.filter, args.repeat, args.min_time)
+    if args.output:
+        harness.dump(results, args.output)
+    if args.save_baseline:
+        harness.dump(results, args.save_baseline)
+
+    failed = bool(results["failed"])
+    if failed:
+        print(f"\n{len(results['failed'])} benchmark(s) failed:")
+        for name, error in results["failed"].items():
+            print(f"  {name}: {error}")
+
+    if args.baseline:
+        print()
+        regressions = harness.compare(results, harness.load(args.baseline), args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} benchmark(s) slower than the baseline by more than {args.threshold:.0%} or missing from the run:")
+            for regression in regressions:
+                print("  " + regression)
+            failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,381 @@
+"""
+in-process BM25 retrieval over the content (standard analyzer) and stemmed_content (english analyzer) fields, without ES
+the postings of each term are delta-encoded document ids and term frequencies packed as variable-byte integers, and the
+document lengths are quantized to one byte as Lucene does. every array is saved as a .npy file and memory-mapped when
+loaded. the scoring follows Lucene's BM25 (the one of ES 7), so rankings stay close to ES, see --parity.
+
+python bm25_index.py --wapo_path pa5_data/wapo_docs.jl --output pa5_data/bm25_index
+python bm25_index.py --output pa5_data/bm25_index --parity --index_name wapo_docs_50k
+"""
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+from functools import lru_cache
+import argparse
+import json
+import os
+import re
+import time
+import uuid
+
+import numpy as np  # type: ignore
+
+from doc_store import DocStore
+
+BM25_INDEX_DIR = "./pa5_data/bm25_index"
+# field -> uses the english analyzer, both index the content_str of the corpus
+FIELDS = {"content": False, "stemmed_content": True}
+# fields kept with each document and returned in the hits, the content is not stored (it can come from a DocStore)
+STORED_FIELDS = {"doc_id": "doc_id", "title": "title", "author": "author", "annotation": "annotation", "date": "published_date"}
+FIELD_FILES = ("terms.npy", "term_offsets.npy", "df.npy", "doc_offsets.npy", "docs.npy", "tf_offsets.npy", "tfs.npy", "norms.npy")
+
+TOKEN_RE = re.compile(r"\w+(?:[.'’]\w+)*")
+# stop words of the english analyzer of ES (Lucene's EnglishAnalyzer)
+ENGLISH_STOP_WORDS = frozenset("a an and are as at be but by for if in into is it no not of on or such that the their then there "
+                               "these they this to was will with".split())
+
+
+def standard_analyzer(text: str) -> List[str]:
+    return TOKEN_RE.findall((text or "").lower())
+
+
+@lru_cache(maxsize=1 << 18)
+def _stem(token: str) -> str:
+    return _stemmer().stem(token)
+
+
+@lru_cache(maxsize=1)
+def _stemmer():
+    from nltk.stem.porter import PorterStemmer  # type: ignore
+    return PorterStemmer(mode=PorterStemmer.MARTIN_EXTENSIONS)
+
+
+def english_analyzer(text: str) -> List[str]:
+    """
+    standard tokens, possessives removed, stop words removed and porter stemming, like the english analyzer of ES
+    """
+    tokens = []
+    for token in standard_analyzer(text):
+        if token.endswith(("'s", "’s")):
+            token = token[:-2]
+        if token not in ENGLISH_STOP_WORDS:
+            tokens.append(_stem(token))
+    return tokens
+
+
+def vbyte_encode(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    7 bits per byte, least significant group first, the high bit is set on every byte but the last one of a value
+    :return: the bytes and the number of bytes of each value
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    n_bytes = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        n_bytes += rest > 0
+        rest >>= np.uint64(7)
+    starts = np.cumsum(n_bytes) - n_bytes
+    out = np.zeros(int(n_bytes.sum()), dtype=np.uint8)
+    for j in range(int(n_bytes.max(initial=0))):
+        has = n_bytes > j
+        group = (values[has] >> np.uint64(7 * j)) & np.uint64(127)
+        more = (n_bytes[has] > j + 1).astype(np.uint64) << np.uint64(7)
+        out[starts[has] + j] = (group | more).astype(np.uint8)
+    return out, n_bytes
+
+
+def vbyte_decode(data: np.ndarray) -> np.ndarray:
+    data = np.asarray(data)
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.int64)
+    ends = np.flatnonzero(data < 128)
+    starts = np.r_[0, ends[:-1] + 1]
+    shifts = 7 * (np.arange(len(data)) - np.repeat(starts, ends - starts + 1))
+    return np.add.reduceat((data & 127).astype(np.int64) << shifts, starts)
+
+
+def _int4_to_long(i: int) -> int:
+    bits, shift = i & 0x07, (i >> 3) - 1
+    return bits if shift == -1 else (bits | 0x08) << shift
+
+
+def _long_to_int4(i: int) -> int:
+    n_bits = i.bit_length()
+    if n_bits < 4:
+        return i
+    shift = n_bits - 4
+    return ((i >> shift) & 0x07) | ((shift + 1) << 3)
+
+
+# Lucene's SmallFloat.intToByte4 / byte4ToInt, the lossy one-byte document length of the BM25 norms
+_FREE_VALUES = 255 - _long_to_int4(2 ** 31 - 1)
+LENGTH_TABLE = np.array([i if i < _FREE_VALUES else _FREE_VALUES + _int4_to_long(i - _FREE_VALUES) for i in range(256)],
+                        dtype=np.float64)
+
+
+def length_to_norm(lengths: np.ndarray) -> np.ndarray:
+    return np.array([n if n < _FREE_VALUES else _FREE_VALUES + _long_to_int4(int(n) - _FREE_VALUES) for n in lengths], dtype=np.uint8)
+
+
+def _pack_strings(strings: Sequence[bytes]) -> Tuple[np.ndarray, np.ndarray]:
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    np.cumsum([len(s) for s in strings], out=offsets[1:])
+    return np.frombuffer(b"".join(strings), dtype=np.uint8), offsets
+
+
+def _add_document(postings: Tuple[List[int], List[int], List[int], Dict[str, int]], doc: int, tokens: List[str]) -> None:
+    """
+    append the (term, doc, tf) entries of a document to the term ids, doc ids, tfs and vocabulary of a field
+    """
+    term_ids, doc_ids, tfs, vocabulary = postings
+    counts: Dict[int, int] = {}
+    for token in tokens:
+        term_id = vocabulary.setdefault(token, len(vocabulary))
+        counts[term_id] = counts.get(term_id, 0) + 1
+    term_ids.extend(counts)
+    tfs.extend(counts.values())
+    doc_ids.extend([doc] * len(counts))
+
+
+def _field_arrays(term_ids: List[int], doc_ids: List[int], tfs: List[int], vocabulary: Dict[str, int],
+                  lengths: np.ndarray) -> Tuple[np.ndarray, ...]:
+    """
+    sort the (term, doc, tf) entries into postings
+    :return: the arrays of FIELD_FILES
+    """
+    terms = sorted(vocabulary)
+    term_rank = np.empty(len(terms), dtype=np.int64)
+    term_rank[[vocabulary[term] for term in terms]] = np.arange(len(terms))
+    term_ids = term_rank[np.asarray(term_ids, dtype=np.int64)]
+    doc_ids, tfs = np.asarray(doc_ids, dtype=np.int64), np.asarray(tfs, dtype=np.int64)
+    order = np.lexsort((doc_ids, term_ids))
+    term_ids, doc_ids, tfs = term_ids[order], doc_ids[order], tfs[order]
+
+    df = np.bincount(term_ids, minlength=len(terms)).astype(np.int32)
+    entry_offsets = np.r_[0, np.cumsum(df)]
+    deltas = np.diff(doc_ids, prepend=0)
+    deltas[entry_offsets[:-1][df > 0]] = doc_ids[entry_offsets[:-1][df > 0]]  # the first doc of each term is absolute
+    docs, doc_bytes = vbyte_encode(deltas)
+    tf_data, tf_bytes = vbyte_encode(tfs)
+    doc_offsets = np.r_[0, np.cumsum(doc_bytes)][entry_offsets]
+    tf_offsets = np.r_[0, np.cumsum(tf_bytes)][entry_offsets]
+
+    blob, term_offsets = _pack_strings([term.encode("utf-8") for term in terms])
+    return blob, term_offsets, df, doc_offsets, docs, tf_offsets, tf_data, length_to_norm(lengths)
+
+
+def _write_field(field_dir: str, term_ids: List[int], doc_ids: List[int], tfs: List[int], vocabulary: Dict[str, int],
+                 lengths: np.ndarray) -> int:
+    """
+    save the postings of a field
+    :return: the total number of tokens of the field
+    """
+    os.makedirs(field_dir, exist_ok=True)
+    for name, array in zip(FIELD_FILES, _field_arrays(term_ids, doc_ids, tfs, vocabulary, lengths)):
+        np.save(os.path.join(field_dir, name), array)
+    return int(lengths.sum())
+
+
+def build_index(docs: Iterable[Dict], output_dir: str = BM25_INDEX_DIR) -> None:
+    """
+    :param docs: corpus documents in ES id order (the position is the id, as in load_es_index.py)
+    """
+    postings = {field: ([], [], [], {}) for field in FIELDS}  # term ids, doc ids, tfs, vocabulary
+    lengths = {field: [] for field in FIELDS}
+    stored = []
+    for i, doc in enumerate(docs):
+        for field, english in FIELDS.items():
+            tokens = (english_analyzer if english else standard_analyzer)(doc.get("content_str"))
+            _add_document(postings[field], i, tokens)
+            lengths[field].append(len(tokens))
+        stored.append(json.dumps({name: doc.get(source) for name, source in STORED_FIELDS.items()}).encode("utf-8"))
+
+    meta = {"n_docs": len(stored), "version": uuid.uuid4().hex, "fields": {}}
+    for field in FIELDS:
+        field_lengths = np.asarray(lengths[field], dtype=np.int64)
+        total = _write_field(os.path.join(output_dir, field), *postings[field], field_lengths)
+        meta["fields"][field] = {"sum_total_term_freq": total, "doc_count": int((field_lengths > 0).sum())}
+    blob, offsets = _pack_strings(stored)
+    np.save(os.path.join(output_dir, "stored.npy"), blob)
+    np.save(os.path.join(output_dir, "stored_offsets.npy"), offsets)
+    with open(os.path.join(output_dir, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+
+class FieldIndex(object):
+    def __init__(self, arrays: Sequence[np.ndarray], english: bool, n_docs: int, sum_total_term_freq: int, doc_count: int,
+                 k1: float = 1.2, b: float = 0.75):
+        """
+        :param arrays: the arrays of FIELD_FILES, see load and from_texts
+        """
+        self.terms, self.term_offsets, self.df, self.doc_offsets, self.docs, self.tf_offsets, self.tfs, self.norms = arrays
+        self.analyzer = english_analyzer if english else standard_analyzer
+        self.n_docs = n_docs
+        self.doc_count = doc_count
+        self.n_terms = len(self.df)
+        avgdl = sum_total_term_freq / doc_count if doc_count else 1.0  # no document of an empty field matches anyway
+        # k1 * (1 - b + b * dl / avgdl) for each of the 256 quantized lengths, as Lucene's BM25 cache
+        self.length_cache = (k1 * (1 - b + b * LENGTH_TABLE / avgdl)).astype(np.float32)
+
+    @classmethod
+    def load(cls, field_dir: str, english: bool, n_docs: int, sum_total_term_freq: int, doc_count: int) -> "FieldIndex":
+        """
+        memory-map a field saved by build_index
+        """
+        arrays = [np.load(os.path.join(field_dir, name), mmap_mode="r") for name in FIELD_FILES]
+        return cls(arrays, english, n_docs, sum_total_term_freq, doc_count)
+
+    @classmethod
+    def from_texts(cls, texts: Sequence[str], english: bool) -> "FieldIndex":
+        """
+        index texts in memory, the position of a text is its doc id
+        """
+        postings = ([], [], [], {})
+        lengths = np.zeros(len(texts), dtype=np.int64)
+        for i, text in enumerate(texts):
+            tokens = (english_analyzer if english else standard_analyzer)(text)
+            _add_document(postings, i, tokens)
+            lengths[i] = len(tokens)
+        return cls(_field_arrays(*postings, lengths), english, len(texts), int(lengths.sum()), int((lengths > 0).sum()))
+
+    def _term(self, i: int) -> bytes:
+        return self.terms[self.term_offsets[i]:self.term_offsets[i + 1]].tobytes()
+
+    def term_id(self, term: str) -> int:
+        key = term.encode("utf-8")
+        lo, hi = 0, self.n_terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._term(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < self.n_terms and self._term(lo) == key else -1
+
+    def postings(self, term_id: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :return: the ids and the term frequencies of the documents containing the term
+        """
+        docs = np.cumsum(vbyte_decode(self.docs[self.doc_offsets[term_id]:self.doc_offsets[term_id + 1]]))
+        return docs, vbyte_decode(self.tfs[self.tf_offsets[term_id]:self.tf_offsets[term_id + 1]])
+
+    def score(self, query_text: str) -> np.ndarray:
+        """
+        :return: BM25 score of every document for a match query (OR of the query tokens), 0 if no token matches
+        """
+        scores = np.zeros(self.n_docs, dtype=np.float32)
+        for token in self.analyzer(query_text):
+            term_id = self.term_id(token)
+            if term_id < 0:
+                continue
+            df = int(self.df[term_id])
+            idf = np.float32(np.log(1 + (self.doc_count - df + 0.5) / (df + 0.5)))
+            docs, tfs = self.postings(term_id)
+            tfs = tfs.astype(np.float32)
+            scores[docs] += idf * tfs / (tfs + self.length_cache[self.norms[docs]])
+        return scores
+
+
+class BM25Index(object):
+    def __init__(self, index_dir: str = BM25_INDEX_DIR, doc_store: Optional[DocStore] = None):
+        """
+        :param doc_store: store of the indexed corpus, adds the content to the returned documents (for the result snippets)
+        """
+        with open(os.path.join(index_dir, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.n_docs = self.meta["n_docs"]
+        self.version = self.meta["version"]
+        self.fields = {field: FieldIndex.load(os.path.join(index_dir, field), english, self.n_docs, **self.meta["fields"][field])
+                       for field, english in FIELDS.items()}
+        self.stored = np.load(os.path.join(index_dir, "stored.npy"), mmap_mode="r")
+        self.stored_offsets = np.load(os.path.join(index_dir, "stored_offsets.npy"), mmap_mode="r")
+        self.doc_store = doc_store
+
+    def source(self, doc: int) -> Dict[str, Any]:
+        source = json.loads(self.stored[self.stored_offsets[doc]:self.stored_offsets[doc + 1]].tobytes())
+        if self.doc_store is not None:
+            source.update(self.doc_store.get(doc, ["content"]) or {})
+        return source
+
+    def top_k(self, field: str, query_text: str, k: int) -> List[Tuple[int, float]]:
+        """
+        :return: (doc, score) of the k best matching documents, ties broken by the smaller doc as in Lucene
+        """
+        scores = self.fields[field].score(query_text)
+        matched = np.flatnonzero(scores)
+        if len(matched) > k:
+            # keep every document tied with the k-th score, the tie break below decides which of them are in the top k
+            threshold = -np.partition(-scores[matched], k - 1)[k - 1]
+            matched = matched[scores[matched] >= threshold]
+        order = np.lexsort((matched, -scores[matched]))[:k]
+        return [(int(matched[i]), float(scores[matched[i]])) for i in order]
+
+    def execute(self, query: Dict[str, Any], k: int) -> Dict[str, Any]:
+        """
+        run an ES query body and return a raw ES search response, only match queries on the indexed fields and ids queries are served
+        """
+        st = time.perf_counter()
+        (kind, params), = query.items()
+        if kind == "match":
+            (field, match), = params.items()
+            if field not in self.fields:
+                raise NotImplementedError(f"field {field} is not in the BM25 index")
+            ranked = self.top_k(field, match["query"] if isinstance(match, dict) else match, k)
+        elif kind == "ids":
+            ranked = [(int(doc_id), 1.0) for doc_id in params["values"] if 0 <= int(doc_id) < self.n_docs][:k]
+        else:
+            raise NotImplementedError(f"{kind} queries need ES, the BM25 index only serves match and ids queries")
+        hits = [{"_index": "bm25_index", "_type": "_doc", "_id": str(doc), "_score": score, "_source": self.source(doc)} for doc, score in ranked]
+        return {"took": int((time.perf_counter() - st) * 1000), "timed_out": False,
+                "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0},
+                "hits": {"total": {"value": len(hits), "relation": "gte"}, "max_score": ranked[0][1] if ranked else None, "hits": hits}}
+
+
+def parity_report(index: BM25Index, index_name: str, k: int = 20) -> List[Dict[str, Any]]:
+    """
+    compare the rankings of the pa5 queries with the ones of ES, for both fields and both query types
+    overlap is the fraction of the ES top k also in the local top k, score_diff the largest relative score difference of the shared documents
+    """
+    from elasticsearch_dsl import Search  # type: ignore
+    from utils import load_topic_queries
+
+    rows = []
+    for topic, query in load_topic_queries("pa5_data/pa5_queries.json").items():
+        for query_type in ("kw", "nl"):
+            for field in FIELDS:
+                es_hits = Search(using="default", index=index_name).query("match", **{field: query[query_type]}).source(False)[:k].execute()
+                es_ranking = [(hit.meta.id, hit.meta.score) for hit in es_hits]
+                local = {str(doc): score for doc, score in index.top_k(field, query[query_type], k)}
+                shared = [(doc_id, score) for doc_id, score in es_ranking if doc_id in local]
+                rows.append({"topic": topic, "query_type": query_type, "field": field,
+                             "overlap": len(shared) / max(len(es_ranking), 1),
+                             "top1": bool(es_ranking) and next(iter(local), None) == es_ranking[0][0],
+                             "score_diff": max((abs(local[d] - s) / s for d, s in shared), default=0.0)})
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="build the in-process BM25 index, or compare its rankings with ES")
+    parser.add_argument("--wapo_path", required=False, type=str, default=None, help="build the index from this processed wapo jsonline file")
+    parser.add_argument("--output", required=False, type=str, default=BM25_INDEX_DIR, help="directory of the index")
+    parser.add_argument("--parity", action='store_true', help="compare the rankings of the pa5 queries with the ES index")
+    parser.add_argument("--index_name", required=False, type=str, default="wapo_docs_50k", help="name of the ES index of the parity report")
+    parser.add_argument("--top_k", required=False, type=int, default=20, help="depth of the parity report")
+    args = parser.parse_args()
+
+    if args.wapo_path:
+        from utils import load_clean_wapo_with_embedding
+        st = time.time()
+        build_index(load_clean_wapo_with_embedding(args.wapo_path), args.output)
+        print(f"Indexed {BM25Index(args.output).n_docs} documents in {time.time() - st:.2f} seconds")
+    if args.parity:
+        from es_service.connection import connect
+        connect()
+        rows = parity_report(BM25Index(args.output), args.index_name, args.top_k)
+        print(f"{'topic':6s} {'type':4s} {'field':16s} {'overlap@' + str(args.top_k):>10s} {'top1':>5s} {'score diff':>10s}")
+        for row in rows:
+            print(f"{row['topic']:6s} {row['query_type']:4s} {row['field']:16s} {row['overlap']:10.2f} {str(row['top1']):>5s} {row['score_diff']:10.4f}")
+        print(f"mean overlap@{args.top_k}: {np.mean([row['overlap'] for row in rows]):.3f}, "
+              f"top1 agreement: {np.mean([row['top1'] for row in rows]):.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+end-to-end latency budget of a search
+a Budget starts when the query arrives. every ES search of the query gets the remaining time as its request timeout (and as
+the ES search timeout, ES then returns the hits found so far) and the query embedding gets it as its deadline. a part of
+the budget (fallback_ms) is kept back: when the embedding or a vector search misses its deadline, or the embedding server
+fails, the search falls back to the BM25 ranking within that reserve, and the hits are returned as Degraded.
+an ES search that answers with partial hits (timed out, or some shards failed) marks the budget, the ranking is then
+returned as Degraded too. if the fallback itself fails the search is answered with an empty Degraded list.
+the budget of the running search is a context variable, so the helpers of evaluate.py read it without extra parameters
+"""
+from typing import Any, Iterable, Iterator, Optional
+from contextlib import contextmanager
+import contextvars
+import time
+
+from instrumentation import REGISTRY
+
+DEGRADED = REGISTRY.counter("search_degraded_total", "searches answered with the BM25 fallback or with partial ES results", ["reason"])
+_current: contextvars.ContextVar = contextvars.ContextVar("search_budget", default=None)
+
+
+class BudgetExceeded(Exception):
+    """
+    not enough of the budget is left to start the next call
+    """
+
+
+class Budget(object):
+    def __init__(self, total_ms: float, fallback_ms: float = 150, terminate_after: Optional[int] = None):
+        """
+        :param total_ms: time given to the whole search
+        :param fallback_ms: time kept back for the BM25 fallback, the embedding and vector searches only get the rest
+        :param terminate_after: documents collected per shard by each ES search, bounds the time of the searches on
+                                large indices at the cost of missing some matches
+        """
+        self.total_ms = total_ms
+        self.fallback_ms = fallback_ms
+        self.terminate_after = terminate_after
+        self.deadline = time.perf_counter() + total_ms / 1000
+        self.reserve_ms = fallback_ms
+        self.partial = False  # an ES search of the search returned partial hits
+
+    def remaining_ms(self) -> float:
+        """
+        time left for the next call, the fallback reserve excluded until release_reserve
+        """
+        return (self.deadline - time.perf_counter()) * 1000 - self.reserve_ms
+
+    def check(self, call: str) -> float:
+        """
+        :return: remaining_ms, raises BudgetExceeded if nothing is left for the call
+        """
+        remaining = self.remaining_ms()
+        if remaining <= 0:
+            raise BudgetExceeded(f"no time left for {call} ({self.total_ms:g} ms budget)")
+        return remaining
+
+    def release_reserve(self) -> None:
+        """
+        let the fallback spend the time kept back for it
+        """
+        self.reserve_ms = 0.0
+
+    def es_params(self) -> dict:
+        """
+        :return: parameters of an ES search: the client timeout in seconds and the ES search timeout a bit shorter, so that
+                 ES answers with its partial hits before the client gives up
+        """
+        remaining = self.check("the ES search")
+        return {"request_timeout": remaining / 1000, "timeout": f"{max(1, int(remaining * 0.8))}ms"}
+
+    @contextmanager
+    def activate(self) -> Iterator["Budget"]:
+        token = _current.set(self)
+        try:
+            yield self
+        finally:
+            _current.reset(token)
+
+
+def current() -> Optional[Budget]:
+    """
+    :return: the budget of the search running in this thread (or task), None if it has no budget
+    """
+    return _current.get()
+
+
+class Degraded(list):
+    """
+    hits returned in place of the requested ranking, reason says why ("embedding_timeout", "embedding_error", "es_timeout",
+    "budget_exhausted", "es_partial" for partial ES hits, "fallback_failed" for an empty list when the fallback failed too)
+    """
+
+    def __init__(self, hits: Iterable[Any], reason: str):
+        super().__init__(hits)
+        self.reason = reason
+
+
+def partial_response(timed_out: bool, failed_shards: int) -> bool:
+    """
+    count an ES response with partial hits and mark the budget of the search
+    """
+    if not timed_out and not failed_shards:
+        return False
+    DEGRADED.inc(reason="es_partial")
+    budget = current()
+    if budget is not None:
+        budget.partial = True
+    return True
+
+
+def degraded_reason(response: Any) -> Optional[str]:
+    return getattr(response, "reason", None) if isinstance(response, Degraded) else None
+
+
+if __name__ == "__main__":
+    pass
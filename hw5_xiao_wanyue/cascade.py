@@ -0,0 +1,102 @@
+"""
+multi-stage ranking cascade
+the first stage retrieves the candidates, each next stage only scores the documents kept by the stage before it and keeps
+its own depth, so the cheap scorers prune the candidates before the expensive ones, e.g. BM25 top 1000 -> fastText top 200
+-> sbert top 50. a stage combines its score with the ranking so far: "replace" ranks by its score alone, "weighted"
+min-max normalizes both (as the weighted fusion of the hybrid search) and "rrf" sums the reciprocal ranks.
+
+a cascade is written as its stages separated by commas, each one scorer:depth[:combine[:weight]], e.g.
+bm25:1000,ft_vector:200,sbert_vector:50:weighted:0.7
+"""
+from typing import Any, Dict, List, NamedTuple, Tuple
+
+SCORERS = ("bm25", "ft_vector", "sbert_vector", "paragraph")
+COMBINES = ("replace", "weighted", "rrf")
+
+
+class Stage(NamedTuple):
+    scorer: str  # one of SCORERS
+    depth: int  # documents kept after the stage
+    combine: str = "replace"  # one of COMBINES, how the stage score is merged with the ranking of the stages before
+    weight: float = 0.5  # weight of the stage score in the weighted combination, the ranking so far gets 1 - weight
+
+    def tag(self) -> str:
+        if self.combine == "weighted":
+            return f"{self.scorer}{self.depth}w{self.weight:g}"
+        return f"{self.scorer}{self.depth}" + ("" if self.combine == "replace" else self.combine)
+
+
+class CascadeConfig(NamedTuple):
+    stages: Tuple[Stage, ...] = (Stage("bm25", 1000), Stage("ft_vector", 200), Stage("sbert_vector", 50))
+    rrf_k: int = 60
+
+    def tag(self) -> str:
+        # identifies the ranking of the cascade, e.g. in the run cache key
+        return "cascade-" + "-".join(stage.tag() for stage in self.stages)
+
+    @classmethod
+    def parse(cls, spec: str, rrf_k: int = 60) -> "CascadeConfig":
+        """
+        :param spec: e.g. "bm25:1000,ft_vector:200,sbert_vector:50:weighted:0.7"
+        """
+        stages = []
+        for part in spec.split(","):
+            fields = part.strip().split(":")
+            if len(fields) < 2:
+                raise ValueError(f"cascade stage {part!r} should be scorer:depth[:combine[:weight]]")
+            stage = Stage(fields[0], int(fields[1]), *fields[2:3], *[float(weight) for weight in fields[3:4]])
+            if stage.scorer not in SCORERS or stage.combine not in COMBINES:
+                raise ValueError(f"cascade stage {part!r}: scorer must be one of {SCORERS} and combine one of {COMBINES}")
+            if stages and stage.depth > stages[-1].depth:
+                raise ValueError(f"cascade stage {part!r} keeps more documents than the stage before it")
+            stages.append(stage)
+        return cls(tuple(stages), rrf_k)
+
+
+class StageReport(NamedTuple):
+    stage: Stage
+    candidates: int  # documents scored by the stage
+    seconds: float
+    hits: List[Any]  # ranking after the stage, the hits are shared by the reports and hit.meta.score is set by the last stage
+    scores: List[float]  # score of each hit after the stage
+
+
+def _normalize(scores: Dict[str, float]) -> Dict[str, float]:
+    finite = [score for score in scores.values() if score != float("-inf")]
+    if not finite:
+        return {doc_id: 0.0 for doc_id in scores}
+    low, high = min(finite), max(finite)
+    return {doc_id: (score - low) / (high - low) if high > low else 1.0 if score != float("-inf") else 0.0
+            for doc_id, score in scores.items()}
+
+
+def combine(ranking: List[Any], scores: Dict[str, float], stage: Stage, rrf_k: int = 60) -> List[Any]:
+    """
+    merge the scores of a stage into the ranking so far
+    :param ranking: hits ranked by the stages before
+    :param scores: score of the stage for each document of the ranking it could score
+    :return: the top stage.depth hits, with the combined score as hit.meta.score, documents without a stage score go last
+             with "replace", ties keep the order of the ranking so far
+    """
+    doc_ids = [hit.meta.id for hit in ranking]
+    if stage.combine == "replace":
+        combined = {doc_id: scores.get(doc_id, float("-inf")) for doc_id in doc_ids}
+    elif stage.combine == "weighted":
+        previous = _normalize({hit.meta.id: hit.meta.score for hit in ranking})
+        current = _normalize(scores)
+        combined = {doc_id: (1.0 - stage.weight) * previous[doc_id] + stage.weight * current.get(doc_id, 0.0) for doc_id in doc_ids}
+    elif stage.combine == "rrf":
+        stage_rank = {doc_id: rank for rank, doc_id in enumerate(sorted(scores, key=lambda doc_id: -scores[doc_id]), start=1)}
+        combined = {doc_id: 1.0 / (rrf_k + rank) + (1.0 / (rrf_k + stage_rank[doc_id]) if doc_id in stage_rank else 0.0)
+                    for rank, doc_id in enumerate(doc_ids, start=1)}
+    else:
+        raise NotImplementedError(stage.combine)
+
+    order = sorted(range(len(ranking)), key=lambda i: -combined[doc_ids[i]])[:stage.depth]
+    for i in order:
+        ranking[i].meta.score = combined[doc_ids[i]]
+    return [ranking[i] for i in order]
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+NDCG@k and latency of each ranking mode on the 12 topics of pa5_queries.json
+the hybrid modes are reported next to bm25, vector only and bm25-then-rerank, the embedding servers of the chosen
+embeddings must be up
+each --cascades cascade gets a row per stage, with the NDCG@k of the ranking after the stage and the time spent up to it,
+to find the cheapest cascade that matches the quality of the expensive scorer alone
+
+python compare_modes.py --index_name wapo_docs_50k --query_type kw --embeddings ft_vector sbert_vector
+python compare_modes.py --index_name wapo_docs_50k --embeddings sbert_vector --cascades bm25:1000,ft_vector:200,sbert_vector:50 bm25:1000,sbert_vector:50
+"""
+from typing import Dict, List, Tuple
+import argparse
+import json
+import time
+
+import numpy as np  # type: ignore
+
+from es_service.connection import add_arguments, config_from_args, connect
+from cascade import CascadeConfig
+from evaluate import cascade_search, get_response, get_score, match_query
+from fusion import FusionConfig
+from utils import load_topic_queries
+
+
+def modes(embeddings: List[str], fusion: FusionConfig) -> List[Tuple[str, str, str, FusionConfig]]:
+    """
+    :return: (name, search type, embedding, fusion) of each mode
+    """
+    result = [("bm25", "vector", "bm25", None)]
+    for embedding in embeddings:
+        result.append((f"vector {embedding}", "vector", embedding, None))
+        result.append((f"rerank {embedding}", "rerank", embedding, None))
+        result.append((f"hybrid-rrf {embedding}", "hybrid", embedding, fusion._replace(method="rrf")))
+        result.append((f"hybrid-weighted {embedding}", "hybrid", embedding, fusion._replace(method="weighted")))
+    return result
+
+
+def cascade_rows(index_name: str, queries: Dict[str, Dict[str, str]], query_type: str, cascade: CascadeConfig, top_k: int,
+                 repeat: int) -> List[Dict]:
+    """
+    :return: per stage of the cascade, the NDCG@top_k of the ranking after the stage and the latency up to the end of the stage
+    """
+    ndcg = [[] for _ in cascade.stages]
+    latencies = [[] for _ in cascade.stages]
+    for topic, query in queries.items():
+        stage_ends = []
+        for _ in range(repeat):
+            reports = cascade_search(index_name, match_query(query[query_type], True), query[query_type], cascade)
+            stage_ends.append(np.cumsum([report.seconds for report in reports]) * 1000)
+        for i, (report, latency) in enumerate(zip(reports, np.median(stage_ends, axis=0))):
+            ndcg[i].append(get_score(report.hits[:top_k], topic, top_k).ndcg)
+            latencies[i].append(float(latency))
+    rows = []
+    for i, stage in enumerate(cascade.stages):
+        rows.append({"mode": f"{cascade.tag()} @{stage.tag()}", "ndcg": float(np.mean(ndcg[i])), "p50_ms": float(np.percentile(latencies[i], 50)),
+                     "p95_ms": float(np.percentile(latencies[i], 95)), "per_topic_ndcg": dict(zip(queries, ndcg[i]))})
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="NDCG and latency of the ranking modes")
+    parser.add_argument("--index_name", required=False, type=str, default="wapo_docs_50k", help="name of the ES index")
+    parser.add_argument("--query_type", required=False, type=str, default="kw", choices=["kw", "nl"], help="use keyword or natural language query")
+    parser.add_argument("--embeddings", required=False, type=str, nargs="+", default=["ft_vector", "sbert_vector"], help="embeddings of the vector modes")
+    parser.add_argument("--top_k", required=False, type=int, default=20, help="evaluate on top k ranked documents")
+    parser.add_argument("--repeat", required=False, type=int, default=3, help="searches of each query, the median latency is reported")
+    parser.add_argument("--bm25_depth", required=False, type=int, default=100, help="documents retrieved by the bm25 leg of the hybrid search")
+    parser.add_argument("--vector_depth", required=False, type=int, default=100, help="documents retrieved by the vector leg of the hybrid search")
+    parser.add_argument("--rrf_k", required=False, type=int, default=60, help="rank constant of reciprocal rank fusion")
+    parser.add_argument("--bm25_weight", required=False, type=float, default=0.5, help="weight of the bm25 leg in weighted fusion")
+    parser.add_argument("--cascades", required=False, type=str, nargs="*", default=[], help="cascades reported stage by stage, scorer:depth[:combine[:weight]] separated by commas (see cascade.py)")
+    parser.add_argument("--output", required=False, type=str, default=None, help="write the table to this json file")
+    add_arguments(parser)
+    args = parser.parse_args()
+    connect(config_from_args(args))
+
+    queries = load_topic_queries("pa5_data/pa5_queries.json")
+    fusion = FusionConfig("rrf", args.bm25_depth, args.vector_depth, args.rrf_k, args.bm25_weight)
+    rows = []
+    print(f"{'mode':28s} {'NDCG@' + str(args.top_k):>8s} {'p50 ms':>9s} {'p95 ms':>9s}")
+    for name, search_type, embedding, mode_fusion in modes(args.embeddings, fusion):
+        ndcg, latencies = [], []
+        for topic, query in queries.items():
+            query_latencies = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                response = get_response(args.index_name, query[args.query_type], True, search_type, embedding, args.top_k, fusion=mode_fusion)
+                query_latencies.append((time.perf_counter() - start) * 1000)
+            latencies.append(float(np.median(query_latencies)))
+            ndcg.append(get_score(response, topic, args.top_k).ndcg)
+        row = {"mode": name, "ndcg": float(np.mean(ndcg)), "p50_ms": float(np.percentile(latencies, 50)),
+               "p95_ms": float(np.percentile(latencies, 95)), "per_topic_ndcg": dict(zip(queries, ndcg))}
+        rows.append(row)
+        print(f"{name:28s} {row['ndcg']:8.4f} {row['p50_ms']:9.1f} {row['p95_ms']:9.1f}")
+    for spec in args.cascades:
+        for row in cascade_rows(args.index_name, queries, args.query_type, CascadeConfig.parse(spec, args.rrf_k), args.top_k, args.repeat):
+            rows.append(row)
+            print(f"{row['mode']:28s} {row['ndcg']:8.4f} {row['p50_ms']:9.1f} {row['p95_ms']:9.1f}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
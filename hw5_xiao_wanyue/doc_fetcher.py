@@ -0,0 +1,87 @@
+"""
+fast path for the document page
+documents are fetched by a direct get on their id with only the displayed fields, kept in a small LRU,
+and the documents of a result page can be prefetched in the background with a single multi-get.
+with a doc store of the corpus (see doc_store.py) the documents are read from the corpus file and ES is only asked for
+the ids missing from the store
+"""
+from typing import Dict, List, Optional, Sequence, Set
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+from elasticsearch.exceptions import NotFoundError  # type: ignore
+from elasticsearch_dsl.connections import connections  # type: ignore
+
+from doc_store import DocStore
+from es_service.connection import request_timeout
+from result_cache import ResultCache
+
+DOC_FIELDS = ["title", "author", "date", "content"]
+
+
+class DocFetcher(object):
+    def __init__(self, index_name: str, max_mb: float = 16, using: str = "default", store: Optional[DocStore] = None):
+        """
+        :param index_name: ES index (or alias) of the documents
+        :param max_mb: memory budget of the recently viewed / prefetched documents
+        :param using: alias of the ES connection
+        :param store: doc store of the corpus indexed in index_name
+        """
+        self.index_name = index_name
+        self.using = using
+        self.store = store
+        self.cache = ResultCache(max_bytes=int(max_mb * 1024 * 1024), ttl=float("inf"), name="documents")
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="doc-prefetch")
+        self.pending: Set[str] = set()  # ids being prefetched, not submitted again by the next prefetch
+        self.lock = threading.Lock()
+
+    def get(self, doc_id: str) -> Optional[Dict[str, str]]:
+        """
+        :return: the displayed fields of the document, None if there is no such document
+        """
+        doc = self.cache.get(doc_id)
+        if doc is not None:
+            return doc
+        if self.store is not None and doc_id.isdigit():
+            stored = self.store.get(int(doc_id), DOC_FIELDS)
+            if stored is not None:
+                doc = {field: str(value) for field, value in stored.items()}
+                self.cache.put(doc_id, doc)
+                return doc
+        try:
+            hit = connections.get_connection(self.using).get(index=self.index_name, id=doc_id, _source_includes=DOC_FIELDS,
+                                                             request_timeout=request_timeout("get", self.using))
+        except NotFoundError:
+            return None
+        doc = {field: str(hit["_source"].get(field)) for field in DOC_FIELDS}
+        self.cache.put(doc_id, doc)
+        return doc
+
+    def _fetch_many(self, doc_ids: List[str]) -> None:
+        try:
+            result = connections.get_connection(self.using).mget(index=self.index_name, body={"ids": doc_ids}, _source_includes=DOC_FIELDS,
+                                                                 request_timeout=request_timeout("get", self.using))
+            for hit in result["docs"]:
+                if hit.get("found"):
+                    self.cache.put(hit["_id"], {field: str(hit["_source"].get(field)) for field in DOC_FIELDS})
+        finally:
+            with self.lock:
+                self.pending.difference_update(doc_ids)
+
+    def prefetch(self, doc_ids: Sequence[str]) -> None:
+        """
+        load the documents that are not cached yet in the background, errors are ignored since get() falls back to ES
+        nothing to do with a doc store, reading a document from it is faster than a cache miss on ES
+        """
+        if self.store is not None:
+            return
+        with self.lock:
+            # membership checks, a prefetch is not a lookup of the cache hit ratio
+            missing = [doc_id for doc_id in dict.fromkeys(map(str, doc_ids)) if doc_id not in self.pending and doc_id not in self.cache]
+            self.pending.update(missing)
+        if missing:
+            self.executor.submit(self._fetch_many, missing)
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,176 @@
+"""
+document store over the corpus jsonl file
+the byte offset of every line is recorded once (the line number is the ES _id, as in load_es_index.py), with the doc_id of
+each line sorted for lookups by doc_id. the reader memory-maps the corpus and parses one line on demand; when only some
+fields are asked for, only their values are decoded and the large vector fields are skipped.
+
+built while loading ES (python load_es_index.py ... --doc_store pa5_data/doc_store) or alone:
+python doc_store.py --wapo_path pa5_data/wapo_docs.jl --output pa5_data/doc_store
+python doc_store.py --output pa5_data/doc_store --get 42 --fields title author
+"""
+from typing import Any, Dict, Iterator, Mapping, Optional, Sequence
+import argparse
+import json
+import mmap
+import os
+import time
+
+import numpy as np  # type: ignore
+
+DOC_STORE_DIR = "./pa5_data/doc_store"
+# names of the ES document fields (es_service.doc_template.BaseDoc) -> field of the corpus line holding the value
+ES_FIELDS = {"content": "content_str", "stemmed_content": "content_str", "date": "published_date"}
+_DECODER = json.JSONDecoder()
+
+
+def _find_value(raw: bytes, field: str) -> int:
+    """
+    :return: position of the value of a top level key in a json object, -1 if the key is missing
+    a quote inside a string value is always escaped, so an unescaped '"field":' can only be a key (the documents are flat)
+    """
+    key = json.dumps(field).encode("utf-8")
+    start = raw.find(key)
+    while start >= 0:
+        backslashes = 0
+        while start - backslashes > 0 and raw[start - backslashes - 1] == 0x5c:
+            backslashes += 1
+        end = start + len(key)
+        while end < len(raw) and raw[end] in b" \t":
+            end += 1
+        if backslashes % 2 == 0 and end < len(raw) and raw[end] == 0x3a:  # ':'
+            end += 1
+            while end < len(raw) and raw[end] in b" \t":
+                end += 1
+            return end
+        start = raw.find(key, start + 1)
+    return -1
+
+
+class LazyDoc(Mapping):
+    """
+    a corpus document decoded field by field on access
+    """
+
+    def __init__(self, raw: bytes):
+        self.raw = raw
+        self.text = None
+        self.values: Dict[str, Any] = {}
+        self.full: Optional[Dict[str, Any]] = None
+
+    def __getitem__(self, field: str) -> Any:
+        if self.full is not None:
+            return self.full[field]
+        if field not in self.values:
+            position = _find_value(self.raw, field)
+            if position < 0:
+                raise KeyError(field)
+            # decode the str once, the positions of the bytes and of the str only match on ascii documents
+            if self.text is None:
+                self.text = self.raw.decode("utf-8")
+            text_position = position if self.raw.isascii() else len(self.raw[:position].decode("utf-8"))
+            self.values[field] = _DECODER.raw_decode(self.text, text_position)[0]
+        return self.values[field]
+
+    def decode(self) -> Dict[str, Any]:
+        if self.full is None:
+            self.full = json.loads(self.raw)
+        return self.full
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.decode())
+
+    def __len__(self) -> int:
+        return len(self.decode())
+
+
+def build_store(corpus_path: str, output_dir: str = DOC_STORE_DIR) -> int:
+    """
+    record the byte offset and the doc_id of every line of the corpus
+    :return: number of documents
+    """
+    offsets, doc_ids = [0], []
+    with open(corpus_path, "rb") as f:
+        for line in f:
+            offsets.append(offsets[-1] + len(line))
+            doc_ids.append(LazyDoc(line)["doc_id"].encode("utf-8"))
+    keys = np.array(doc_ids, dtype=bytes)
+    order = np.argsort(keys, kind="stable")
+    os.makedirs(output_dir, exist_ok=True)
+    np.save(os.path.join(output_dir, "offsets.npy"), np.asarray(offsets, dtype=np.int64))
+    np.save(os.path.join(output_dir, "doc_ids.npy"), keys[order])
+    np.save(os.path.join(output_dir, "doc_rows.npy"), order.astype(np.int64))
+    stat = os.stat(corpus_path)
+    with open(os.path.join(output_dir, "meta.json"), "w") as f:
+        json.dump({"corpus_path": os.path.abspath(corpus_path), "size": stat.st_size, "mtime": stat.st_mtime}, f)
+    return len(doc_ids)
+
+
+class DocStore(object):
+    def __init__(self, store_dir: str = DOC_STORE_DIR, corpus_path: Optional[str] = None):
+        """
+        :param corpus_path: the corpus file, default the one the store was built from, it must not have changed since
+        """
+        with open(os.path.join(store_dir, "meta.json")) as f:
+            meta = json.load(f)
+        self.corpus_path = corpus_path or meta["corpus_path"]
+        stat = os.stat(self.corpus_path)
+        if stat.st_size != meta["size"] or stat.st_mtime != meta["mtime"]:
+            raise ValueError(f"{self.corpus_path} changed since the doc store in {store_dir} was built, build it again")
+        self.offsets = np.load(os.path.join(store_dir, "offsets.npy"), mmap_mode="r")
+        self.doc_ids = np.load(os.path.join(store_dir, "doc_ids.npy"), mmap_mode="r")
+        self.doc_rows = np.load(os.path.join(store_dir, "doc_rows.npy"), mmap_mode="r")
+        self.n_docs = len(self.offsets) - 1
+        with open(self.corpus_path, "rb") as f:
+            self.corpus = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def raw(self, es_id: int) -> bytes:
+        return self.corpus[self.offsets[es_id]:self.offsets[es_id + 1]]
+
+    def id_of(self, doc_id: str) -> int:
+        """
+        :return: the ES _id (line number) of a doc_id, -1 if it is not in the corpus
+        """
+        key = doc_id.encode("utf-8")
+        i = int(np.searchsorted(self.doc_ids, key))
+        return int(self.doc_rows[i]) if i < len(self.doc_ids) and self.doc_ids[i] == key else -1
+
+    def get(self, es_id: int, fields: Optional[Sequence[str]] = None) -> Optional[Mapping[str, Any]]:
+        """
+        :param fields: only decode these fields, ES field names (content, date) are mapped to the corpus fields
+        :return: the document (a lazily decoded LazyDoc if fields is None), None if es_id is not in the corpus
+        """
+        if not 0 <= es_id < self.n_docs:
+            return None
+        doc = LazyDoc(self.raw(es_id))
+        if fields is None:
+            return doc
+        return {field: doc.get(ES_FIELDS.get(field, field)) for field in fields}
+
+    def get_by_doc_id(self, doc_id: str, fields: Optional[Sequence[str]] = None) -> Optional[Mapping[str, Any]]:
+        return self.get(self.id_of(doc_id), fields)
+
+    def close(self) -> None:
+        self.corpus.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="build the document store of a corpus, or read documents from it")
+    parser.add_argument("--wapo_path", required=False, type=str, default=None, help="build the store of this processed wapo jsonline file")
+    parser.add_argument("--output", required=False, type=str, default=DOC_STORE_DIR, help="directory of the store")
+    parser.add_argument("--get", required=False, type=str, nargs="*", default=[], help="print the documents with these ES ids or doc_ids")
+    parser.add_argument("--fields", required=False, type=str, nargs="+", default=["doc_id", "title", "author", "date"], help="fields printed by --get")
+    args = parser.parse_args()
+
+    if args.wapo_path:
+        st = time.time()
+        n_docs = build_store(args.wapo_path, args.output)
+        print(f"Stored the offsets of {n_docs} documents in {time.time() - st:.2f} seconds")
+    if args.get:
+        store = DocStore(args.output)
+        for key in args.get:
+            doc = store.get(int(key), args.fields) if key.isdigit() else store.get_by_doc_id(key, args.fields)
+            print(json.dumps(doc, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""
+offline embedding of a corpus jsonl file
+documents are streamed in chunks, each chunk is sorted by token length and cut into batches so that the texts of a batch
+have similar lengths (little padding), the batches are encoded by a pool of Encoder processes and the documents are
+written back in their original order with the vector added, i.e. in the format read by load_es_index.py.
+progress is checkpointed after every chunk and a restarted job resumes after the last complete chunk.
+
+python embed_corpus.py --wapo_path pa5_data/wapo_docs.jl --output pa5_data/wapo_docs_sbert.jl --embedding sbert --model msmarco-distilbert-base-v3
+"""
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+import argparse
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import time
+
+import numpy as np  # type: ignore
+
+from utils import load_clean_wapo_with_embedding
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+logging.basicConfig(format="%(asctime)s %(levelname)-8s %(message)s", level=logging.INFO, datefmt="%Y-%m-%d %H:%M:%S")
+
+# the encoder of each pool process
+_encoder = None
+
+
+def _init_encoder(embedding: str, model: str, backend: str) -> None:
+    global _encoder
+    from embedding_service.embed import Encoder
+    _encoder = Encoder(embedding=embedding, model=model, backend=backend)
+
+
+def _encode_batch(texts: List[str]) -> np.ndarray:
+    return _encoder.encode(texts, pooling="mean", batch_size=len(texts))
+
+
+def load_checkpoint(path: str) -> Dict[str, Any]:
+    if not os.path.exists(path):
+        return {"docs_done": 0, "output_bytes": 0}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_checkpoint(path: str, checkpoint: Dict[str, Any]) -> None:
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)  # atomic, a crash leaves either the old or the new checkpoint
+
+
+def length_batches(texts: Sequence[str], batch_size: int, max_tokens: int = 512) -> List[List[int]]:
+    """
+    :return: indices of the texts cut into batches of texts with similar (whitespace token) lengths
+    """
+    order = sorted(range(len(texts)), key=lambda i: min(len(texts[i].split()), max_tokens))
+    return [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+
+
+class CorpusEmbedder(object):
+    def __init__(self, embedding: str, model: str, vector_field: str, text_fields: Sequence[str] = ("title", "content_str"),
+                 backend: str = "torch", num_encoders: int = 1, batch_size: int = 64, chunk_size: int = 4096):
+        """
+        :param embedding: embedding type, as for embedding_service.server
+        :param model: name/path of the model
+        :param vector_field: field of the vector in the output documents, e.g. sbert_vector
+        :param text_fields: fields of the document joined into the encoded text
+        :param backend: inference backend of the Encoder
+        :param num_encoders: number of encoder processes, 0 encodes in this process
+        :param batch_size: texts per encode call
+        :param chunk_size: documents read ahead and sorted by length, also the checkpoint interval
+        """
+        self.vector_field = vector_field
+        self.text_fields = list(text_fields)
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.pool = None
+        if num_encoders > 0:
+            self.pool = multiprocessing.Pool(num_encoders, initializer=_init_encoder, initargs=(embedding, model, backend))
+        else:
+            _init_encoder(embedding, model, backend)
+
+    def text_of(self, doc: Dict) -> str:
+        return " ".join(str(doc.get(field) or "") for field in self.text_fields)
+
+    def embed_chunk(self, docs: List[Dict]) -> np.ndarray:
+        texts = [self.text_of(doc) for doc in docs]
+        batches = length_batches(texts, self.batch_size)
+        batch_texts = [[texts[i] for i in batch] for batch in batches]
+        encoded = self.pool.imap(_encode_batch, batch_texts) if self.pool is not None else map(_encode_batch, batch_texts)
+        vectors: Optional[np.ndarray] = None
+        for batch, batch_vectors in zip(batches, encoded):
+            if vectors is None:
+                vectors = np.empty((len(docs), batch_vectors.shape[1]), dtype=np.float32)
+            vectors[batch] = batch_vectors
+        return vectors
+
+    def run(self, docs: Iterator[Dict], output_path: str, checkpoint_path: str, limit: Optional[int] = None) -> int:
+        """
+        embed the documents and append them to the output file, resuming from the checkpoint
+        :return: number of documents embedded by this run
+        """
+        checkpoint = load_checkpoint(checkpoint_path)
+        # drop whatever was written after the last checkpoint
+        with open(output_path, "a+b") as f:
+            f.truncate(checkpoint["output_bytes"])
+        if checkpoint["docs_done"]:
+            logger.info(f"Resuming after {checkpoint['docs_done']} documents")
+        docs = itertools.islice(docs, checkpoint["docs_done"], limit)
+
+        start, done = time.time(), 0
+        with open(output_path, "ab") as f:
+            while True:
+                chunk = list(itertools.islice(docs, self.chunk_size))
+                if not chunk:
+                    break
+                vectors = self.embed_chunk(chunk)
+                for doc, vector in zip(chunk, vectors):
+                    doc[self.vector_field] = vector.tolist()
+                    f.write((json.dumps(doc) + "\n").encode("utf-8"))
+                f.flush()
+                os.fsync(f.fileno())
+                done += len(chunk)
+                checkpoint = {"docs_done": checkpoint["docs_done"] + len(chunk), "output_bytes": f.tell()}
+                save_checkpoint(checkpoint_path, checkpoint)
+                logger.info(f"{checkpoint['docs_done']} documents embedded, {done / (time.time() - start):.1f} docs/sec")
+        elapsed = time.time() - start
+        logger.info(f"=== Embedded {done} documents in {elapsed:.2f} seconds ({done / max(elapsed, 1e-9):.1f} docs/sec) ===")
+        return done
+
+    def close(self) -> None:
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="embed a corpus jsonl file offline")
+    parser.add_argument("--wapo_path", required=True, type=str, help="path to the processed wapo jsonline file")
+    parser.add_argument("--output", required=True, type=str, help="output jsonline file, the input documents with the vector added")
+    parser.add_argument("--embedding", required=True, type=str, help="name of the embedding type")
+    parser.add_argument("--model", required=True, type=str, help="name/path of the embedding model")
+    parser.add_argument("--vector_field", required=False, type=str, default=None, help="field of the vector, default <embedding>_vector")
+    parser.add_argument("--text_fields", required=False, type=str, nargs="+", default=["title", "content_str"], help="fields joined into the encoded text")
+    parser.add_argument("--backend", required=False, type=str, default="torch", choices=["torch", "onnx", "onnx-int8"], help="inference backend of sbert")
+    parser.add_argument("--num_encoders", required=False, type=int, default=1, help="number of encoder processes, 0 to encode in this process")
+    parser.add_argument("--batch_size", required=False, type=int, default=64, help="texts per encode call")
+    parser.add_argument("--chunk_size", required=False, type=int, default=4096, help="documents sorted by length together, also the checkpoint interval")
+    parser.add_argument("--checkpoint", required=False, type=str, default=None, help="checkpoint file, default <output>.ckpt")
+    parser.add_argument("--limit", required=False, type=int, default=None, help="only embed the first documents")
+    args = parser.parse_args()
+
+    vector_field = args.vector_field or {"fasttext": "ft_vector"}.get(args.embedding, f"{args.embedding}_vector")
+    embedder = CorpusEmbedder(args.embedding, args.model, vector_field, args.text_fields, args.backend, args.num_encoders,
+                              args.batch_size, args.chunk_size)
+    try:
+        embedder.run(load_clean_wapo_with_embedding(args.wapo_path), args.output, args.checkpoint or args.output + ".ckpt", args.limit)
+    finally:
+        embedder.close()
+
+
+if __name__ == "__main__":
+    main()
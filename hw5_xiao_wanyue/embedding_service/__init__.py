@@ -1,4 +1,19 @@
+from typing import List
+import os
+
 # set the port number for an embedding server
 # we may want to be consistent about the port number for different servers to avoid conflicts.
 PORT_EMBEDDING_MAPPING = {8080: "sbert", 8081: "fasttext"}
 INV_PORT_EMBEDDING_MAPPING = {"sbert": 8080, "fasttext": 8081}
+
+
+def get_endpoints(embedding_type: str, host: str = "localhost") -> List[str]:
+    """
+    host:port of each replica of an embedding server
+    read from $EMBEDDING_ENDPOINTS_<TYPE> (comma separated, e.g. EMBEDDING_ENDPOINTS_SBERT=localhost:8100,localhost:8101),
+    by default the single server on the port of INV_PORT_EMBEDDING_MAPPING
+    """
+    value = os.environ.get(f"EMBEDDING_ENDPOINTS_{embedding_type.upper()}")
+    if value:
+        return [endpoint.strip() for endpoint in value.split(",") if endpoint.strip()]
+    return [f"{host}:{INV_PORT_EMBEDDING_MAPPING[embedding_type]}"]
@@ -3,11 +3,81 @@ embedding client
 adapted from https://github.com/amansrivastava17/embedding-as-service
 """
 
-from typing import Union, List, Optional
+from typing import Union, List, Optional, Iterator, Tuple, Dict, Sequence
+import asyncio
+import itertools
+import random
+import threading
 import numpy as np
 import zmq
+import zmq.asyncio
 import json
-from embedding_service import INV_PORT_EMBEDDING_MAPPING
+import time
+import uuid
+from embedding_service import get_endpoints
+
+
+class EmbeddingServerError(Exception):
+    """
+    the server answered with an error instead of embeddings, e.g. "overloaded" or "deadline exceeded"
+    """
+
+
+def parse_result(result: bytes) -> np.array:
+    result = json.loads(result.decode("utf-8"))
+    if isinstance(result, dict) and "error" in result:
+        raise EmbeddingServerError(result["error"])
+    return np.array(result)
+
+
+class EndpointHealth(object):
+    """
+    health of the server replicas, shared by all the clients of the process.
+    an endpoint that fails a health check or lets a request time out is skipped for down_seconds
+    """
+
+    def __init__(self, check_interval: float = 5.0, down_seconds: float = 5.0):
+        self.check_interval = check_interval
+        self.down_seconds = down_seconds
+        self.down_until: Dict[str, float] = {}
+        self.checked_at: Dict[str, float] = {}
+        self.lock = threading.Lock()
+
+    def is_up(self, endpoint: str) -> bool:
+        return time.time() >= self.down_until.get(endpoint, 0.0)
+
+    def mark_up(self, endpoint: str) -> None:
+        with self.lock:
+            self.down_until.pop(endpoint, None)
+
+    def mark_down(self, endpoint: str) -> None:
+        with self.lock:
+            self.down_until[endpoint] = time.time() + self.down_seconds
+
+    def claim_check(self, endpoint: str) -> bool:
+        """
+        True if the endpoint is due for a health check, the caller is then expected to check it
+        """
+        with self.lock:
+            now = time.time()
+            if now - self.checked_at.get(endpoint, 0.0) < self.check_interval:
+                return False
+            self.checked_at[endpoint] = now
+            return True
+
+
+HEALTH = EndpointHealth()
+
+
+def pick_endpoint(endpoints: List[str], outstanding: List[int], exclude: Sequence[int] = ()) -> int:
+    """
+    least-outstanding-requests routing among the healthy endpoints, ties are broken at random so that short-lived clients
+    spread over the replicas too
+    """
+    candidates = [i for i, endpoint in enumerate(endpoints) if i not in exclude and HEALTH.is_up(endpoint)]
+    if not candidates:
+        candidates = [i for i in range(len(endpoints)) if i not in exclude] or list(range(len(endpoints)))
+    return min(candidates, key=lambda i: (outstanding[i], random.random()))
 
 
 class EmbeddingClient(object):
@@ -15,30 +85,137 @@ class EmbeddingClient(object):
     Represents an example client.
     """
 
-    def __init__(self, host, embedding_type):
+    def __init__(self, host, embedding_type, endpoints: Optional[List[str]] = None, health_timeout_ms: int = 100):
+        """
+        :param endpoints: host:port of the replicas of the server, default get_endpoints(embedding_type, host)
+        :param health_timeout_ms: time given to the replicas to answer a health check
+        """
         self.zmq_context = zmq.Context()
-        self.socket = self.zmq_context.socket(zmq.DEALER)
-        self.socket.connect(f"tcp://{host}:{INV_PORT_EMBEDDING_MAPPING[embedding_type]}")
-        self.identity = "123"
+        self.endpoints = endpoints or get_endpoints(embedding_type, host)
+        self.sockets = []
+        self.poller = zmq.Poller()
+        for endpoint in self.endpoints:
+            socket = self.zmq_context.socket(zmq.DEALER)
+            socket.connect(f"tcp://{endpoint}")
+            self.sockets.append(socket)
+            self.poller.register(socket, zmq.POLLIN)
+        self.socket = self.sockets[0]
+        self.outstanding = [0] * len(self.endpoints)
+        self.identity = uuid.uuid4().hex[:8]
+        self.request_ids = itertools.count()
+        if len(self.endpoints) > 1:
+            self.check_health(health_timeout_ms)
 
-    def encode(self, texts: Union[List[str], List[List[str]]], pooling: Optional[str] = "mean", batch_size: int = 256, **kwargs,) -> np.array:
+    def check_health(self, timeout_ms: int = 100, force: bool = False) -> List[str]:
         """
-        Connects to server. Send compute request, poll for and print result to standard out.
+        Ping the replicas that were not checked recently (all of them if force) and mark the silent ones as down.
+        :return: the endpoints that are up
         """
-        if not isinstance(texts, list):
-            raise ValueError("Argument `texts` should be either List[str] or List[List[str]]")
-        embeddings = []
-        for i in range(0, len(texts), batch_size):
-            request_data = {"type": "encode", "texts": texts[i : i + batch_size], "pooling": pooling,}
-            self.send(json.dumps(request_data))
-            result = self.receive()
-            result = json.loads(result.decode("utf-8"))
-            embeddings.append(np.array(result))
+        pings = {}  # request id -> endpoint index
+        for i, endpoint in enumerate(self.endpoints):
+            if force or HEALTH.claim_check(endpoint):
+                request_id = f"{self.identity}-{next(self.request_ids)}"
+                self.sockets[i].send_string(json.dumps({"type": "ping", "id": request_id}))
+                pings[request_id] = i
+        deadline = time.time() + timeout_ms / 1000
+        while pings:
+            events = dict(self.poller.poll(max(0, int((deadline - time.time()) * 1000))))
+            if not events:
+                break
+            for socket in events:
+                frames = socket.recv_multipart()
+                i = pings.pop(frames[0].decode("utf-8"), None)
+                if i is not None and frames[-1] == b"pong":
+                    HEALTH.mark_up(self.endpoints[i])
+        for i in pings.values():
+            HEALTH.mark_down(self.endpoints[i])
+            self.sockets[i].setsockopt(zmq.LINGER, 0)
+        return [endpoint for endpoint in self.endpoints if HEALTH.is_up(endpoint)]
+
+    def encode(self, texts: Union[List[str], List[List[str]]], pooling: Optional[str] = "mean", batch_size: int = 256,
+               max_in_flight: int = 4, timeout_ms: Optional[float] = None, **kwargs,) -> np.array:
+        """
+        Connects to server. Send compute requests, keeping up to max_in_flight batches at the servers so that several
+        server workers (and replicas) compute them at once, and reassemble the results in the order of the texts.
+        Raises TimeoutError if the embeddings are not back within timeout_ms, and EmbeddingServerError if the server
+        rejects a batch (overloaded or past the deadline).
+        """
+        embeddings = [None] * ((len(texts) + batch_size - 1) // batch_size)
+        for start, batch_embeddings in self.stream_encode(texts, pooling, batch_size, max_in_flight, timeout_ms):
+            embeddings[start // batch_size] = batch_embeddings
         embeddings = np.vstack(embeddings)
         return embeddings
 
+    def stream_encode(self, texts: Union[List[str], List[List[str]]], pooling: Optional[str] = "mean", batch_size: int = 256,
+                      max_in_flight: int = 4, timeout_ms: Optional[float] = None) -> Iterator[Tuple[int, np.array]]:
+        """
+        Yield (offset of the batch in texts, embeddings of the batch) as the batches arrive, not necessarily in order.
+        Each batch goes to the healthy replica with the fewest outstanding requests, a batch rejected as overloaded is
+        retried once on another replica.
+        :param timeout_ms: deadline of the whole call, sent with each request so that the server skips batches nobody waits for anymore
+        """
+        if not isinstance(texts, list):
+            raise ValueError("Argument `texts` should be either List[str] or List[List[str]]")
+        deadline = time.time() + timeout_ms / 1000 if timeout_ms is not None else None
+        starts = iter(range(0, len(texts), batch_size))
+        in_flight = {}  # request id -> (offset of its batch, endpoint index, endpoint indices tried before)
+
+        def send(start: int, tried: Tuple[int, ...] = ()) -> None:
+            i = pick_endpoint(self.endpoints, self.outstanding, tried)
+            request_id = f"{self.identity}-{next(self.request_ids)}"
+            request_data = {"type": "encode", "id": request_id, "texts": texts[start : start + batch_size], "pooling": pooling,
+                            "sent_at": time.time(), "deadline": deadline,}
+            self.sockets[i].send_string(json.dumps(request_data))
+            self.outstanding[i] += 1
+            in_flight[request_id] = (start, i, tried)
+
+        while True:
+            while len(in_flight) < max_in_flight:
+                start = next(starts, None)
+                if start is None:
+                    break
+                send(start)
+            if not in_flight:
+                return
+            timeout = max(0, int((deadline - time.time()) * 1000)) if deadline is not None else None
+            events = dict(self.poller.poll(timeout))
+            if not events:
+                for _, i, _ in in_flight.values():
+                    self.sockets[i].setsockopt(zmq.LINGER, 0)  # do not block terminate() on the unanswered requests
+                    if len(self.endpoints) > 1:
+                        HEALTH.mark_down(self.endpoints[i])
+                raise TimeoutError(f"{len(in_flight)} embedding requests not answered within {timeout_ms} ms")
+            for socket in events:
+                frames = socket.recv_multipart()
+                request_id = frames[0].decode("utf-8")
+                if len(frames) != 2 or request_id not in in_flight:
+                    continue  # late reply of an abandoned stream or health check
+                start, i, tried = in_flight.pop(request_id)
+                self.outstanding[i] -= 1
+                try:
+                    result = parse_result(frames[1])
+                except EmbeddingServerError as e:
+                    if str(e) == "overloaded" and not tried and len(self.endpoints) > 1:
+                        send(start, tried + (i,))
+                        continue
+                    raise
+                yield start, result
+
+    def metrics(self, timeout_ms: int = 200) -> Optional[str]:
+        """
+        Fetch the Prometheus text metrics of the server, None if the server does not answer within timeout_ms.
+        """
+        while self.socket.poll(0):
+            self.receive()  # late reply of an earlier call that timed out
+        self.send(json.dumps({"type": "metrics"}))
+        if not self.socket.poll(timeout_ms):
+            self.socket.setsockopt(zmq.LINGER, 0)  # do not block terminate() on the unanswered request
+            return None
+        return self.receive().decode("utf-8")
+
     def terminate(self):
-        self.socket.close()
+        for socket in self.sockets:
+            socket.close()
         self.zmq_context.term()
 
     def send(self, data):
@@ -52,3 +229,64 @@ class EmbeddingClient(object):
         Receive and return data through provided socket.
         """
         return self.socket.recv()
+
+
+class AsyncEmbeddingClient(object):
+    """
+    asyncio client, many encode calls can be in flight at once.
+    each in-flight request uses its own DEALER socket from a small pool, so replies never need to be matched to requests.
+    each encode call goes to the healthy replica with the fewest outstanding calls.
+    """
+
+    def __init__(self, host, embedding_type, max_sockets: int = 64, endpoints: Optional[List[str]] = None):
+        self.zmq_context = zmq.asyncio.Context()
+        self.endpoints = endpoints or get_endpoints(embedding_type, host)
+        self.idle_sockets: List[List[zmq.asyncio.Socket]] = [[] for _ in self.endpoints]
+        self.outstanding = [0] * len(self.endpoints)
+        self.slots = asyncio.Semaphore(max_sockets)
+
+    def _checkout(self, i: int) -> zmq.asyncio.Socket:
+        if self.idle_sockets[i]:
+            return self.idle_sockets[i].pop()
+        socket = self.zmq_context.socket(zmq.DEALER)
+        socket.connect(f"tcp://{self.endpoints[i]}")
+        return socket
+
+    async def encode(self, texts: List[str], pooling: Optional[str] = "mean", batch_size: int = 256, timeout_ms: Optional[float] = None) -> np.array:
+        """
+        same errors as EmbeddingClient.encode (TimeoutError past timeout_ms, EmbeddingServerError on rejection)
+        """
+        if not isinstance(texts, list):
+            raise ValueError("Argument `texts` should be either List[str] or List[List[str]]")
+        deadline = time.time() + timeout_ms / 1000 if timeout_ms is not None else None
+        async with self.slots:
+            i = pick_endpoint(self.endpoints, self.outstanding)
+            socket = self._checkout(i)
+            self.outstanding[i] += 1
+            try:
+                embeddings = []
+                for start in range(0, len(texts), batch_size):
+                    request_data = {"type": "encode", "texts": texts[start : start + batch_size], "pooling": pooling, "sent_at": time.time(),
+                                    "deadline": deadline,}
+                    await socket.send_string(json.dumps(request_data))
+                    if deadline is None:
+                        result = await socket.recv()
+                    else:
+                        result = await asyncio.wait_for(socket.recv(), max(0.0, deadline - time.time()))
+                    embeddings.append(parse_result(result))
+            except BaseException as e:
+                # a cancelled request may still get its reply later, never reuse that socket
+                socket.close(linger=0)
+                if isinstance(e, asyncio.TimeoutError) and len(self.endpoints) > 1:
+                    HEALTH.mark_down(self.endpoints[i])
+                raise
+            finally:
+                self.outstanding[i] -= 1
+            self.idle_sockets[i].append(socket)
+        return np.vstack(embeddings)
+
+    def terminate(self):
+        for sockets in self.idle_sockets:
+            for socket in sockets:
+                socket.close()
+        self.zmq_context.term()
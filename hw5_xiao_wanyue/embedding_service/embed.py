@@ -5,7 +5,6 @@ it will be called by the client
 from typing import List, Any
 from tqdm import tqdm
 import numpy as np
-from sentence_transformers import SentenceTransformer
 from embedding_service.text_processing import TextProcessing
 
 
@@ -19,6 +18,9 @@ class SBERTEmbedding:
         self.load(model_name)
 
     def load(self, model_name: str) -> None:
+        # imported here so that the fastText, ONNX and in-process encoders load without sentence_transformers (and torch)
+        from sentence_transformers import SentenceTransformer  # type: ignore
+
         try:
             self.model = SentenceTransformer(model_name)
             print("Model loaded Successfully !")
@@ -95,19 +97,25 @@ class FastTextEmbedding:
 
 
 class Encoder:
-    def __init__(self, embedding: str, model: str) -> None:
+    def __init__(self, embedding: str, model: str, backend: str = "torch") -> None:
         """
         encoder wrapper for both type of embedding
         :param embedding: embedding types
         :param model: model name /path
+        :param backend: inference backend of sbert, "torch" (eager SentenceTransformer), "onnx" or "onnx-int8"
+                        (exported graph, see embedding_service.onnx_embedding)
         """
         self.embedding = embedding
         self.model = model
+        self.backend = backend
         self.embedding_model = None
         self._load()
 
     def _load(self) -> None:
-        if self.embedding == "sbert":
+        if self.embedding == "sbert" and self.backend in ("onnx", "onnx-int8"):
+            from embedding_service.onnx_embedding import ONNXSBERTEmbedding
+            self.embedding_model = ONNXSBERTEmbedding(self.model, quantized=self.backend == "onnx-int8")
+        elif self.embedding == "sbert":
             self.embedding_model = SBERTEmbedding(self.model)
         elif self.embedding == "fasttext":
             self.embedding_model = FastTextEmbedding(self.model)
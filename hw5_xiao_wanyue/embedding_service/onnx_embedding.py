@@ -0,0 +1,179 @@
+"""
+ONNX Runtime backend for the sentence BERT embeddings
+the transformer of a SentenceTransformer model is exported once to an ONNX graph (optionally with dynamic int8 quantization
+of the weights) and cached on disk with its tokenizer and pooling settings, later loads only need onnxruntime and the tokenizer.
+selected with Encoder(embedding="sbert", model=..., backend="onnx" or "onnx-int8")
+
+parity and speed check against the eager PyTorch model:
+python -m embedding_service.onnx_embedding --model msmarco-distilbert-base-v3 --wapo_path pa5_data/wapo_test.jl
+"""
+from typing import Any, Dict, List, Tuple
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+ONNX_CACHE_DIR = "onnx_models"
+
+
+def artifact_dir(model_name: str, cache_dir: str = ONNX_CACHE_DIR) -> str:
+    return os.path.join(cache_dir, model_name.strip("/").replace("/", "__"))
+
+
+def export_model(model_name: str, cache_dir: str = ONNX_CACHE_DIR, quantize: bool = True, opset: int = 13) -> str:
+    """
+    export the transformer of a SentenceTransformer model to ONNX, reuses the cached artifact if it already exists
+    :param model_name: pretrained model name or path, as given to SentenceTransformer
+    :param quantize: also write a copy with int8 weights (dynamic quantization of the MatMul/Gemm nodes)
+    :return: the directory of the artifact
+    """
+    out_dir = artifact_dir(model_name, cache_dir)
+    fp32_path = os.path.join(out_dir, "model.onnx")
+    int8_path = os.path.join(out_dir, "model-int8.onnx")
+    if os.path.exists(fp32_path) and (not quantize or os.path.exists(int8_path)):
+        return out_dir
+
+    if not os.path.exists(fp32_path):
+        import torch  # type: ignore
+        from sentence_transformers import SentenceTransformer  # type: ignore
+
+        st = SentenceTransformer(model_name, device="cpu")
+        transformer, pooling = st[0], st[1]
+        os.makedirs(out_dir, exist_ok=True)
+        transformer.tokenizer.save_pretrained(os.path.join(out_dir, "tokenizer"))
+        config = {
+            "max_seq_length": st.max_seq_length,
+            "pooling": "cls" if pooling.pooling_mode_cls_token else "max" if pooling.pooling_mode_max_tokens else "mean",
+            "normalize": any(type(module).__name__ == "Normalize" for module in st),
+        }
+        with open(os.path.join(out_dir, "config.json"), "w") as f:
+            json.dump(config, f, indent=2)
+
+        model = transformer.auto_model.eval()
+        dummy = transformer.tokenizer(["export the model"], return_tensors="pt")
+        with torch.no_grad():
+            torch.onnx.export(model, (dummy["input_ids"], dummy["attention_mask"]), fp32_path,
+                              input_names=["input_ids", "attention_mask"], output_names=["last_hidden_state"],
+                              dynamic_axes={"input_ids": {0: "batch", 1: "sequence"}, "attention_mask": {0: "batch", 1: "sequence"},
+                                            "last_hidden_state": {0: "batch", 1: "sequence"}},
+                              opset_version=opset, do_constant_folding=True)
+        print("Exported", model_name, "to", fp32_path)
+
+    if quantize and not os.path.exists(int8_path):
+        from onnxruntime.quantization import QuantType, quantize_dynamic  # type: ignore
+
+        quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8)
+        print("Quantized", fp32_path, "to", int8_path)
+    return out_dir
+
+
+class ONNXSBERTEmbedding:
+    def __init__(self, model_name: str, quantized: bool = True, cache_dir: str = ONNX_CACHE_DIR, num_threads: int = 0,
+                 batch_size: int = 32) -> None:
+        """
+        same interface as embed.SBERTEmbedding
+        :param model_name: pretrained model name or path, exported on first use
+        :param quantized: run the int8 graph instead of the fp32 one
+        :param num_threads: intra-op threads of onnxruntime, 0 lets onnxruntime decide
+        :param batch_size: texts per forward pass, the texts are sorted by length so each batch has little padding
+        """
+        import onnxruntime  # type: ignore
+        from transformers import AutoTokenizer  # type: ignore
+
+        out_dir = export_model(model_name, cache_dir, quantize=quantized)
+        with open(os.path.join(out_dir, "config.json")) as f:
+            self.config: Dict[str, Any] = json.load(f)
+        self.tokenizer = AutoTokenizer.from_pretrained(os.path.join(out_dir, "tokenizer"))
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = num_threads
+        path = os.path.join(out_dir, "model-int8.onnx" if quantized else "model.onnx")
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.batch_size = batch_size
+        print("Model loaded Successfully !", path)
+
+    def _pool(self, hidden: np.ndarray, mask: np.ndarray) -> np.ndarray:
+        if self.config["pooling"] == "cls":
+            pooled = hidden[:, 0]
+        elif self.config["pooling"] == "max":
+            pooled = np.where(mask[:, :, None] > 0, hidden, -1e9).max(axis=1)
+        else:
+            weights = mask[:, :, None].astype(hidden.dtype)
+            pooled = (hidden * weights).sum(axis=1) / np.clip(weights.sum(axis=1), 1e-9, None)
+        if self.config["normalize"]:
+            pooled = pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+        return pooled
+
+    def _forward(self, texts: List[str]) -> np.ndarray:
+        tokens = self.tokenizer(texts, padding=True, truncation=True, max_length=self.config["max_seq_length"], return_tensors="np")
+        hidden = self.session.run(["last_hidden_state"], {"input_ids": tokens["input_ids"].astype(np.int64),
+                                                          "attention_mask": tokens["attention_mask"].astype(np.int64)})[0]
+        return self._pool(hidden, tokens["attention_mask"])
+
+    def encode(self, texts: List[str], pooling: Any = None) -> np.array:
+        """
+        :param pooling: placeholder, the pooling of the exported model is used
+        """
+        order = np.argsort([len(text) for text in texts], kind="stable")
+        embeddings = np.empty((len(texts), 0), dtype=np.float32)
+        for start in range(0, len(texts), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            vectors = self._forward([texts[i] for i in batch])
+            if embeddings.shape[1] == 0:
+                embeddings = np.empty((len(texts), vectors.shape[1]), dtype=np.float32)
+            embeddings[batch] = vectors
+        return embeddings
+
+
+def _timed_encode(model: Any, texts: List[str], batch_size: int) -> Tuple[np.ndarray, float]:
+    start = time.perf_counter()
+    vectors = np.vstack([model.encode(texts[i:i + batch_size]) for i in range(0, len(texts), batch_size)])
+    return vectors, time.perf_counter() - start
+
+
+def _parity_check(model_name: str, texts: List[str], batch_size: int, num_threads: int) -> None:
+    """
+    cosine agreement of the exported backends with the eager model, and their latency and throughput
+    """
+    from embedding_service.embed import SBERTEmbedding
+
+    eager = SBERTEmbedding(model_name)
+    reference, eager_seconds = _timed_encode(eager, texts, batch_size)
+    _, eager_single = _timed_encode(eager, texts[:50], 1)
+    print(f"{'backend':10s} {'mean cos':>9s} {'min cos':>9s} {'docs/s':>9s} {'ms/query':>9s}")
+    print(f"{'torch':10s} {1.0:9.4f} {1.0:9.4f} {len(texts) / eager_seconds:9.1f} {eager_single / 50 * 1000:9.2f}")
+    for name, quantized in (("onnx", False), ("onnx-int8", True)):
+        model = ONNXSBERTEmbedding(model_name, quantized=quantized, num_threads=num_threads)
+        vectors, seconds = _timed_encode(model, texts, batch_size)
+        _, single = _timed_encode(model, texts[:50], 1)
+        cos = (vectors * reference).sum(axis=1) / (np.linalg.norm(vectors, axis=1) * np.linalg.norm(reference, axis=1))
+        print(f"{name:10s} {cos.mean():9.4f} {cos.min():9.4f} {len(texts) / seconds:9.1f} {single / 50 * 1000:9.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="export SBERT to ONNX and compare it with the PyTorch model")
+    parser.add_argument("--model", required=False, type=str, default="msmarco-distilbert-base-v3", help="name/path of the SBERT model")
+    parser.add_argument("--wapo_path", required=False, type=str, default="pa5_data/wapo_test.jl", help="documents used for the comparison")
+    parser.add_argument("--n_docs", required=False, type=int, default=500, help="number of documents used for the comparison")
+    parser.add_argument("--batch_size", required=False, type=int, default=32, help="texts per encode call")
+    parser.add_argument("--num_threads", required=False, type=int, default=0, help="intra-op threads of onnxruntime")
+    parser.add_argument("--export_only", action='store_true', help="only export and quantize the model")
+    args = parser.parse_args()
+
+    export_model(args.model, quantize=True)
+    if args.export_only:
+        return
+    texts = []
+    with open(args.wapo_path, "r", encoding="utf-8") as f:
+        for line in f:
+            doc = json.loads(line)
+            texts.append(doc["title"] + " " + doc["content_str"][:1000])
+            if len(texts) == args.n_docs:
+                break
+    _parity_check(args.model, texts, args.batch_size, args.num_threads)
+
+
+if __name__ == "__main__":
+    main()
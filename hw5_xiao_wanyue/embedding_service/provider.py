@@ -0,0 +1,185 @@
+"""
+query encoders behind one interface, passed to evaluate.get_response (or set with evaluate.use_encoder)
+"zmq" sends the texts to the embedding servers with EmbeddingClient. "inprocess" holds the models
+(embedding_service.embed.Encoder) in the calling process, which skips the JSON serialization, the ZMQ hop and the queue of
+the server workers, for deployments where the search and the model run on the same host.
+
+per query latency of both providers:
+python -m embedding_service.provider --embedding sbert --providers zmq inprocess
+"""
+from typing import Dict, List, Optional
+import argparse
+import os
+import threading
+import time
+
+import numpy as np
+
+from instrumentation import REGISTRY
+
+ENCODE_LATENCY = REGISTRY.histogram("query_encoding_seconds", "time to encode the queries of a search", ["provider", "embedding"])
+# models loaded by the in-process provider, the ones the servers are started with in the README
+DEFAULT_MODELS = {"sbert": "msmarco-distilbert-base-v3", "fasttext": "pa5_data/wiki-news-300d-1M-subword.vec"}
+
+
+def model_of(embedding_type: str) -> str:
+    """
+    model of an embedding type, read from $EMBEDDING_MODEL_<TYPE> (e.g. EMBEDDING_MODEL_SBERT=all-MiniLM-L6-v2), by default DEFAULT_MODELS
+    """
+    model = os.environ.get(f"EMBEDDING_MODEL_{embedding_type.upper()}", DEFAULT_MODELS.get(embedding_type))
+    if model is None:
+        raise ValueError(f"no model for {embedding_type}, set EMBEDDING_MODEL_{embedding_type.upper()}")
+    return model
+
+
+class EncoderProvider(object):
+    name = ""
+
+    def encode(self, embedding_type: str, texts: List[str], pooling: str = "mean", timeout_ms: Optional[float] = None) -> np.ndarray:
+        """
+        :param embedding_type: "sbert", "fasttext", ... as in embedding_service.INV_PORT_EMBEDDING_MAPPING
+        :return: (texts x dim) embeddings
+        """
+        st = time.perf_counter()
+        embeddings = self._encode(embedding_type, texts, pooling, timeout_ms)
+        ENCODE_LATENCY.observe(time.perf_counter() - st, provider=self.name, embedding=embedding_type)
+        return embeddings
+
+    def _encode(self, embedding_type: str, texts: List[str], pooling: str, timeout_ms: Optional[float]) -> np.ndarray:
+        raise NotImplementedError
+
+    def tag(self) -> str:
+        """
+        short name of the settings that change the embeddings, e.g. in the key of a cached run
+        """
+        return self.name
+
+    def close(self) -> None:
+        pass
+
+
+class ZMQEncoderProvider(EncoderProvider):
+    name = "zmq"
+
+    def __init__(self, host: str = "localhost"):
+        self.host = host
+        # a ZMQ socket must not be used by several threads, each thread gets its own client of each embedding type
+        self.local = threading.local()
+        self.clients = []
+        self.lock = threading.Lock()
+
+    def client(self, embedding_type: str) -> "EmbeddingClient":
+        from embedding_service.client import EmbeddingClient
+
+        clients = self.local.__dict__.setdefault("clients", {})
+        if embedding_type not in clients:
+            clients[embedding_type] = EmbeddingClient(host=self.host, embedding_type=embedding_type)
+            with self.lock:
+                self.clients.append(clients[embedding_type])
+        return clients[embedding_type]
+
+    def _encode(self, embedding_type: str, texts: List[str], pooling: str, timeout_ms: Optional[float]) -> np.ndarray:
+        return self.client(embedding_type).encode(texts, pooling=pooling, timeout_ms=timeout_ms)
+
+    def close(self) -> None:
+        with self.lock:
+            for client in self.clients:
+                client.terminate()
+            self.clients = []
+        self.local = threading.local()
+
+
+class InProcessEncoderProvider(EncoderProvider):
+    name = "inprocess"
+
+    def __init__(self, backend: str = "torch", models: Optional[Dict[str, str]] = None):
+        """
+        :param backend: inference backend of sbert, as the --backend of the server
+        :param models: model of each embedding type, default model_of
+        """
+        self.backend = backend
+        self.models = models or {}
+        self.encoders = {}
+        self.lock = threading.Lock()
+
+    def encoder(self, embedding_type: str) -> "Encoder":
+        """
+        the model of an embedding type, loaded on its first query and then shared by all the threads
+        """
+        encoder = self.encoders.get(embedding_type)
+        if encoder is None:
+            with self.lock:
+                if embedding_type not in self.encoders:
+                    from embedding_service.embed import Encoder
+
+                    self.encoders[embedding_type] = Encoder(embedding_type, self.models.get(embedding_type) or model_of(embedding_type),
+                                                            self.backend)
+                encoder = self.encoders[embedding_type]
+        return encoder
+
+    def tag(self) -> str:
+        return f"{self.name}-{self.backend}"  # the quantized backends give slightly different embeddings
+
+    def _encode(self, embedding_type: str, texts: List[str], pooling: str, timeout_ms: Optional[float]) -> np.ndarray:
+        # timeout_ms is only there for the same signature: nothing waits on another process, the time is spent computing
+        return self.encoder(embedding_type).encode(texts, pooling=pooling)
+
+
+PROVIDERS = {ZMQEncoderProvider.name: ZMQEncoderProvider, InProcessEncoderProvider.name: InProcessEncoderProvider}
+
+
+def make_provider(name: str, **kwargs) -> EncoderProvider:
+    if name not in PROVIDERS:
+        raise ValueError(f"unknown encoder provider {name}, choose from {', '.join(PROVIDERS)}")
+    return PROVIDERS[name](**kwargs)
+
+
+def compare_latency(providers: List[EncoderProvider], embedding_type: str, queries: List[str], repeat: int = 5) -> List[Dict]:
+    """
+    encode each query alone, as a search does, with every provider
+    the first call of each provider (model loading, connection) is made before the timing
+    :return: per query, the median latency in ms of each provider and the largest difference between their embeddings
+    """
+    for provider in providers:
+        provider.encode(embedding_type, queries[:1])
+    rows = []
+    for query in queries:
+        row = {"query": query}
+        embeddings = []
+        for provider in providers:
+            timings = []
+            for _ in range(repeat):
+                st = time.perf_counter()
+                embedding = provider.encode(embedding_type, [query])
+                timings.append(time.perf_counter() - st)
+            row[f"{provider.name}_ms"] = float(np.median(timings)) * 1000
+            embeddings.append(embedding)
+        row["max_diff"] = float(max(np.abs(embedding - embeddings[0]).max() for embedding in embeddings))
+        rows.append(row)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="compare the query encoding latency of the encoder providers")
+    parser.add_argument("--embedding", required=False, type=str, default="sbert", help="embedding type")
+    parser.add_argument("--providers", required=False, type=str, nargs="+", default=list(PROVIDERS), choices=list(PROVIDERS), help="providers compared")
+    parser.add_argument("--backend", required=False, type=str, default="torch", choices=["torch", "onnx", "onnx-int8"], help="inference backend of the in-process sbert")
+    parser.add_argument("--repeat", required=False, type=int, default=5, help="encodings of each query, the median is reported")
+    args = parser.parse_args()
+
+    from utils import load_topic_queries
+    queries = [query[query_type] for query in load_topic_queries("pa5_data/pa5_queries.json").values() for query_type in ("kw", "nl")]
+    providers = [make_provider(name, backend=args.backend) if name == InProcessEncoderProvider.name else make_provider(name)
+                 for name in args.providers]
+    rows = compare_latency(providers, args.embedding, queries, args.repeat)
+    columns = [f"{provider.name}_ms" for provider in providers]
+    print("\t".join(columns + ["max_diff", "query"]))
+    for row in rows:
+        print("\t".join([f"{row[column]:.2f}" for column in columns] + [f"{row['max_diff']:.2e}", row["query"]]))
+    print("\t".join([f"{np.mean([row[column] for row in rows]):.2f}" for column in columns] + ["", "mean"]))
+    for provider in providers:
+        provider.close()
+
+
+if __name__ == "__main__":
+    main()
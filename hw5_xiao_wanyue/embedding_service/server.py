@@ -5,15 +5,19 @@ embedding server
 adapted from https://github.com/amansrivastava17/embedding-as-service
 """
 from typing import Union, List, Optional
+import multiprocessing
 import threading
 import argparse
 import zmq
 import json
 import sys
+import time
 import logging
 
 from embedding_service.embed import Encoder
 from embedding_service import INV_PORT_EMBEDDING_MAPPING
+from instrumentation import REGISTRY
+
 
 logger = logging.getLogger(__name__)
 handler = logging.StreamHandler(stream=sys.stdout)
@@ -22,12 +26,46 @@ logger.addHandler(handler)
 logger.setLevel(logging.INFO)
 
 
+class ServerMetrics(object):
+    """
+    metrics of one server, the names are prefixed by the server name so that the metrics of several servers can be exposed together
+    """
+
+    def __init__(self, name: str):
+        prefix = f"embedding_{name}"
+        # queue wait is measured against the client's send timestamp, so it is only meaningful when client and server clocks agree
+        self.queue_wait = REGISTRY.histogram(f"{prefix}_queue_wait_seconds", "time between the client sending a request and a worker picking it up")
+        self.compute = REGISTRY.histogram(f"{prefix}_compute_seconds", "time spent computing a request")
+        self.requests = REGISTRY.counter(f"{prefix}_requests_total", "number of requests handled", ["type"])
+        self.texts = REGISTRY.counter(f"{prefix}_texts_total", "number of texts computed")
+        self.queue_depth = REGISTRY.gauge(f"{prefix}_queue_depth", "requests admitted and not answered yet (queued or computing)")
+        self.dropped = REGISTRY.counter(f"{prefix}_dropped_total", "requests answered with an error instead of a result", ["reason"])
+
+
+def error_reply(frames: List[bytes], request: dict, error: str) -> List[bytes]:
+    """
+    reply frames answering a request with {"error": ...} instead of a result, frames[0] is the client socket ID
+    """
+    reply = [frames[0]]
+    if "id" in request:
+        reply.append(str(request["id"]).encode("utf-8"))
+    reply.append(json.dumps({"error": error}).encode("utf-8"))
+    return reply
+
+
 class Server(object):
-    def __init__(self, embedding, model, port, num_workers=4):
+    # admission control, class attributes so that the subclasses (NER, load test stub) get the defaults too
+    max_queue = 64  # requests waiting for a worker on top of the ones being computed, more are rejected as overloaded
+    hwm = 1000  # high-water mark of the client facing socket, messages beyond it are dropped by zmq
+
+    def __init__(self, embedding, model, port, num_workers=4, backend="torch", max_queue=64, hwm=1000):
         self.zmq_context = zmq.Context()
         self.port = port
         self.num_workers = num_workers
-        self.encoder = Encoder(embedding=embedding, model=model)
+        self.max_queue = max_queue
+        self.hwm = hwm
+        self.encoder = Encoder(embedding=embedding, model=model, backend=backend)
+        self.metrics = ServerMetrics(embedding)
 
     def start(self):
         """
@@ -38,25 +76,58 @@ class Server(object):
 
         # Front facing socket to accept client connections.
         socket_front = self.zmq_context.socket(zmq.ROUTER)
+        socket_front.setsockopt(zmq.RCVHWM, self.hwm)
+        socket_front.setsockopt(zmq.SNDHWM, self.hwm)
         socket_front.bind(f"tcp://0.0.0.0:{self.port}")
 
         # Backend socket to distribute work.
         socket_back = self.zmq_context.socket(zmq.DEALER)
+        socket_back.setsockopt(zmq.SNDHWM, self.num_workers + self.max_queue)
         socket_back.bind("inproc://backend")
 
         # Start workers.
         for i in range(0, self.num_workers):
-            worker = Worker(self.zmq_context, self.encoder, i)
+            worker = self.make_worker(i)
             worker.start()
             logger.info(f"[WORKER-{i}]: ready and listening!")
 
-        # Use built in queue device to distribute requests among workers.
-        # What queue device does internally is,
-        #   1. Read a client's socket ID and request.
-        #   2. Send socket ID and request to a worker.
-        #   3. Read a client's socket ID and result from a worker.
-        #   4. Route result back to the client using socket ID.
-        zmq.device(zmq.QUEUE, socket_front, socket_back)
+        self.proxy(socket_front, socket_back)
+
+    def proxy(self, socket_front, socket_back):
+        """
+        Distribute requests among workers like the built in queue device, with admission control.
+        What the loop does is,
+          1. Read a client's socket ID and request.
+          2. If num_workers + max_queue requests are already admitted, answer {"error": "overloaded"} right away,
+             otherwise send socket ID and request to a worker.
+          3. Read a client's socket ID and result from a worker.
+          4. Route result back to the client using socket ID.
+        """
+        poller = zmq.Poller()
+        poller.register(socket_front, zmq.POLLIN)
+        poller.register(socket_back, zmq.POLLIN)
+        capacity = self.num_workers + self.max_queue
+        pending = 0
+        while True:
+            events = dict(poller.poll())
+            if socket_back in events:
+                socket_front.send_multipart(socket_back.recv_multipart())
+                pending -= 1
+            if socket_front in events:
+                frames = socket_front.recv_multipart()
+                if pending >= capacity:
+                    # only parsed when overloaded, the metrics of an overloaded server are still served
+                    request = json.loads(frames[-1].decode("utf-8"))
+                    if request.get("type") != "metrics":
+                        self.metrics.dropped.inc(reason="overloaded")
+                        socket_front.send_multipart(error_reply(frames, request, "overloaded"))
+                        continue
+                socket_back.send_multipart(frames)
+                pending += 1
+            self.metrics.queue_depth.set(pending)
+
+    def make_worker(self, _id):
+        return Worker(self.zmq_context, self.encoder, _id, self.metrics)
 
 
 class Worker(threading.Thread):
@@ -65,11 +136,12 @@ class Worker(threading.Thread):
     Does computations and return results back to server.
     """
 
-    def __init__(self, zmq_context, encoder, _id):
+    def __init__(self, zmq_context, encoder, _id, metrics):
         threading.Thread.__init__(self)
         self.zmq_context = zmq_context
         self.worker_id = _id
         self.encoder = encoder
+        self.metrics = metrics
 
     def run(self):
         """
@@ -83,21 +155,48 @@ class Worker(threading.Thread):
         while True:
             # First string recieved is socket ID of client
             client_id = socket.recv()
-            request = socket.recv()
+            request = json.loads(socket.recv().decode("utf-8"))
             # print('Worker ID - %s. Recieved computation request.' % (self.worker_id))
-            result = self.compute(request)
+            if request.get("deadline") is not None and time.time() > request["deadline"]:
+                # the client has given up on this request, do not spend a worker on it
+                self.metrics.dropped.inc(reason="deadline")
+                socket.send_multipart(error_reply([client_id], request, "deadline exceeded"))
+                continue
+            try:
+                result = self.compute(request)
+            except Exception as e:
+                # answer the request so that the client and the admission count of the frontend are not left waiting
+                logger.exception(f"[WORKER-{self.worker_id}]: request failed")
+                self.metrics.dropped.inc(reason="error")
+                socket.send_multipart(error_reply([client_id], request, f"{type(e).__name__}: {e}"))
+                continue
 
             # print('Worker ID - %s. Sending computed result back.' % (self.worker_id))
             # For successful routing of result to correct client, the socket ID of client should be sent first.
             socket.send(client_id, zmq.SNDMORE)
-            socket.send_string(result)
+            if "id" in request:
+                # pipelined clients have several requests in flight and match the replies by the id echoed before the result
+                socket.send_string(str(request["id"]), zmq.SNDMORE)
+            socket.send_string(result if result is not None else "null")
 
     def compute(self, request):
         """Computation takes place here. Adds the two numbers which are in the request and return result."""
-        request = json.loads(request.decode("utf-8"))
+        received_at = time.time()
         _type = request.get("type")
+        self.metrics.requests.inc(type=str(_type))
         if _type == "encode":
-            return self.encode(request)
+            if "sent_at" in request:
+                self.metrics.queue_wait.observe(max(0.0, received_at - request["sent_at"]))
+            st = time.perf_counter()
+            result = self.encode(request)
+            self.metrics.compute.observe(time.perf_counter() - st)
+            self.metrics.texts.inc(len(request["texts"]))
+            return result
+        if _type == "metrics":
+            # only the metrics of the server, the instrumentation ones are exposed by the app that scrapes them too
+            return REGISTRY.render(prefix="embedding_")
+        if _type == "ping":
+            return "pong"
         return
 
     def encode(self, data):
@@ -110,14 +209,37 @@ class Worker(threading.Thread):
         return json.dumps(embedding.tolist())
 
 
+def run_server(args: argparse.Namespace, port: int) -> None:
+    server = Server(embedding=args.embedding, model=args.model, port=port, num_workers=args.num_workers, backend=args.backend,
+                    max_queue=args.max_queue, hwm=args.hwm)
+    server.start()
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--embedding", required=True, type=str, help="name of the embedding type")
     parser.add_argument("--model", required=True, type=str, help="name/path of the embedding model")
     parser.add_argument("--num_workers", required=False, type=int, default=4, help="number of workers on the server")
+    parser.add_argument("--backend", required=False, type=str, default="torch", choices=["torch", "onnx", "onnx-int8"], help="inference backend of sbert")
+    parser.add_argument("--max_queue", required=False, type=int, default=64, help="requests waiting for a worker before new ones are rejected")
+    parser.add_argument("--hwm", required=False, type=int, default=1000, help="high-water mark of the client facing socket")
+    parser.add_argument("--replicas", required=False, type=int, default=1, help="number of server processes, on consecutive ports")
+    parser.add_argument("--port", required=False, type=int, default=None, help="port of the first replica, default the port of the embedding")
     args = parser.parse_args()
-    server = Server(embedding=args.embedding, model=args.model, port=INV_PORT_EMBEDDING_MAPPING[args.embedding], num_workers=args.num_workers)
-    server.start()
+    port = args.port or INV_PORT_EMBEDDING_MAPPING[args.embedding]
+    if args.replicas == 1:
+        run_server(args, port)
+        return
+
+    # each replica loads its own model in its own process
+    endpoints = [f"localhost:{port + i}" for i in range(args.replicas)]
+    logger.info(f"Starting {args.replicas} replicas, point the clients at them with "
+                f"EMBEDDING_ENDPOINTS_{args.embedding.upper()}={','.join(endpoints)}")
+    replicas = [multiprocessing.Process(target=run_server, args=(args, port + i), name=f"{args.embedding}-{port + i}") for i in range(args.replicas)]
+    for replica in replicas:
+        replica.start()
+    for replica in replicas:
+        replica.join()
 
 
 if __name__ == "__main__":
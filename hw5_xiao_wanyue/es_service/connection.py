@@ -0,0 +1,168 @@
+"""
+the Elasticsearch connection shared by every entry point (hw5.py, serve.py, evaluate.py, compare_modes.py, load_es_index.py)
+the settings come from the command line (add_arguments / config_from_args) or, for an app imported by a WSGI server, from
+the ES_HOSTS, ES_MAXSIZE, ES_TIMEOUT, ES_HTTP_COMPRESS and ES_SNIFF environment variables
+elasticsearch is only imported when a connection is created, hw5.py imports this module at startup for its arguments
+"""
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+import argparse
+import os
+
+from instrumentation import REGISTRY
+
+POOL_STATS = REGISTRY.gauge("es_connection_pool", "connections of the ES connection pool of each node", ["alias", "host", "stat"])
+OPERATIONS = ("search", "get", "bulk", "admin")
+
+
+class ESConfig(NamedTuple):
+    """
+    hosts: ES nodes, "host" or "host:port"
+    maxsize: connections kept open per node, should be the number of threads sending requests concurrently
+    timeout: default request timeout in seconds, the *_timeout fields override it per operation
+    http_compress: gzip the request bodies, worth it for bulk loads over a network
+    sniff: discover the other nodes of the cluster on start and when a node fails
+    max_retries, retry_on_timeout: requests re-sent to another node after a failure (and after a timeout), each retry gets
+                                   the full request timeout again
+    """
+    hosts: Tuple[str, ...] = ("localhost",)
+    maxsize: int = 10
+    timeout: float = 30.0
+    http_compress: bool = False
+    sniff: bool = False
+    max_retries: int = 3
+    retry_on_timeout: bool = True
+    search_timeout: float = 30.0
+    get_timeout: float = 5.0
+    bulk_timeout: float = 300.0
+    admin_timeout: float = 30.0
+
+    def client_kwargs(self) -> Dict[str, Any]:
+        kwargs = {"hosts": list(self.hosts), "maxsize": self.maxsize, "timeout": self.timeout, "http_compress": self.http_compress,
+                  "max_retries": self.max_retries, "retry_on_timeout": self.retry_on_timeout}
+        if self.sniff:
+            kwargs.update(sniff_on_start=True, sniff_on_connection_fail=True, sniffer_timeout=60)
+        return kwargs
+
+    def request_timeout(self, operation: str) -> float:
+        return getattr(self, f"{operation}_timeout")
+
+    def no_retry(self) -> "ESConfig":
+        """
+        settings of the client of the searches with a latency budget, a retry would outlive the budget
+        """
+        return self._replace(max_retries=0, retry_on_timeout=False)
+
+
+def default_config() -> ESConfig:
+    config = ESConfig()
+    return config._replace(hosts=tuple(os.environ.get("ES_HOSTS", ",".join(config.hosts)).split(",")),
+                           maxsize=int(os.environ.get("ES_MAXSIZE", config.maxsize)),
+                           timeout=float(os.environ.get("ES_TIMEOUT", config.timeout)),
+                           http_compress=os.environ.get("ES_HTTP_COMPRESS", "0") == "1",
+                           sniff=os.environ.get("ES_SNIFF", "0") == "1")
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--es_hosts", required=False, type=str, nargs="+", default=None, help="ES hosts, default $ES_HOSTS or localhost")
+    parser.add_argument("--es_maxsize", required=False, type=int, default=None, help="ES connections per node, match it to the request threads")
+    parser.add_argument("--es_timeout", required=False, type=float, default=None, help="default ES request timeout in seconds")
+    parser.add_argument("--es_search_timeout", required=False, type=float, default=None, help="ES search request timeout in seconds")
+    parser.add_argument("--es_compress", action='store_true', help="gzip the ES request bodies")
+    parser.add_argument("--es_sniff", action='store_true', help="discover the ES cluster nodes on start and on failure")
+
+
+def config_from_args(args: argparse.Namespace) -> ESConfig:
+    """
+    the command line settings of add_arguments over the default config, unset flags keep the default
+    """
+    config = default_config()
+    overrides = {"hosts": tuple(args.es_hosts) if args.es_hosts else None, "maxsize": args.es_maxsize, "timeout": args.es_timeout,
+                 "search_timeout": args.es_search_timeout, "http_compress": args.es_compress or None, "sniff": args.es_sniff or None}
+    return config._replace(**{field: value for field, value in overrides.items() if value is not None})
+
+
+_configs: Dict[str, ESConfig] = {}
+
+
+def connect(config: Optional[ESConfig] = None, alias: str = "default") -> "Elasticsearch":
+    """
+    create the connection of alias (used by elasticsearch_dsl with using=alias), or reuse it if it has the same config
+    """
+    from elasticsearch_dsl.connections import connections  # type: ignore
+
+    config = config or default_config()
+    if _configs.get(alias) != config:
+        connections.create_connection(alias=alias, **config.client_kwargs())
+        _configs[alias] = config
+    return connections.get_connection(alias)
+
+
+def disconnect_all() -> None:
+    """
+    close the connections created by connect, e.g. in a process about to fork (the children must not share its sockets)
+    """
+    from elasticsearch_dsl.connections import connections  # type: ignore
+
+    for alias in list(_configs):
+        connections.get_connection(alias).transport.close()
+        connections.remove_connection(alias)
+        del _configs[alias]
+
+
+def no_retry_alias(alias: str = "default") -> str:
+    """
+    :return: the alias of a connection with the settings of alias but without retries (see ESConfig.no_retry), created
+             on first use, for the requests bounded by a budget.Budget
+    """
+    name = f"{alias}_no_retry"
+    connect(_configs.get(alias, default_config()).no_retry(), name)
+    return name
+
+
+def connect_async(config: Optional[ESConfig] = None) -> "AsyncElasticsearch":
+    """
+    asyncio client with the same settings, must be created on the loop that uses it
+    """
+    from elasticsearch import AsyncElasticsearch  # type: ignore
+
+    return AsyncElasticsearch(**(config or default_config()).client_kwargs())
+
+
+def request_timeout(operation: str, alias: str = "default") -> float:
+    """
+    :param operation: one of OPERATIONS
+    :return: timeout in seconds of this kind of request, pass it as request_timeout
+    """
+    return _configs.get(alias, ESConfig()).request_timeout(operation)
+
+
+def pool_stats(alias: str = "default") -> List[Dict[str, Any]]:
+    """
+    :return: per node, the pool size, the connections in use, opened and the requests sent so far, and if the node is marked dead
+    """
+    if alias not in _configs:
+        return []
+    from elasticsearch_dsl.connections import connections  # type: ignore
+
+    pool = connections.get_connection(alias).transport.connection_pool
+    live = set(pool.connections)
+    stats = []
+    for connection in getattr(pool, "orig_connections", pool.connections):
+        node = {"host": connection.host, "dead": connection not in live}
+        http_pool = getattr(connection, "pool", None)
+        if http_pool is not None:
+            maxsize = _configs[alias].maxsize
+            node.update(maxsize=maxsize, in_use=maxsize - http_pool.pool.qsize(), opened=http_pool.num_connections,
+                        requests=http_pool.num_requests)
+        stats.append(node)
+    return stats
+
+
+def update_pool_metrics(alias: str = "default") -> None:
+    """
+    copy pool_stats to the es_connection_pool gauge, called before the metrics are rendered
+    """
+    for node in pool_stats(alias):
+        for stat, value in node.items():
+            if stat != "host":
+                POOL_STATS.set(float(value), alias=alias, host=node["host"], stat=stat)
@@ -1,19 +1,19 @@
-from typing import Iterator, Dict, Union, Sequence, Generator
+from typing import Iterator, Dict, Optional, Union, Sequence, Generator
 from elasticsearch_dsl import Index  # type: ignore
-from elasticsearch_dsl.connections import connections  # type: ignore
 from elasticsearch.helpers import bulk
+from es_service.connection import ESConfig, connect, default_config, request_timeout
 from es_service.doc_template import BaseDoc
 
 
 class ESIndex(object):
-    def __init__(self, index_name: str, docs: Union[Iterator[Dict], Sequence[Dict]]):
+    def __init__(self, index_name: str, docs: Union[Iterator[Dict], Sequence[Dict]], config: Optional[ESConfig] = None):
         """
         ES index structure
         :param index_name: the name of your index
         :param docs: wapo docs to be loaded
+        :param config: ES connection settings, the bulk requests are always compressed
         """
-        # set an elasticsearch connection to your localhost
-        connections.create_connection(hosts=["localhost"], timeout=100, alias="default")
+        self.es = connect((config or default_config())._replace(http_compress=True))
         self.index = index_name
         es_index = Index(self.index)  # initialize the index
 
@@ -48,11 +48,12 @@ class ESIndex(object):
 
     def load(self, docs: Union[Iterator[Dict], Sequence[Dict]]):
         # bulk insertion
-        bulk(connections.get_connection(),
+        bulk(self.es,
              (
                 d.to_dict(
                     include_meta=True, skip_empty=False
                 )  # serialize the BaseDoc instance (include meta information and not skip empty documents)
                 for d in self._populate_doc(docs)
             ),
+            request_timeout=request_timeout("bulk"),
         )
@@ -1,54 +1,106 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import argparse
-import json
-from typing import List, Any
-from metrics import Score
+import asyncio
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Dict, List, Any, Optional, Set
+from bm25_index import BM25_INDEX_DIR, BM25Index
+from budget import DEGRADED, Budget, BudgetExceeded, Degraded, current as current_budget, partial_response
+from cascade import CascadeConfig, StageReport, combine
+from doc_store import DocStore
+from fusion import FusionConfig, fuse
+from metrics import Score, Qrels, batch_eval, load_qrels
+from run_cache import RunCache, RunEntry, RunKey, get_index_version
 from utils import load_topic_queries
-from elasticsearch_dsl import Search
-from elasticsearch_dsl.query import Match, ScriptScore, Ids, Query
-from elasticsearch_dsl.connections import connections
-from embedding_service.client import EmbeddingClient
+from elasticsearch_dsl import Search, MultiSearch
+from elasticsearch_dsl.query import Bool, Match, MatchPhrase, ScriptScore, Ids, Query
+from elasticsearch_dsl.response import Response
+from elasticsearch.exceptions import ConnectionTimeout
+from es_service.connection import add_arguments, config_from_args, connect, no_retry_alias, request_timeout
+from embedding_service.client import EmbeddingServerError
+from embedding_service.provider import PROVIDERS, EncoderProvider, ZMQEncoderProvider, make_provider
+from ner_service.client import NERClient, NERServerError
+from instrumentation import span
+from paragraph_index import PARAGRAPH_INDEX_DIR, ParagraphIndex
+from topic_index import TOPIC_INDEX_DIR, TopicFilter, TopicIndex
 import csv
-from NER_fatch import query_db_index
 
-from flair.data import Sentence
-from flair.models import SequenceTagger
+EMBEDDING_TYPES = {"ft_vector": "fasttext", "sbert_vector": "sbert"}
+# multi-vector embedding scored in process with the paragraph index instead of by ES
+PARAGRAPH_EMBEDDING = "paragraph"
+# index name -> in-process BM25 index serving its searches instead of ES (see use_local_index)
+LOCAL_INDICES: Dict[str, BM25Index] = {}
+# encodes the queries when no encoder is passed to get_response (see use_encoder)
+ENCODER: Dict[str, EncoderProvider] = {"default": ZMQEncoderProvider()}
+# runs the BM25 leg of the hybrid searches while the calling thread runs the vector leg
+HYBRID_LEGS = ThreadPoolExecutor(max_workers=8, thread_name_prefix="hybrid-leg")
+# NER client of each thread, a ZMQ socket must not be used by several threads (see ner_client)
+_ner_clients = threading.local()
 
 
 def get_score(response: List[Any], topic_id: str, k: int) -> Score:
-    relevance = []
-    for hit in response:
-        if hit.annotation == f"{topic_id}-1":
-            relevance.append(1)
-        elif hit.annotation == f"{topic_id}-2":
-            relevance.append(2)
-        else:
-            relevance.append(0)
-
-    with open("./pa5_data/ideal_relevance.json", "r") as f:
-        ideal_relevance = json.load(f)[topic_id]
-
-    S = Score.eval(relevance, ideal_relevance, k)
+    qrels = load_qrels()  # loaded once per process
+    relevance = qrels.relevance_of_hits(response, topic_id)
+    S = Score.eval(relevance, qrels.ideal_relevance[topic_id], k)
     return S
 
 
-def generate_script_score_query(query_vector: List[float], embedding_type: str) -> Query:
+def generate_script_score_query(query_vector: List[float], embedding_type: str, candidate_ids: Optional[List[str]] = None) -> Query:
     """
         Generate an ES query that match all documents based on the cosine similarity
 
         :param query_vector: query embedding from the encoder
         :param embedding_type: embedding type, should match the field name defined in BaseDoc ("ft_vector" or "sbert_vector")
+        :param candidate_ids: only score these documents (e.g. from topic_candidates) instead of all documents
 
         :return: an query object
     """
-    q_script = ScriptScore(query={"match_all": {}},  # use a match-all query
+    base_query = Ids(values=candidate_ids) if candidate_ids else {"match_all": {}}  # use a match-all query
+    q_script = ScriptScore(query=base_query,
                            script={"source": f"cosineSimilarity(params.query_vector, '{embedding_type}') + 1.0",
                                    "params": {"query_vector": query_vector}})
     return q_script
 
 
-def re_rank(query_text: str, embedding_type: str, response: List[Any], debug: bool = False) -> Query:
+def match_query(query_text: str, english_analyzer: bool) -> Query:
+    """
+    BM25 match query on the stemmed content (english analyzer) or on the content (standard analyzer)
+    """
+    if english_analyzer:
+        return Match(stemmed_content={"query": query_text})
+    return Match(content={"query": query_text})
+
+
+# failures of the embedding part of a search answered by the BM25 fallback when the search has a budget -> reason
+# (asyncio.wait_for of the async embedding client raises asyncio.TimeoutError, not the builtin TimeoutError before 3.11)
+FALLBACK_REASONS = {BudgetExceeded: "budget_exhausted", TimeoutError: "embedding_timeout", asyncio.TimeoutError: "embedding_timeout",
+                    EmbeddingServerError: "embedding_error", ConnectionTimeout: "es_timeout"}
+
+
+def use_encoder(encoder: EncoderProvider) -> None:
+    """
+    encode the queries with this provider (e.g. embedding_service.provider.InProcessEncoderProvider) instead of the embedding servers
+    """
+    ENCODER["default"] = encoder
+
+
+def encode_query(embedding_type: str, query_text: str, encoder: Optional[EncoderProvider] = None) -> Any:
+    """
+    :param embedding_type: embedding server type ("sbert", "fasttext")
+    :return: the query vector, within the remaining budget of the search if it has one
+    """
+    budget = current_budget()
+    timeout_ms = budget.check("the query embedding") if budget is not None else None
+    with span("query_encoding"):
+        return (encoder or ENCODER["default"]).encode(embedding_type, [query_text], timeout_ms=timeout_ms)[0]
+
+
+def re_rank(query_text: str, embedding_type: str, response: List[Any], debug: bool = False,
+            encoder: Optional[EncoderProvider] = None) -> Query:
     """
     The purpose of this re_rank function is to restructure .
 
@@ -57,27 +109,33 @@ def re_rank(query_text: str, embedding_type: str, response: List[Any], debug: bo
                                 the default value is bm25
     :param response: List[Any] - a list of top k documents that have the highest similarity rate with the search query text
     :param debug: bool - a bool value that controls debug mode
+    :param encoder: EncoderProvider - encodes the query, default the one set by use_encoder (the embedding servers)
 
     :return: a restructured query after embedded with user-specified embedding type
     """
 
-    if embedding_type == "ft_vector":
-        if debug: print("Re-rank query with {} embedding vector".format("fasttext"))
-        encoder = EmbeddingClient(host="localhost", embedding_type="fasttext")
-    elif embedding_type == "sbert_vector":
-        if debug: print("Re-rank query with {} embedding vector".format("sbert"))
-        encoder = EmbeddingClient(host="localhost", embedding_type="sbert")
-    else:
+    if embedding_type not in EMBEDDING_TYPES:
         raise NotImplementedError(embedding_type)
+    if debug: print("Re-rank query with {} embedding vector".format(EMBEDDING_TYPES[embedding_type]))
 
-    query_vector = encoder.encode([query_text], pooling="mean").tolist()[0] # get the query embedding and convert it to a list
+    query_vector = encode_query(EMBEDDING_TYPES[embedding_type], query_text, encoder).tolist() # get the query embedding and convert it to a list
     q_vector = generate_script_score_query(query_vector, embedding_type) # compute the cosine similarity score between the embeddings of query text and content text
     q_match_ids = Ids(values=[hit.meta.id for hit in response])  # get doc ids from response
     q_c = (q_match_ids & q_vector) # compound query by using logic operators on retrieved ids and query vector
     return q_c
 
 
-def search(index_name: str, query_text: Query, top_k: int, debug: bool = False) -> List[Any]:
+def use_local_index(index_name: str, index_dir: str = BM25_INDEX_DIR, doc_store_dir: Optional[str] = None) -> BM25Index:
+    """
+    answer the match and ids searches of index_name with the in-process BM25 index of bm25_index.py instead of ES,
+    the searches scoring vectors in ES (script score) are not supported
+    :param doc_store_dir: doc store of the corpus (see doc_store.py), the hits then include the content as the ES hits do
+    """
+    LOCAL_INDICES[index_name] = BM25Index(index_dir, DocStore(doc_store_dir) if doc_store_dir else None)
+    return LOCAL_INDICES[index_name]
+
+
+def search(index_name: str, query_text: Query, top_k: int, debug: bool = False, boost_ids: Optional[Set[str]] = None) -> List[Any]:
     """
         The purpose of this search function is to define a search query object and use this search object to retrieve
         documents storing in the index database.
@@ -86,31 +144,29 @@ def search(index_name: str, query_text: Query, top_k: int, debug: bool = False)
         :param query_text: str - The query or a natural language that used to match documents from the index
         :param top_k: int - an integer that represents the number of documents retrieving from the index
         :param debug: bool - a bool value that controls debug mode
+        :param boost_ids: Set[str] - ES ids of the documents mentioning an entity of the query (see ner_query),
+                                their score is increased by 1 and the top k documents are sorted again
 
         :return: a list of top k documents that have the highest similarity rate with the search query text
     """
 
-    result = Search(using="default", index=index_name).query(query_text)[:top_k]  # initialize a query and return top k results
-    response = result.execute()
-    # print(len(response))
-    #
-    # ner_collection = ner_query(query_text, True)
-    # for hit in response:
-    #     if int(hit.meta.id) in ner_collection:
-    #         hit.meta.score += 1
-    #
-    # re_sort = [(hit.meta.id, hit.meta.score, hit.title, hit.content, hit.date, hit.annotation) for hit in response if hit.meta.score is not None]
-    # print(len(re_sort))
-    # re_sort.sort(key = lambda x: x[1], reverse=True)
-    # re_sort = re_sort[:top_k]
-
-    # print(len(re_sort))
-    # count = 0
-    # for hit in response:
-    #     # print(int(hit.meta.id), hit.meta.score, "  -  ", re_sort[count][0], re_sort[count][1])
-    #     if int(hit.meta.id) != int(re_sort[count][0]):
-    #         print(int(hit.meta.id), re_sort[count][0])
-    #     count+=1
+    budget = current_budget()
+    # a budgeted search is never retried, a retry would get the full request timeout again
+    using = "default" if budget is None or index_name in LOCAL_INDICES else no_retry_alias()
+    result = Search(using=using, index=index_name).query(query_text)[:top_k]  # initialize a query and return top k results
+    result = result.params(request_timeout=request_timeout("search"))
+    if budget is not None:
+        # the remaining budget of the search bounds the request, ES returns the hits found within it
+        result = result.params(**budget.es_params())
+        if budget.terminate_after:
+            result = result.params(terminate_after=budget.terminate_after)
+    local_index = LOCAL_INDICES.get(index_name)
+    if local_index is not None:
+        response = apply_boost(Response(result, local_index.execute(query_text.to_dict(), top_k)), boost_ids)
+    else:
+        response = result.execute()
+        partial_response(response.timed_out, response._shards.failed)
+        response = apply_boost(response, boost_ids)
 
     if debug:
         print("Search query:", result.to_dict())
@@ -119,21 +175,222 @@ def search(index_name: str, query_text: Query, top_k: int, debug: bool = False)
     return response
 
 
-def ner_query(query_text:str, debug:bool=False) -> List[str]:
-    tagger = SequenceTagger.load('ner')
-    sentence = Sentence("Sony cyberattack")
-    tagger.predict(sentence)
-    query_ner = [entity.text for entity in sentence.get_spans('ner')]
+def ner_client() -> NERClient:
+    """
+    the NER client of the calling thread, created on its first entity lookup and kept for the next ones
+    """
+    client = getattr(_ner_clients, "client", None)
+    if client is None:
+        client = _ner_clients.client = NERClient(host="localhost")
+    return client
+
+
+def ner_query(index_name: str, query_text: str, top_k: int = 100, debug: bool = False) -> Set[str]:
+    """
+    The purpose of this ner_query function is to find the documents that mention the named entities of the query.
+    The entities are tagged by the NER server (python -m ner_service.server) and looked up in a single multi-search request.
+
+    :param index_name: str - The index name that represents the Elasticsearch "database"
+    :param query_text: str - The query or a natural language that used to match documents from the index
+    :param top_k: int - the number of documents retrieved for each entity
+    :param debug: bool - a bool value that controls debug mode
 
-    ner_collection = []
+    :return: a set of ES ids of the documents that mention at least one entity
+    """
+    budget = current_budget()
+    try:
+        query_ner = ner_client().tag([query_text])[0]  # within the remaining budget
+    except (TimeoutError, BudgetExceeded):
+        if budget is None:
+            raise
+        DEGRADED.inc(reason="ner_timeout")  # a budgeted search goes on without the entity boost
+        return set()
+    except NERServerError:
+        DEGRADED.inc(reason="ner_error")  # e.g. the server is overloaded, search with the plain query
+        return set()
+    if debug: print("Entities of the query:", query_ner)
+    if not query_ner:
+        return set()
+
+    ms = MultiSearch(using="default", index=index_name).params(request_timeout=request_timeout("search"))
+    if budget is not None:
+        ms = MultiSearch(using=no_retry_alias(), index=index_name).params(request_timeout=budget.es_params()["request_timeout"])
     for entity in query_ner:
-        for item in query_db_index(entity):
-            ner_collection.append(item['id'])
+        ms = ms.add(Search().query(MatchPhrase(content={"query": entity})).source(False)[:top_k])
+    ner_collection = {hit.meta.id for response in ms.execute() for hit in response}
     if debug: print(ner_collection)
     return ner_collection
 
 
-def get_response(index_name:str, query_text:str, english_analyzer:bool, search_type:str, embedding:str, k:int, debug:bool=False) -> List[Any]:
+def apply_boost(response: List[Any], boost_ids: Optional[Set[str]]) -> List[Any]:
+    """
+    increase the score of the documents in boost_ids by 1 and sort the documents again
+    """
+    if not boost_ids:
+        return response
+    for hit in response:
+        if hit.meta.id in boost_ids:
+            hit.meta.score += 1
+    return sorted(response, key=lambda hit: hit.meta.score, reverse=True)
+
+
+@lru_cache(maxsize=None)
+def get_paragraph_index(index_dir: str = PARAGRAPH_INDEX_DIR) -> ParagraphIndex:
+    return ParagraphIndex.load(index_dir)
+
+
+def encode_paragraph_query(query_text: str, encoder: Optional[EncoderProvider] = None) -> Any:
+    return encode_query(get_paragraph_index().embedding, query_text, encoder)
+
+
+def paragraph_rerank(query_text: str, response: List[Any], boost_ids: Optional[Set[str]] = None,
+                     encoder: Optional[EncoderProvider] = None) -> List[Any]:
+    """
+    re-rank the hits by the max-sim of the query and the paragraphs of each document, computed in process
+    """
+    query_vector = encode_paragraph_query(query_text, encoder)
+    hits = {hit.meta.id: hit for hit in response}
+    with span("rerank_search"):
+        ranking = get_paragraph_index().rerank(query_vector, list(hits))
+    for doc_id, score in ranking:
+        hits[doc_id].meta.score = score
+    return apply_boost([hits[doc_id] for doc_id, _ in ranking], boost_ids)
+
+
+def paragraph_search(index_name: str, query_text: str, k: int, boost_ids: Optional[Set[str]] = None,
+                     candidate_ids: Optional[List[str]] = None, encoder: Optional[EncoderProvider] = None) -> List[Any]:
+    """
+    rank all documents of the paragraph index (or only the candidates) by max-sim, only the top k documents are fetched from ES
+    """
+    query_vector = encode_paragraph_query(query_text, encoder)
+    with span("vector_search"):
+        if candidate_ids:
+            ranking = [(doc_id, score) for doc_id, score in get_paragraph_index().rerank(query_vector, candidate_ids)[:k]
+                       if score > float("-inf")]
+        else:
+            ranking = get_paragraph_index().search(query_vector, k)
+        hits = {hit.meta.id: hit for hit in search(index_name, Ids(values=[doc_id for doc_id, _ in ranking]), k)}
+    response = []
+    for doc_id, score in ranking:
+        if doc_id in hits:
+            hits[doc_id].meta.score = score
+            response.append(hits[doc_id])
+    return apply_boost(response, boost_ids)
+
+
+def vector_search(index_name: str, query_text: str, embedding: str, k: int, boost_ids: Optional[Set[str]] = None,
+                  candidate_ids: Optional[List[str]] = None, encoder: Optional[EncoderProvider] = None) -> List[Any]:
+    """
+    encode the query with the encoder of the embedding and rank all documents (or only the candidates) by cosine similarity
+    """
+    if embedding == PARAGRAPH_EMBEDDING:
+        return paragraph_search(index_name, query_text, k, boost_ids, candidate_ids, encoder)
+    if embedding not in EMBEDDING_TYPES:
+        raise NotImplementedError(embedding)
+    query_vector = encode_query(EMBEDDING_TYPES[embedding], query_text, encoder).tolist()
+    q_vector = generate_script_score_query(query_vector, embedding, candidate_ids)
+    with span("vector_search"):
+        return search(index_name, q_vector, k, boost_ids=boost_ids)
+
+
+def hybrid_search(index_name: str, query: Query, query_text: str, embedding: str, k: int, fusion: FusionConfig,
+                  debug: bool = False, candidate_ids: Optional[List[str]] = None, encoder: Optional[EncoderProvider] = None) -> List[Any]:
+    """
+    run the BM25 leg and the vector leg concurrently, each to its own depth, and merge them with rank fusion
+    the latency is the one of the slowest leg instead of the sum of both
+    when the vector leg of a budgeted search fails, the hits of the BM25 leg are attached to the error as bm25_hits, the
+    fallback of budgeted_response answers with them instead of searching again
+    """
+    def bm25_leg() -> List[Any]:
+        with span("first_stage_search"):
+            return search(index_name, query, fusion.bm25_depth, debug)
+
+    bm25_future = HYBRID_LEGS.submit(contextvars.copy_context().run, bm25_leg)  # the leg runs within the budget of the search
+    try:
+        vector_hits = vector_search(index_name, query_text, embedding, fusion.vector_depth, candidate_ids=candidate_ids, encoder=encoder)
+    except tuple(FALLBACK_REASONS) as e:
+        if current_budget() is not None:
+            try:
+                e.bm25_hits = bm25_future.result()
+            except tuple(FALLBACK_REASONS):
+                pass  # the fallback searches again with the reserve
+        raise
+    bm25_hits = bm25_future.result()
+    with span("fusion"):
+        return fuse(bm25_hits, vector_hits, fusion, k)
+
+
+def stage_scores(index_name: str, query: Query, query_text: str, scorer: str, doc_ids: List[str],
+                 encoder: Optional[EncoderProvider] = None) -> Dict[str, float]:
+    """
+    score only the given documents with one scorer of the cascade, in one ES request (or in process for the paragraphs)
+    :return: score of each document the scorer could score
+    """
+    if scorer == PARAGRAPH_EMBEDDING:
+        return dict(get_paragraph_index().rerank(encode_paragraph_query(query_text, encoder), doc_ids))
+    if scorer == "bm25":
+        q_scored = Bool(must=[query], filter=[Ids(values=doc_ids)])
+    elif scorer in EMBEDDING_TYPES:
+        query_vector = encode_query(EMBEDDING_TYPES[scorer], query_text, encoder).tolist()
+        q_scored = generate_script_score_query(query_vector, scorer, doc_ids)
+    else:
+        raise NotImplementedError(scorer)
+    return {hit.meta.id: hit.meta.score for hit in search(index_name, q_scored, len(doc_ids))}
+
+
+def cascade_search(index_name: str, query: Query, query_text: str, cascade: CascadeConfig, debug: bool = False,
+                   encoder: Optional[EncoderProvider] = None) -> List[StageReport]:
+    """
+    run the stages of the cascade, the first one retrieves its depth of documents and each next one scores only the
+    documents kept by the one before it
+    :return: the report of each stage (documents scored, time, ranking), the last ranking is the result
+    """
+    reports = []
+    hits: List[Any] = []
+    for i, stage in enumerate(cascade.stages):
+        st = time.perf_counter()
+        candidates = len(hits)
+        with span(f"cascade_{stage.scorer}"):
+            if i == 0 and stage.scorer == "bm25":
+                hits = list(search(index_name, query, stage.depth, debug))
+            elif i == 0:
+                hits = list(vector_search(index_name, query_text, stage.scorer, stage.depth, encoder=encoder))
+            elif hits:
+                scores = stage_scores(index_name, query, query_text, stage.scorer, [hit.meta.id for hit in hits], encoder)
+                hits = combine(hits, scores, stage, cascade.rrf_k)
+        reports.append(StageReport(stage, len(hits) if i == 0 else candidates, time.perf_counter() - st, list(hits),
+                                   [hit.meta.score for hit in hits]))
+        if debug: print("Cascade stage {}: scored {} documents, kept {} in {:.1f} ms".format(stage.tag(), reports[-1].candidates, len(hits),
+                                                                                          reports[-1].seconds * 1000))
+    return reports
+
+
+@lru_cache(maxsize=None)
+def get_topic_index(index_dir: str = TOPIC_INDEX_DIR) -> TopicIndex:
+    return TopicIndex.load(index_dir)
+
+
+def topic_candidates(index_name: str, query: Query, topic_filter: TopicFilter, debug: bool = False) -> Optional[List[str]]:
+    """
+    documents of the explicit topics of the filter, or of the topics inferred from the top BM25 documents of the query
+
+    :return: ES ids of the candidates, None if no topic was found (the vector search then scores every document)
+    """
+    topic_index = get_topic_index()
+    if topic_filter.topics:
+        topics = {topic: 1.0 for topic in topic_filter.topics}
+    else:
+        feedback = search(index_name, query, topic_filter.feedback_docs)
+        topics = topic_index.infer_topics([hit.meta.id for hit in feedback], topic_filter.n_topics)
+    candidates = topic_index.candidates(topics, topic_filter.max_candidates)
+    if debug: print("Topics {} -> {} candidate documents".format(topics, len(candidates)))
+    return candidates or None
+
+
+def get_response(index_name:str, query_text:str, english_analyzer:bool, search_type:str, embedding:str, k:int, debug:bool=False, ner_boost:bool=False,
+                 fusion: Optional[FusionConfig] = None, topic_filter: Optional[TopicFilter] = None,
+                 encoder: Optional[EncoderProvider] = None, cascade: Optional[CascadeConfig] = None,
+                 budget: Optional[Budget] = None) -> List[Any]:
     """
     The purpose of this get_response function is use the user self-defined query_text to retrieve documents storing in the index database.
 
@@ -142,42 +399,49 @@ def get_response(index_name:str, query_text:str, english_analyzer:bool, search_t
     :param english_analyzer: bool - A bool value representing whether the user want to use english analyzer to process article's content
                                 or use standard analyzer to process content
     :param search_type: str - the string representing the method user specified to use for matching, the available option could be
-                                    "rerank" or "vector".
-    :param embedding: str - the embedding type specified by user, available option could be fasttext embedding and sbert embedding;
-                                the default value is bm25
+                                    "rerank", "vector", "hybrid" (BM25 and vector legs merged by rank fusion) or "cascade"
+                                    (stages of scorers pruning the candidates, the embedding is then ignored).
+    :param embedding: str - the embedding type specified by user, available option could be fasttext embedding, sbert embedding
+                                or "paragraph" (max-sim over the paragraph vectors of paragraph_index.py); the default value is bm25
     :param top_k: int - an integer that represents the number of documents retrieving from the index
     :param debug: bool - a bool value that controls debug mode
+    :param ner_boost: bool - boost the documents mentioning a named entity of the query (requires the NER server)
+    :param fusion: FusionConfig - depths of the legs and fusion method of the hybrid search, default reciprocal rank fusion
+    :param topic_filter: TopicFilter - only score the documents of some LDA topics (see topic_index.py) in the vector search
+                                and the vector leg of the hybrid search, default score all documents
+    :param encoder: EncoderProvider - encodes the query for the embeddings, default the one set by use_encoder (the embedding servers)
+    :param cascade: CascadeConfig - stages of the cascade search, default bm25 top 1000 -> fasttext top 200 -> sbert top 50
+    :param budget: Budget - end-to-end latency budget, if the embedding part fails or misses its deadline the BM25 hits are
+                                returned instead, as a budget.Degraded list
 
     :return: a list of top k documents that have the highest similarity rate with the search query text
     """
+    if budget is not None:
+        return budgeted_response(budget, index_name, query_text, english_analyzer, search_type, embedding, k, debug, ner_boost=ner_boost,
+                                 fusion=fusion, topic_filter=topic_filter, encoder=encoder, cascade=cascade)
 
-    if english_analyzer:
-        if debug: print("Matching on stemmed content with english analyzer")
-        q_basic = Match(stemmed_content={"query": query_text}) # match query based on stemmed content if user choose english analyzer
-    else:
-        if debug: print("Matching on content with standard analyzer")
-        q_basic = Match(content={"query": query_text}) # match query based on content if user choose english analyzer
+    boost_ids = None
+    if ner_boost:
+        with span("entity_lookup"):
+            boost_ids = ner_query(index_name, query_text, debug=debug)
+
+    if debug: print("Matching on {}".format("stemmed content with english analyzer" if english_analyzer else "content with standard analyzer"))
+    q_basic = match_query(query_text, english_analyzer)
 
     if debug: print("embedding:", embedding, "  search type:", search_type, "  query text:", query_text)
+    candidate_ids = None
+    if topic_filter is not None and embedding != "bm25" and search_type in ("vector", "hybrid"):
+        with span("topic_prefilter"):
+            candidate_ids = topic_candidates(index_name, q_basic, topic_filter, debug)
     # rank documents based on the embedding type
     if search_type == "vector":
         if embedding == "bm25":
             if debug: print("Rank query with {} embedding vector".format("bm25"))
-            response = search(index_name, q_basic, k, debug) # using query object to search the top k documents
-        elif embedding == "ft_vector":
-            if debug: print("Rank query with {} embedding vector".format("fasttext"))
-            encoder = EmbeddingClient(host="localhost", embedding_type="fasttext")
-            query_vector = encoder.encode([query_text], pooling="mean").tolist()[0]
-            q_vector = generate_script_score_query(query_vector, embedding)
-            response = search(index_name, q_vector, k)
-        elif embedding == "sbert_vector":
-            if debug: print("Rank query with {} embedding vector".format("sbert"))
-            encoder = EmbeddingClient(host="localhost", embedding_type="sbert")
-            query_vector = encoder.encode([query_text], pooling="mean").tolist()[0]
-            q_vector = generate_script_score_query(query_vector, embedding)
-            response = search(index_name, q_vector, k)
+            with span("first_stage_search"):
+                response = search(index_name, q_basic, k, debug, boost_ids) # using query object to search the top k documents
         else:
-            raise NotImplementedError(embedding)
+            if debug: print("Rank query with {} embedding vector".format(EMBEDDING_TYPES.get(embedding, embedding)))
+            response = vector_search(index_name, query_text, embedding, k, boost_ids, candidate_ids, encoder)
 
     # if the first ranking is based on the default bm25 and the search type was specified as "re-rank", rerank the operations
     if search_type == "rerank":
@@ -185,26 +449,156 @@ def get_response(index_name:str, query_text:str, english_analyzer:bool, search_t
 
         # using query object to search the top k documents
         if debug: print("Rank query with {} embedding vector".format("bm25"))
-        response = search(index_name, q_basic, k, debug)
+        with span("first_stage_search"):
+            response = search(index_name, q_basic, k, debug)
 
         if debug: print("Re-rank with {} embedding vector".format(embedding))
-        rescore_query = re_rank(query_text, embedding, response, debug)  # re-rank the top k response if user specifies the embedding method
-        response = search(index_name, rescore_query, k) # re-rank
+        if embedding == PARAGRAPH_EMBEDDING:
+            response = paragraph_rerank(query_text, response, boost_ids, encoder)  # scored in process, no second ES request
+        else:
+            rescore_query = re_rank(query_text, embedding, response, debug, encoder)  # re-rank the top k response if user specifies the embedding method
+            with span("rerank_search"):
+                response = search(index_name, rescore_query, k, boost_ids=boost_ids) # re-rank
+
+    if search_type == "hybrid":
+        assert query_text, f"Hybrid search with {embedding} can only happen if query text is not empty!"
+        fusion = fusion or FusionConfig()
+        if debug: print("Fuse bm25 top {} and {} top {} with {}".format(fusion.bm25_depth, embedding, fusion.vector_depth, fusion.method))
+        response = apply_boost(hybrid_search(index_name, q_basic, query_text, embedding, k, fusion, debug, candidate_ids, encoder), boost_ids)
+
+    if search_type == "cascade":
+        assert query_text, "Cascade search can only happen if query text is not empty!"
+        reports = cascade_search(index_name, q_basic, query_text, cascade or CascadeConfig(), debug, encoder)
+        response = apply_boost(reports[-1].hits[:k], boost_ids)
     return response
 
 
+def budgeted_response(budget: Budget, index_name: str, query_text: str, english_analyzer: bool, search_type: str, embedding: str,
+                      k: int, debug: bool = False, **kwargs) -> List[Any]:
+    """
+    get_response within the budget, every ES search and embedding call of the search gets the remaining time
+    :return: the ranking of get_response (as a Degraded list if an ES search returned partial hits), or the BM25 ranking
+             as a Degraded list when a call of the embedding part failed or ran out of time, or an empty Degraded list
+             when the BM25 search failed too
+    """
+    with budget.activate():
+        try:
+            response = get_response(index_name, query_text, english_analyzer, search_type, embedding, k, debug, **kwargs)
+            return Degraded(response, "es_partial") if budget.partial else response
+        except tuple(FALLBACK_REASONS) as e:
+            reason = next(reason for error, reason in FALLBACK_REASONS.items() if isinstance(e, error))
+            DEGRADED.inc(reason=reason)
+            if search_type == "vector" and embedding == "bm25":
+                error = e  # the BM25 search itself failed, nothing to fall back to
+            elif getattr(e, "bm25_hits", None) is not None:
+                if debug: print("Falling back to the bm25 leg ({}): {}".format(reason, e))
+                return Degraded(e.bm25_hits[:k], reason)
+            else:
+                if debug: print("Falling back to bm25 ({}): {}".format(reason, e))
+                budget.release_reserve()
+                try:
+                    with span("first_stage_search"):
+                        return Degraded(search(index_name, match_query(query_text, english_analyzer), k, debug), reason)
+                except tuple(FALLBACK_REASONS) as fallback_error:
+                    error = fallback_error
+        DEGRADED.inc(reason="fallback_failed")
+        if debug: print("No BM25 results within the budget: {}".format(error))
+        return Degraded([], "fallback_failed")
+
+
+def get_run(run_cache: RunCache, index_name: str, index_version: str, topic_id: str, query_text: str, english_analyzer: bool,
+            search_type: str, embedding: str, k: int, debug: bool = False, fusion: Optional[FusionConfig] = None,
+            topic_filter: Optional[TopicFilter] = None, cascade: Optional[CascadeConfig] = None) -> List[RunEntry]:
+    """
+    The purpose of this get_run function is to reuse the cached run of a retrieval, and only query the index on a cache miss.
+
+    :param run_cache: RunCache - the on-disk cache of TREC runs
+    :param index_version: str - the build of the index (see run_cache.get_index_version), part of the cache key
+    :param topic_id: str - the topic written in the run file
+    the other parameters are the same as get_response
+
+    :return: a list of (doc_id, score) of the top k documents
+    """
+    # the fusion settings and the cascade stages change the hybrid and cascade rankings, so they are part of the key
+    key_type = (fusion or FusionConfig()).tag() if search_type == "hybrid" else search_type
+    if search_type == "cascade":
+        key_type = (cascade or CascadeConfig()).tag()
+    if topic_filter is not None:
+        key_type += "+" + topic_filter.tag()
+    # the in-process backends (e.g. onnx-int8) give other embeddings than the embedding servers
+    encoder = "" if search_type == "vector" and embedding == "bm25" else ENCODER["default"].tag()
+    key = RunKey(index_name, index_version, query_text, "english" if english_analyzer else "standard", key_type, embedding, k, encoder)
+    run = run_cache.get(key)
+    if run is None:
+        run = run_cache.put(key, topic_id, get_response(index_name, query_text, english_analyzer, search_type, embedding, k, debug, fusion=fusion,
+                                                         topic_filter=topic_filter, cascade=cascade))
+    elif debug:
+        print("Reusing cached run", key.digest())
+    return run
+
+
+def run_qrels(run_cache: RunCache) -> Qrels:
+    """
+    qrels scoring the cached runs: the judgments of the corpus, or the ones cached with the runs if the corpus is not here
+    """
+    qrels = load_qrels()
+    return qrels if qrels.complete else run_cache.qrels(qrels.ideal_relevance)
+
+
+def score_run(run: List[RunEntry], topic_id: str, k: int, qrels: Qrels) -> Score:
+    relevance = qrels.relevance([entry.doc_id for entry in run], topic_id)
+    return Score.eval(relevance, qrels.ideal_relevance[topic_id], k)
+
+
 def main():
-    connections.create_connection(hosts=["localhost"], timeout=100, alias="default") # getting connection to the elasticsearch server
     parser = argparse.ArgumentParser(description="Elasticsearch IR system") # creating arguments
     parser.add_argument("--index_name", required=True, type=str, default="wapo_docs_50k", help="name of the ES index")
     parser.add_argument("--topic_id", required=True, type=str, default="TOPIC_ID", help="topic id number")
     parser.add_argument("--query_type", required=True, type=str, default='kw', help="use keyword or natural language query")
     parser.add_argument("--use_english_analyzer", action='store_true', help="use english analyzer for BM25 search")
-    parser.add_argument("--search_type", required=False, type=str, default='vector', help="reranking or ranking with vector only")
-    parser.add_argument("--vector_name", required=False, type=str, default="bm25", help="use fasttext or sbert embedding")
+    parser.add_argument("--search_type", required=False, type=str, default='vector', help="reranking, ranking with vector only, hybrid (bm25 and vector fused) or cascade (see --cascade)")
+    parser.add_argument("--vector_name", required=False, type=str, default="bm25", help="use fasttext, sbert or paragraph (multi-vector) embedding")
     parser.add_argument("--top_k", required=True, type=int, default=20, help="evaluate on top k ranked documents")
+    parser.add_argument("--cutoffs", required=False, type=int, nargs="+", default=None, help="also report P@k, AP and NDCG@k at each of these cutoffs (<= top_k)")
+    parser.add_argument("--ner_boost", action='store_true', help="boost documents mentioning named entities of the query (requires the NER server)")
+    parser.add_argument("--run_cache_dir", required=False, type=str, default="run_cache", help="directory of the cached TREC runs")
+    parser.add_argument("--no_run_cache", action='store_true', help="always query the index and do not cache the runs")
+    parser.add_argument("--invalidate_cache", action='store_true', help="drop the cached runs of this index, e.g. after rebuilding it")
+    parser.add_argument("--index_version", required=False, type=str, default=None, help="version of the index used in the cache key, default read from ES: get_index_version sends one request to ES on every invocation without --local_index, even when all runs are cached, set it to score cached runs without ES")
+    parser.add_argument("--fusion", required=False, type=str, default="rrf", choices=["rrf", "weighted"], help="fusion of the hybrid search legs")
+    parser.add_argument("--bm25_depth", required=False, type=int, default=100, help="documents retrieved by the bm25 leg of the hybrid search")
+    parser.add_argument("--vector_depth", required=False, type=int, default=100, help="documents retrieved by the vector leg of the hybrid search")
+    parser.add_argument("--rrf_k", required=False, type=int, default=60, help="rank constant of reciprocal rank fusion")
+    parser.add_argument("--bm25_weight", required=False, type=float, default=0.5, help="weight of the bm25 leg in weighted fusion")
+    parser.add_argument("--cascade", required=False, type=str, default="bm25:1000,ft_vector:200,sbert_vector:50", help="stages of the cascade search, scorer:depth[:combine[:weight]] separated by commas (see cascade.py)")
+    parser.add_argument("--topic_filter", required=False, type=int, nargs="*", default=None, help="only score the documents of these LDA topics in the vector search, no topic infers them from the bm25 top documents")
+    parser.add_argument("--max_candidates", required=False, type=int, default=5000, help="documents kept by the topic filter")
+    parser.add_argument("--local_index", required=False, type=str, default=None, help="serve the BM25 searches from the in-process index in this directory (see bm25_index.py) instead of ES")
+    parser.add_argument("--encoder", required=False, type=str, default="zmq", choices=list(PROVIDERS), help="encode the queries with the embedding servers (zmq) or with the models loaded in this process (inprocess)")
+    parser.add_argument("--doc_store", required=False, type=str, default=None, help="doc store of the corpus (see doc_store.py) filling the content of the --local_index hits")
     parser.add_argument("--debug", action='store_true', help="debug mode activated")
+    add_arguments(parser)
     args = parser.parse_args()
+    connect(config_from_args(args))  # getting connection to the elasticsearch server
+    if args.local_index:
+        use_local_index(args.index_name, args.local_index, args.doc_store)
+    use_encoder(make_provider(args.encoder))
+    fusion = FusionConfig(args.fusion, args.bm25_depth, args.vector_depth, args.rrf_k, args.bm25_weight)
+    cascade = CascadeConfig.parse(args.cascade, args.rrf_k)
+    topic_filter = None
+    if args.topic_filter is not None:
+        topic_filter = TopicFilter(topics=tuple(args.topic_filter), max_candidates=args.max_candidates)
+
+    run_cache = None
+    if not args.no_run_cache and not args.ner_boost:  # entity boosting is not part of the cache key
+        run_cache = RunCache(args.run_cache_dir)
+        if args.invalidate_cache:
+            dropped = run_cache.invalidate(args.index_name)
+            if args.debug: print("Dropped {} cached runs of {}".format(dropped, args.index_name))
+        if args.index_version or not args.local_index:
+            index_version = args.index_version or get_index_version(args.index_name)
+        else:
+            index_version = "local-" + LOCAL_INDICES[args.index_name].version
 
     # loading example queries from the pa5_queries.json file
     queries = load_topic_queries("pa5_data/pa5_queries.json")
@@ -219,7 +613,22 @@ def main():
 
     top_k = int(args.top_k)
     if args.debug: print("Looking for top {} docuemnts from the dataset".format(top_k))
-    response = get_response(args.index_name, query_text, args.use_english_analyzer, args.search_type, args.vector_name, top_k, args.debug)
+    if run_cache is None:
+        response = get_response(args.index_name, query_text, args.use_english_analyzer, args.search_type, args.vector_name, top_k, args.debug, args.ner_boost,
+                                fusion, topic_filter, cascade=cascade)
+        qrels = load_qrels()
+        relevance = qrels.relevance_of_hits(response, args.topic_id)
+    else:
+        response = get_run(run_cache, args.index_name, index_version, args.topic_id, query_text, args.use_english_analyzer,
+                           args.search_type, args.vector_name, top_k, args.debug, fusion, topic_filter, cascade)
+        qrels = run_qrels(run_cache)
+        relevance = qrels.relevance([entry.doc_id for entry in response], args.topic_id)
+
+    def ndcg_of(topic: str, text: str, analyzer: bool, s_type: str, vector: str) -> float:
+        if run_cache is None:
+            return get_score(get_response(args.index_name, text, analyzer, s_type, vector, top_k, args.debug), topic, top_k).ndcg
+        run = get_run(run_cache, args.index_name, index_version, topic, text, analyzer, s_type, vector, top_k, args.debug)
+        return score_run(run, topic, top_k, run_qrels(run_cache)).ndcg
 
     # for each of the 12 example queries, calculate the ndcg score under different conditions
     writeToCSV = False
@@ -241,10 +650,10 @@ def main():
                 query_text1 = queries[topic]['kw']
                 query_text2 = queries[topic]['nl']
 
-                vector_kw = get_score(get_response(args.index_name, query_text1, English_Analyzer, "vector", 'bm25', top_k, args.debug), topic, top_k).ndcg
-                vector_nl = get_score(get_response(args.index_name, query_text2, English_Analyzer, "vector", 'bm25', top_k, args.debug), topic, top_k).ndcg
-                rerank_kw = get_score(get_response(args.index_name, query_text1, English_Analyzer, "rerank", "ft_vector", top_k, args.debug), topic, top_k).ndcg
-                rerank_nl = get_score(get_response(args.index_name, query_text2, English_Analyzer, "rerank", "ft_vector", top_k, args.debug), topic, top_k).ndcg
+                vector_kw = ndcg_of(topic, query_text1, English_Analyzer, "vector", 'bm25')
+                vector_nl = ndcg_of(topic, query_text2, English_Analyzer, "vector", 'bm25')
+                rerank_kw = ndcg_of(topic, query_text1, English_Analyzer, "rerank", "ft_vector")
+                rerank_nl = ndcg_of(topic, query_text2, English_Analyzer, "rerank", "ft_vector")
 
                 # print()
                 # print("vector_kw ", vector_kw, "  vector_nl ",vector_nl)
@@ -260,10 +669,15 @@ def main():
         print("****************"*3)
         print("Queries Evaluation End")
     else:
-        ndcg_score = get_score(response, args.topic_id, top_k)
+        ndcg_score = Score.eval(relevance, qrels.ideal_relevance[args.topic_id], top_k)
         print(f"score of {args.query_type:11s}: {ndcg_score.ap:.5f}")
         print(f"score of {args.query_type:11s}: {ndcg_score.prec:.5f}")
         print(f"score of {args.query_type:11s}: {ndcg_score.ndcg:.5f}")
+        if args.cutoffs:
+            # score every cutoff from the single retrieval above
+            batch = batch_eval([relevance], [qrels.ideal_relevance[args.topic_id]], args.cutoffs)
+            for j, k in enumerate(batch.cutoffs):
+                print(f"@{k:<4d} AP: {batch.ap[0, j]:.5f}  P: {batch.prec[0, j]:.5f}  NDCG: {batch.ndcg[0, j]:.5f}")
 
 
 if __name__ == "__main__":
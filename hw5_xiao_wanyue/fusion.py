@@ -0,0 +1,75 @@
+"""
+rank fusion of the BM25 and vector legs of the hybrid search
+reciprocal rank fusion only uses the ranks of each leg, weighted score fusion min-max normalizes the scores of each leg
+before summing them, a document missing from a leg gets nothing (rrf) or 0 (weighted) from that leg
+"""
+from typing import Any, Dict, List, NamedTuple, Sequence
+
+
+class FusionConfig(NamedTuple):
+    method: str = "rrf"  # "rrf" or "weighted"
+    bm25_depth: int = 100  # number of documents retrieved by the BM25 leg
+    vector_depth: int = 100  # number of documents retrieved by the vector leg
+    rrf_k: int = 60
+    bm25_weight: float = 0.5  # weight of the BM25 leg in the weighted fusion, the vector leg gets 1 - bm25_weight
+
+    def tag(self) -> str:
+        # identifies the fused ranking, e.g. in the run cache key
+        if self.method == "rrf":
+            return f"hybrid-rrf{self.rrf_k}-{self.bm25_depth}-{self.vector_depth}"
+        return f"hybrid-w{self.bm25_weight:g}-{self.bm25_depth}-{self.vector_depth}"
+
+
+def reciprocal_rank_fusion(legs: Sequence[List[Any]], rrf_k: int = 60) -> Dict[str, float]:
+    """
+    :param legs: ranked hits of each leg
+    :return: fused score of each document id
+    """
+    fused: Dict[str, float] = {}
+    for hits in legs:
+        for rank, hit in enumerate(hits, start=1):
+            fused[hit.meta.id] = fused.get(hit.meta.id, 0.0) + 1.0 / (rrf_k + rank)
+    return fused
+
+
+def weighted_score_fusion(legs: Sequence[List[Any]], weights: Sequence[float]) -> Dict[str, float]:
+    """
+    :param legs: ranked hits of each leg
+    :param weights: weight of each leg
+    :return: fused score of each document id
+    """
+    fused: Dict[str, float] = {}
+    for hits, weight in zip(legs, weights):
+        if not hits:
+            continue
+        scores = [hit.meta.score for hit in hits]
+        low, high = min(scores), max(scores)
+        for hit in hits:
+            norm = (hit.meta.score - low) / (high - low) if high > low else 1.0
+            fused[hit.meta.id] = fused.get(hit.meta.id, 0.0) + weight * norm
+    return fused
+
+
+def fuse(bm25_hits: List[Any], vector_hits: List[Any], config: FusionConfig, k: int) -> List[Any]:
+    """
+    merge the two legs into one list of hits sorted by the fused score (set as hit.meta.score)
+    :return: the top k fused hits
+    """
+    if config.method == "rrf":
+        fused = reciprocal_rank_fusion([bm25_hits, vector_hits], config.rrf_k)
+    elif config.method == "weighted":
+        fused = weighted_score_fusion([bm25_hits, vector_hits], [config.bm25_weight, 1.0 - config.bm25_weight])
+    else:
+        raise NotImplementedError(config.method)
+
+    hits: Dict[str, Any] = {}
+    for hit in list(bm25_hits) + list(vector_hits):
+        hits.setdefault(hit.meta.id, hit)
+    ranked = sorted(fused, key=lambda doc_id: fused[doc_id], reverse=True)[:k]
+    for doc_id in ranked:
+        hits[doc_id].meta.score = fused[doc_id]
+    return [hits[doc_id] for doc_id in ranked]
+
+
+if __name__ == "__main__":
+    pass
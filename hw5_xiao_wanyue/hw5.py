@@ -2,21 +2,255 @@
 # -*- coding: utf-8 -*-
 import ast
 import argparse
+import cProfile
+import os
+import threading
+import time
+_import_start = time.perf_counter()
 from datetime import datetime
 # from typing import Dict, Tuple
-from flask import Flask, render_template, request
-from elasticsearch_dsl import Search
-from elasticsearch import Elasticsearch
-from elasticsearch_dsl.query import Ids
-from elasticsearch_dsl.connections import connections
-from evaluate import get_response, get_score
-from spell_corrector import SpellCorrector
+from flask import Flask, render_template, request, g, Response, jsonify
+from embedding_service import INV_PORT_EMBEDDING_MAPPING
+from es_service import connection as es_connection
+from budget import Budget, Degraded, degraded_reason
+from instrumentation import REGISTRY, STARTUP_PHASES, STARTUP_SECONDS, span, startup_phase, startup_report
+from result_cache import ResultCache
+from utils import load_topic_queries
 
+# elasticsearch, numpy, zmq and the spell corrector vocabulary are loaded on first use (or by warm_up), not at import
 app = Flask(__name__)
-es = Elasticsearch()
-connections.create_connection(hosts=["localhost"], timeout=100, alias="default")
-sc = SpellCorrector()
+sc = None
+suggester = None
+get_response = None
+es_connected = False  # the default ES connection of this process is created, see load_search_backend
 page_limit = 8
+_load_lock = threading.Lock()
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Elasticsearch IR system") # creating arguments
+    parser.add_argument("--index_name", required=False, type=str, default="wapo_docs_50k", help="name of the ES index")
+    parser.add_argument("--top_k", required=False, type=int, default=10000, help="evaluate on top k ranked documents")
+    parser.add_argument("--debug", action='store_true', help="debug mode activated")
+    parser.add_argument("--profile_slow_ms", required=False, type=float, default=None, help="profile every request and dump the profile of requests slower than this")
+    parser.add_argument("--profile_dir", required=False, type=str, default="profiles", help="directory of the dumped profiles")
+    parser.add_argument("--no_result_cache", action='store_true', help="do not cache the results of /results")
+    parser.add_argument("--cache_mb", required=False, type=float, default=64, help="memory budget of the result cache in MB")
+    parser.add_argument("--cache_ttl", required=False, type=float, default=600, help="seconds before a cached result expires")
+    parser.add_argument("--no_warm_up", action='store_true', help="do not pre-populate the result cache with the pa5 queries")
+    parser.add_argument("--doc_cache_mb", required=False, type=float, default=16, help="memory budget of the document page cache in MB")
+    parser.add_argument("--no_prefetch", action='store_true', help="do not prefetch the documents of the displayed result page")
+    parser.add_argument("--startup_report", action='store_true', help="print the time spent in each startup phase once warmed up")
+    parser.add_argument("--suggest_index", required=False, type=str, default="./pa5_data/suggest_index", help="directory of the /suggest prefix index")
+    parser.add_argument("--doc_store", required=False, type=str, default=None, help="read the document pages from the doc store of the corpus in this directory (see doc_store.py) instead of ES")
+    parser.add_argument("--encoder", required=False, type=str, default="zmq", choices=["zmq", "inprocess"], help="encode the queries with the embedding servers (zmq) or with the models loaded in the app (inprocess), not used by the asyncio workers of serve.py")
+    parser.add_argument("--budget_ms", required=False, type=float, default=2000, help="latency budget of a search, the bm25 results are shown when the embedding part misses it, 0 for no budget")
+    parser.add_argument("--fallback_ms", required=False, type=float, default=150, help="part of the budget kept for the bm25 fallback")
+    parser.add_argument("--terminate_after", required=False, type=int, default=None, help="documents collected per shard by each ES search of a budgeted search")
+    es_connection.add_arguments(parser)
+    return parser
+
+
+# default settings when the app is imported by a WSGI server (see serve.py), replaced by the command line in __main__
+args = build_parser().parse_args([])
+io_loop = None
+async_searcher = None
+result_cache = None
+doc_fetcher = None
+
+
+def load_search_backend(connect: bool = True) -> None:
+    """
+    import the search code (elasticsearch, numpy, zmq) and create the default ES connection
+    :param connect: create the ES connection too, serve.py imports the code before fork and connects in each worker
+    """
+    global get_response, es_connected
+    with _load_lock:
+        if get_response is None:
+            with startup_phase("search_backend"):
+                from evaluate import get_response as evaluate_get_response
+                if args.encoder != "zmq":
+                    from embedding_service.provider import make_provider
+                    from evaluate import use_encoder
+                    use_encoder(make_provider(args.encoder))
+            get_response = evaluate_get_response
+        if connect and not es_connected:
+            es_connection.connect(es_connection.config_from_args(args))
+            es_connected = True
+
+
+def close_search_backend() -> None:
+    """
+    close the ES connections of this process, called by serve.py before fork
+    """
+    global es_connected
+    with _load_lock:
+        es_connection.disconnect_all()
+        es_connected = False
+
+
+def get_spell_corrector():
+    global sc
+    if sc is None:
+        with _load_lock:
+            if sc is None:
+                with startup_phase("spell_corrector"):
+                    from spell_corrector import SpellCorrector
+                    sc = SpellCorrector()
+    return sc
+
+
+def get_suggester():
+    global suggester
+    if suggester is None:
+        with _load_lock:
+            if suggester is None:
+                with startup_phase("suggester"):
+                    from suggest import load_suggester
+                    suggester = load_suggester(args.suggest_index)
+    return suggester
+
+
+def warm_up(report: bool = False, connect: bool = True) -> None:
+    """
+    load everything the first requests need, run in a background thread by __main__ so the app accepts requests at once,
+    and before fork by serve.py so the workers share the loaded vocabulary
+    :param connect: create the ES connection, see load_search_backend
+    """
+    with startup_phase("warm_up"):
+        load_search_backend(connect)
+        get_spell_corrector()
+        get_suggester()
+    if report:
+        print(startup_report())
+
+
+def enable_async_io(config=None) -> None:
+    """
+    route the ES and embedding calls of this process through an asyncio loop, must be called after fork
+    :param config: es_service.connection.ESConfig of the ES client, default from args
+    """
+    global io_loop, async_searcher
+    from async_search import IOLoop, AsyncSearcher
+    io_loop = IOLoop().start()
+    async_searcher = AsyncSearcher(config or es_connection.config_from_args(args))
+
+
+def enable_result_cache(max_mb: float = 64, ttl: float = 600, warm_up: bool = True) -> None:
+    """
+    cache the /results searches, the cache is dropped when the index behind args.index_name changes (e.g. an alias is switched)
+    :param warm_up: run the pa5_queries.json queries in the background to pre-populate the cache
+    """
+    global result_cache
+
+    def index_version() -> str:
+        load_search_backend()
+        from run_cache import get_index_version
+        return get_index_version(args.index_name)
+
+    result_cache = ResultCache(max_bytes=int(max_mb * 1024 * 1024), ttl=ttl, index_version=index_version)
+    if warm_up:
+        threading.Thread(target=warm_result_cache, name="cache-warm-up", daemon=True).start()
+
+
+def is_complete(doc_result) -> bool:
+    # a fallback or partial ranking is not cached, the next search tries the full one again
+    return degraded_reason(doc_result) is None
+
+
+def warm_result_cache(queries_path: str = "pa5_data/pa5_queries.json") -> None:
+    for query in load_topic_queries(queries_path).values():
+        for query_text in (query["kw"], query["nl"]):
+            key = ResultCache.make_key(query_text, "english_analyzer", "bm25", "relevance", None, None)
+            try:
+                result_cache.get_or_compute(key, lambda: search_results(query_text, "english_analyzer", "bm25", "relevance", None, None),
+                                            cacheable=is_complete)
+            except Exception as e:
+                print("Cache warm-up failed:", e)
+                return
+
+
+def get_doc_fetcher():
+    # created on first use, args.index_name is only known once the command line (or serve.py) has set args
+    global doc_fetcher
+    if doc_fetcher is None:
+        load_search_backend()
+        from doc_fetcher import DocFetcher
+        from doc_store import DocStore
+        doc_fetcher = DocFetcher(args.index_name, max_mb=args.doc_cache_mb, store=DocStore(args.doc_store) if args.doc_store else None)
+    return doc_fetcher
+
+
+def prefetch_page(doc_results, page_num: int) -> None:
+    """
+    load the documents listed on the given result page in the background, so that clicking one is served from memory
+    """
+    if args.no_prefetch:
+        return
+    get_doc_fetcher().prefetch([each[0] for each in doc_results[(page_num - 1) * page_limit:page_num * page_limit]])
+
+
+def run_search(query_text: str, english_analyzer: bool, search_type: str, embed_type: str):
+    budget = Budget(args.budget_ms, args.fallback_ms, args.terminate_after) if args.budget_ms else None
+    if async_searcher is not None:
+        # the budget bounds every call of the search, the timeout only guards against a stuck loop
+        timeout = args.budget_ms / 1000 + 1 if budget is not None else None
+        return io_loop.run(async_searcher.get_response(args.index_name, query_text, english_analyzer, search_type, embed_type, args.top_k, args.debug,
+                                                       budget=budget), timeout)
+    load_search_backend()
+    return get_response(args.index_name, query_text, english_analyzer, search_type, embed_type, args.top_k, args.debug, budget=budget)
+
+
+REQUEST_LATENCY = REGISTRY.histogram("http_request_latency_seconds", "latency of each request", ["route"])
+REQUESTS = REGISTRY.counter("http_requests_total", "number of requests", ["route", "status"])
+
+
+@app.before_request
+def start_request_timer():
+    g.start_time = time.perf_counter()
+    if args.profile_slow_ms is not None:
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+
+@app.after_request
+def record_request(response):
+    elapsed = time.perf_counter() - g.start_time
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    REQUEST_LATENCY.observe(elapsed, route=route)
+    REQUESTS.inc(route=route, status=str(response.status_code))
+
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profiler.disable()
+        if elapsed * 1000 >= args.profile_slow_ms:
+            # dump the profile of slow requests, inspect with `python -m pstats <file>` or snakeviz
+            os.makedirs(args.profile_dir, exist_ok=True)
+            name = route.strip("/").replace("/", "_").replace("<", "").replace(">", "") or "home"
+            profiler.dump_stats(os.path.join(args.profile_dir, f"{name}_{int(time.time() * 1000)}_{int(elapsed * 1000)}ms.prof"))
+    return response
+
+
+# clients of the embedding servers scraped by /metrics, kept across the scrapes
+_metrics_clients = {}
+_metrics_lock = threading.Lock()
+
+
+# metrics page in the Prometheus text format
+@app.route("/metrics")
+def metrics():
+    from embedding_service.client import EmbeddingClient
+    es_connection.update_pool_metrics()
+    text = REGISTRY.render()
+    with _metrics_lock:
+        for embedding_type in INV_PORT_EMBEDDING_MAPPING:
+            # queue wait and compute time reported by the embedding servers that are up
+            if embedding_type not in _metrics_clients:
+                _metrics_clients[embedding_type] = EmbeddingClient(host="localhost", embedding_type=embedding_type)
+            server_metrics = _metrics_clients[embedding_type].metrics()
+            if server_metrics:
+                text += server_metrics
+    return Response(text, mimetype="text/plain; version=0.0.4")
 
 
 # home page
@@ -31,6 +265,54 @@ def back_to_home():
     return render_template("test.html")
 
 
+def search_results(query_text: str, analyzer_type: str, embed_type: str, sort_type: str, custom_date_top, custom_date_bottom):
+    """
+    run the search of the result page, then sort and filter the hits by date
+    :return: a list of (id, score, title, snippet, date) of the matching articles
+    """
+    search_type = 'vector' if embed_type=='bm25' else 'rerank'
+    english_analyzer = (analyzer_type == "english_analyzer")
+    response = run_search(query_text, english_analyzer, search_type, embed_type)
+    reason = degraded_reason(response)
+    doc_result = [(hit.meta.id, round(hit.meta.score,4), hit.title, hit.content[:200]+'......', hit.date) for hit in response]
+    if sort_type == "date":
+        doc_result.sort(key = lambda x: x[4])
+
+    with span("date_filtering"):
+        if custom_date_top is not None and len(custom_date_top.strip()) > 0:
+            try:
+                start_date = datetime.strptime(custom_date_top.strip(), '%Y/%m/%d')
+                doc_result = [each for each in doc_result if datetime.strptime(each[4], '%Y/%m/%d') >= start_date]
+            except ValueError as e:
+                print('Value Error')
+        if custom_date_bottom is not None and len(custom_date_bottom.strip()) > 0:
+            try:
+                end_date = datetime.strptime(custom_date_bottom.strip(), '%Y/%m/%d')
+                doc_result = [each for each in doc_result if datetime.strptime(each[4], '%Y/%m/%d') <= end_date]
+            except ValueError as e:
+                print('Value Error')
+
+    return Degraded(doc_result, reason) if reason else doc_result
+
+
+# completions of the query being typed, ranked by corpus frequency of the completed word
+@app.route("/suggest")
+def suggest():
+    query_text = request.args.get("q", "")
+    if "k" in request.args and request.args.get("k", type=int) is None:
+        return jsonify({"error": "k must be an integer"}), 400
+    k = request.args.get("k", 10, type=int)
+    index = get_suggester()
+    k = max(1, min(k, index.top_k))  # the index precomputes top_k completions per prefix
+    head, _, last = query_text.lower().rpartition(" ")
+    if not last:
+        return jsonify({"query": query_text, "suggestions": []})
+    with span("suggest"):
+        completions = index.suggest(last, k)
+    prefix = head + " " if head else ""
+    return jsonify({"query": query_text, "suggestions": [prefix + word for word, _ in completions]})
+
+
 # result page
 @app.route("/results", methods=["POST"])
 def results():
@@ -49,7 +331,6 @@ def results():
     sort_type = request.form['true_sorting'] if 'true_sorting' in request.form else 'relevance'
     analyzer_type = request.form['true_analyzer'] if 'true_analyzer' in request.form else 'english_analyzer'
     embed_type = request.form['true_embedding'] if 'true_embedding' in request.form else 'bm25'
-    search_type = 'vector' if embed_type=='bm25' else 'rerank'
     if args.debug:
         print(analyzer_type)
         print(embed_type)
@@ -57,25 +338,12 @@ def results():
         print(custom_date_top, custom_date_bottom)
         print()
 
-    english_analyzer = (analyzer_type == "english_analyzer")
-    response = get_response(args.index_name, query_text, english_analyzer, search_type, embed_type, args.top_k, args.debug)
-    doc_result = [(hit.meta.id, round(hit.meta.score,4), hit.title, hit.content[:200]+'......', hit.date) for hit in response]
-    if sort_type == "date":
-        doc_result.sort(key = lambda x: x[4])
-
-    print(type(custom_date_top), len(custom_date_top.strip()))
-    if custom_date_top is not None and len(custom_date_top.strip()) > 0:
-        try:
-            start_date = datetime.strptime(custom_date_top.strip(), '%Y/%m/%d')
-            doc_result = [each for each in doc_result if datetime.strptime(each[4], '%Y/%m/%d') >= start_date]
-        except ValueError as e:
-            print('Value Error')
-    if custom_date_bottom is not None and len(custom_date_bottom.strip()) > 0:
-        try:
-            end_date = datetime.strptime(custom_date_bottom.strip(), '%Y/%m/%d')
-            doc_result = [each for each in doc_result if datetime.strptime(each[4], '%Y/%m/%d') <= end_date]
-        except ValueError as e:
-            print('Value Error')
+    if result_cache is not None:
+        key = ResultCache.make_key(query_text, analyzer_type, embed_type, sort_type, custom_date_top, custom_date_bottom)
+        doc_result = result_cache.get_or_compute(
+            key, lambda: search_results(query_text, analyzer_type, embed_type, sort_type, custom_date_top, custom_date_bottom), cacheable=is_complete)
+    else:
+        doc_result = search_results(query_text, analyzer_type, embed_type, sort_type, custom_date_top, custom_date_bottom)
 
     if args.debug:
         print(args.top_k, query_text)
@@ -84,19 +352,23 @@ def results():
     recommend = []
     changed = 0
 
-    for each in query_token:
-        if sc.correct(each) == each:
-            recommend.append(each)
-        else:
-            changed = 1
-            recommend.append(sc.correct(each))
+    with span("spell_correction"):
+        for each in query_token:
+            corrected = get_spell_corrector().correct(each)
+            if corrected == each:
+                recommend.append(each)
+            else:
+                changed = 1
+                recommend.append(corrected)
     if args.debug: print(recommend)
     recommend = ' '.join(recommend)
+    prefetch_page(doc_result, page_num)
 
     doc_json ={"page_limit":page_limit, "query_text":str(query_text), "page_num":int(page_num), "doc_results":doc_result, "changed":changed,
                "sort": sort_type, "total_number":len(doc_result), "analyzer":analyzer_type, "embedding": embed_type, "spell_correct":recommend,
-               "start_date":custom_date_top.strip(), "end_date":custom_date_bottom.strip()}
-    return render_template("results.html", data=doc_json)
+               "start_date":custom_date_top.strip(), "end_date":custom_date_bottom.strip(), "degraded": degraded_reason(doc_result)}
+    with span("template_rendering"):
+        return render_template("results.html", data=doc_json)
 
 
 # "next page" to show more results
@@ -129,6 +401,7 @@ def next_page(page_id):
                    "embedding": embed_type}
         return render_template('results.html', data=doc_json)
     else:
+        prefetch_page(doc_results, page_id)
         doc_json ={"page_limit":page_limit,
                    "query_text":str(query_text),
                    "page_num":int(page_id),
@@ -147,18 +420,20 @@ def next_page(page_id):
 def doc_data(doc_id):
     if args.debug: print(doc_id)
 
-    search = Search(using="default", index=args.index_name).query(Ids(values=[doc_id]))
-    results = search.execute()
-    doc_result = [(hit.title, hit.author, hit.date, hit.content) for hit in results][0]
-
-    doc_content ={"title":str(doc_result[0]), "author":str(doc_result[1]), "date":str(doc_result[2]), "content": str(doc_result[3])}
+    # direct get of the displayed fields only, usually already loaded by the prefetch of the result page
+    with span("document_fetch"):
+        doc_content = get_doc_fetcher().get(str(doc_id))
+    if doc_content is None:
+        return "Document not found", 404
     return render_template("doc.html", data=doc_content)
 
 
+STARTUP_PHASES["imports"] = time.perf_counter() - _import_start
+STARTUP_SECONDS.set(STARTUP_PHASES["imports"], phase="imports")
+
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Elasticsearch IR system") # creating arguments
-    parser.add_argument("--index_name", required=False, type=str, default="wapo_docs_50k", help="name of the ES index")
-    parser.add_argument("--top_k", required=False, type=int, default=10000, help="evaluate on top k ranked documents")
-    parser.add_argument("--debug", action='store_true', help="debug mode activated")
-    args = parser.parse_args()
+    args = build_parser().parse_args()
+    threading.Thread(target=warm_up, args=(args.startup_report,), name="warm-up", daemon=True).start()
+    if not args.no_result_cache:
+        enable_result_cache(args.cache_mb, args.cache_ttl, warm_up=not args.no_warm_up)
     app.run(debug=True, port=5000)
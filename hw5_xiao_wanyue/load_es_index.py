@@ -1,7 +1,10 @@
 import argparse
 import time
-from typing import List, Dict, Union, Iterator
+from typing import List, Dict, Optional, Union, Iterator
+from es_service.connection import ESConfig, add_arguments, config_from_args
 from es_service.index import ESIndex
+from doc_store import build_store
+from topic_index import TopicIndexBuilder
 from utils import load_clean_wapo_with_embedding
 import logging
 
@@ -15,14 +18,15 @@ class IndexLoader:
     load document index to Elasticsearch
     """
 
-    def __init__(self, index, docs):
+    def __init__(self, index, docs, config: Optional[ESConfig] = None):
         self.index_name = index
         self.docs: Union[Iterator[Dict], List[Dict]] = docs
+        self.config = config
 
     def load(self) -> None:
         st = time.time()
         logger.info(f"Building index ...")
-        ESIndex(self.index_name, self.docs)
+        ESIndex(self.index_name, self.docs, self.config)
         logger.info(
             f"=== Built {self.index_name} in {round(time.time() - st, 2)} seconds ===")
 
@@ -38,9 +42,23 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--index_name", required=True, type=str, help="name of the ES index")
     parser.add_argument("--wapo_path", required=True, type=str, help="path to the processed wapo jsonline file")
+    parser.add_argument("--topic_index", required=False, type=str, default=None, help="also build the inverted index of the dominant LDA topics in this directory")
+    parser.add_argument("--doc_store", required=False, type=str, default=None, help="also record the byte offsets of the documents in the corpus file in this directory (see doc_store.py)")
+    add_arguments(parser)
     args = parser.parse_args()
     idx_loader = IndexLoader.from_docs_jsonl(args.index_name, args.wapo_path)
+    idx_loader.config = config_from_args(args)
+    if args.topic_index:
+        builder = TopicIndexBuilder()
+        idx_loader.docs = builder.tap(idx_loader.docs)
     idx_loader.load()
+    if args.topic_index:
+        topic_index = builder.build()
+        topic_index.save(args.topic_index)
+        logger.info(f"=== Built the topic index of {len(topic_index.doc_ids)} documents over {topic_index.n_topics} topics ===")
+    if args.doc_store:
+        n_docs = build_store(args.wapo_path, args.doc_store)
+        logger.info(f"=== Built the doc store of {n_docs} documents ===")
 
 if __name__ == "__main__":
     main()
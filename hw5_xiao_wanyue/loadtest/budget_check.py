@@ -0,0 +1,70 @@
+#! /usr/bin/env python
+
+"""
+check that a search with a latency budget returns within the budget when ES hangs
+an ES stand-in whose searches never answer in time is started in-process, budgeted BM25 searches are sent to it through
+the blocking client (evaluate.budgeted_response) and the asyncio client (async_search.AsyncSearcher), and each must give
+up within the budget after a single ES request (no retries)
+
+python -m loadtest.budget_check --budget_ms 500 --fallback_ms 100
+"""
+import argparse
+import sys
+import threading
+import time
+
+from budget import Budget, degraded_reason
+from es_service.connection import ESConfig, connect
+from loadtest.es_standin import Handler, StandInIndex, serve
+
+INDEX_NAME = "hanging"
+
+
+def timed(name: str, search, budget_ms: float, slack_ms: float) -> bool:
+    """
+    run search(), report its time and ES requests and whether it stayed within budget_ms + slack_ms with one request
+    """
+    requests = Handler.search_requests
+    start = time.perf_counter()
+    response = search()
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    requests = Handler.search_requests - requests
+    ok = elapsed_ms <= budget_ms + slack_ms and requests == 1
+    print(f"{name:<8} {elapsed_ms:7.1f} ms  {requests} ES request(s)  degraded: {degraded_reason(response)}  {'ok' if ok else 'FAILED'}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="budgeted searches against a hanging ES")
+    parser.add_argument("--budget_ms", required=False, type=float, default=500, help="total budget of each search")
+    parser.add_argument("--fallback_ms", required=False, type=float, default=100, help="part of the budget kept for the BM25 fallback")
+    parser.add_argument("--slack_ms", required=False, type=float, default=50, help="tolerated overshoot of the budget")
+    parser.add_argument("--port", required=False, type=int, default=9299, help="port of the hanging ES stand-in")
+    args = parser.parse_args()
+
+    import evaluate
+    from async_search import AsyncSearcher, IOLoop
+
+    doc = {"id": "1", "title": "budget check", "content": "budget check", "ft_vector": [0.0], "sbert_vector": [0.0]}
+    server = serve([StandInIndex(INDEX_NAME, [doc])], port=args.port, search_delay=30.0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    config = ESConfig(hosts=(f"localhost:{args.port}",))
+    connect(config)
+
+    def budget() -> Budget:
+        return Budget(args.budget_ms, args.fallback_ms)
+
+    ok = timed("sync", lambda: evaluate.budgeted_response(budget(), INDEX_NAME, "budget check", False, "vector", "bm25", 10),
+               args.budget_ms, args.slack_ms)
+    loop = IOLoop().start()
+    searcher = AsyncSearcher(config)
+    ok &= timed("async", lambda: loop.run(searcher.get_response(INDEX_NAME, "budget check", False, "vector", "bm25", 10, budget=budget())),
+                args.budget_ms, args.slack_ms)
+    loop.run(searcher.close())
+    loop.stop()
+    server.shutdown()
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
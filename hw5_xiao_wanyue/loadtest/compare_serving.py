@@ -0,0 +1,48 @@
+#! /usr/bin/env python
+
+"""
+compare the throughput of several deployments of the app, e.g. the Flask development server against serve.py
+each deployment is driven at increasing arrival rates and the achieved QPS and p50/p99 latency of /results are reported
+
+python -m loadtest.compare_serving --urls dev=http://127.0.0.1:5000 prod=http://127.0.0.1:8000 --rates 10 25 50 100
+"""
+import argparse
+import json
+
+import numpy as np  # type: ignore
+
+from loadtest.load_generator import LoadGenerator, Mode, load_query_mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description="throughput comparison of app deployments")
+    parser.add_argument("--urls", required=True, type=str, nargs="+", help="name=url of each deployment")
+    parser.add_argument("--rates", required=False, type=float, nargs="+", default=[10, 25, 50, 100], help="arrival rates to test")
+    parser.add_argument("--duration", required=False, type=float, default=20.0, help="duration of each step in seconds")
+    parser.add_argument("--concurrency", required=False, type=int, default=256, help="maximum number of in-flight requests")
+    parser.add_argument("--embedding", required=False, type=str, default="bm25", help="embedding mode of the /results requests")
+    parser.add_argument("--output", required=False, type=str, default=None, help="write the table to this json file")
+    args = parser.parse_args()
+
+    queries = load_query_mix()
+    rows = []
+    print(f"{'deployment':12s} {'rate':>7s} {'qps':>8s} {'errors':>7s} {'p50 ms':>9s} {'p99 ms':>9s}")
+    for item in args.urls:
+        name, url = item.split("=", 1)
+        for rate in args.rates:
+            generator = LoadGenerator(url, queries, [Mode("english_analyzer", args.embedding)], {"results": 1.0}, n_docs=1)
+            wall_time = generator.run(rate, args.duration, args.concurrency)
+            ok = np.asarray([s.latency_ms for s in generator.samples if s.ok])
+            row = {"deployment": name, "rate": rate, "qps": len(ok) / wall_time, "errors": len(generator.samples) - len(ok),
+                   "p50_ms": float(np.percentile(ok, 50)) if len(ok) else None, "p99_ms": float(np.percentile(ok, 99)) if len(ok) else None}
+            rows.append(row)
+            p50 = f"{row['p50_ms']:9.1f}" if row["p50_ms"] is not None else f"{'-':>9s}"
+            p99 = f"{row['p99_ms']:9.1f}" if row["p99_ms"] is not None else f"{'-':>9s}"
+            print(f"{name:12s} {rate:7.1f} {row['qps']:8.2f} {row['errors']:7d} {p50} {p99}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
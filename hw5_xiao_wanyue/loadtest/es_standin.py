@@ -0,0 +1,237 @@
+#! /usr/bin/env python
+
+"""
+local stand-in for Elasticsearch used by the load tests
+it serves the subset of the REST API used by this project (search with match / match_phrase / ids / script_score / bool,
+get by id, mget, msearch and index settings) over docs loaded from a wapo jsonline file, so that the Flask app and
+evaluate.py can run without an ES cluster.
+the match queries are scored by the in-process BM25 of bm25_index.py (Lucene's BM25 and its approximation of the ES analyzers).
+
+python -m loadtest.es_standin --wapo_path pa5_data/wapo_test.jl --index_name wapo_docs_50k --replicate 1000
+"""
+from typing import Any, Dict, List, Optional, Tuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import argparse
+import json
+import re
+import time
+import uuid
+
+import numpy as np  # type: ignore
+
+from bm25_index import FieldIndex
+from utils import load_clean_wapo_with_embedding
+
+SCRIPT_FIELD_RE = re.compile(r"cosineSimilarity\(params\.query_vector,\s*'(\w+)'\)\s*\+\s*([0-9.]+)")
+
+
+class StandInIndex(object):
+    # text field -> uses the english analyzer, as in es_service.doc_template.BaseDoc
+    TEXT_FIELDS = {"content": False, "stemmed_content": True, "title": False, "author": False, "annotation": False}
+
+    def __init__(self, name: str, docs: List[Dict[str, Any]]):
+        self.name = name
+        self.uuid = uuid.uuid4().hex
+        self.created = str(int(time.time() * 1000))
+        self.docs = docs
+        self.fields = {field: FieldIndex.from_texts([d.get(field) or "" for d in docs], english) for field, english in self.TEXT_FIELDS.items()}
+        self.vectors = {}
+        for field in ("ft_vector", "sbert_vector"):
+            matrix = np.asarray([d[field] for d in docs], dtype=np.float32)
+            self.vectors[field] = matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+
+    @classmethod
+    def from_wapo(cls, name: str, wapo_path: str, replicate: int = 1) -> "StandInIndex":
+        docs = []
+        for _ in range(replicate):
+            for doc in load_clean_wapo_with_embedding(wapo_path):
+                # same fields as es_service.index.ESIndex._populate_doc
+                docs.append({"doc_id": doc["doc_id"], "title": doc["title"], "author": doc["author"], "content": doc["content_str"],
+                             "stemmed_content": doc["content_str"], "annotation": doc["annotation"], "date": doc["published_date"],
+                             "ft_vector": doc["ft_vector"], "sbert_vector": doc["sbert_vector"]})
+        return cls(name, docs)
+
+    def evaluate(self, query: Dict[str, Any]) -> Dict[int, float]:
+        """
+        evaluate a query DSL clause into {doc position: score}
+        """
+        (kind, body), = query.items()
+        if kind == "match_all":
+            return dict.fromkeys(range(len(self.docs)), 1.0)
+        if kind == "match":
+            (field, params), = body.items()
+            text = params["query"] if isinstance(params, dict) else params
+            scores = self.fields[field].score(text)
+            matched = np.flatnonzero(scores)
+            return dict(zip(matched.tolist(), scores[matched].tolist()))
+        if kind == "match_phrase":
+            (field, params), = body.items()
+            phrase = (params["query"] if isinstance(params, dict) else params).lower()
+            return {i: 1.0 for i, d in enumerate(self.docs) if phrase in (d.get(field) or "").lower()}
+        if kind == "ids":
+            return {int(i): 1.0 for i in body["values"] if 0 <= int(i) < len(self.docs)}
+        if kind == "script_score":
+            matched = self.evaluate(body["query"])
+            field, offset = SCRIPT_FIELD_RE.search(body["script"]["source"]).groups()
+            q = np.asarray(body["script"]["params"]["query_vector"], dtype=np.float32)
+            q /= max(float(np.linalg.norm(q)), 1e-12)
+            ids = np.fromiter(matched.keys(), dtype=np.int64, count=len(matched))
+            sims = self.vectors[field][ids] @ q + float(offset)
+            return dict(zip(ids.tolist(), sims.tolist()))
+        if kind == "bool":
+            result: Optional[Dict[int, float]] = None
+            clauses = [(c, True) for c in body.get("must", [])] + [(c, False) for c in body.get("filter", [])]
+            for clause, scoring in clauses:
+                scores = self.evaluate(clause)
+                if not scoring:
+                    scores = dict.fromkeys(scores, 0.0)
+                result = scores if result is None else {i: s + scores[i] for i, s in result.items() if i in scores}
+            should = [self.evaluate(clause) for clause in body.get("should", [])]
+            if result is None:
+                result = {}
+                for scores in should:
+                    for i, s in scores.items():
+                        result[i] = result.get(i, 0.0) + s
+            else:
+                for scores in should:
+                    for i in result:
+                        result[i] += scores.get(i, 0.0)
+            return result
+        raise ValueError(f"query type {kind} is not supported by the stand-in")
+
+    def hit(self, i: int, score: Optional[float], source: Any = True) -> Dict[str, Any]:
+        hit = {"_index": self.name, "_type": "_doc", "_id": str(i), "_score": score}
+        if source is not False:
+            doc = self.docs[i]
+            if isinstance(source, (list, dict)):
+                includes = source if isinstance(source, list) else source.get("includes", list(doc))
+                excludes = [] if isinstance(source, list) else source.get("excludes", [])
+                doc = {k: v for k, v in doc.items() if k in includes and k not in excludes}
+            hit["_source"] = doc
+        return hit
+
+    def search(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        st = time.perf_counter()
+        scores = self.evaluate(body.get("query", {"match_all": {}}))
+        start, size = int(body.get("from", 0)), int(body.get("size", 10))
+        ranked: List[Tuple[int, float]] = sorted(scores.items(), key=lambda x: (-x[1], x[0]))[start: start + size]
+        hits = [self.hit(i, s, body.get("_source", True)) for i, s in ranked]
+        return {"took": int((time.perf_counter() - st) * 1000), "timed_out": False,
+                "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0},
+                "hits": {"total": {"value": len(scores), "relation": "eq"}, "max_score": ranked[0][1] if ranked else None, "hits": hits}}
+
+    def get(self, doc_id: str, source: Any = True) -> Optional[Dict[str, Any]]:
+        if not doc_id.isdigit() or int(doc_id) >= len(self.docs):
+            return None
+        return dict(self.hit(int(doc_id), None, source), _version=1, _seq_no=0, _primary_term=1, found=True)
+
+
+def _source_param(params: Dict[str, List[str]]) -> Any:
+    if "_source_includes" in params:
+        return params["_source_includes"][0].split(",")
+    if "_source" in params:
+        value = params["_source"][0]
+        return value.split(",") if value not in ("true", "false") else value == "true"
+    return True
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    indices: Dict[str, StandInIndex] = {}
+    search_delay = 0.0  # seconds every search waits before its reply, simulates an overloaded or hanging node
+    search_requests = 0
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status: int, body: Any = None, content_type: str = "application/json") -> None:
+        data = b"" if body is None else json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("X-Elastic-Product", "Elasticsearch")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(data)
+
+    def read_body(self) -> bytes:
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def not_found(self, what: str) -> None:
+        self.reply(404, {"error": {"type": "index_not_found_exception", "reason": f"no such index [{what}]"}, "status": 404})
+
+    def route(self) -> None:
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        parts = [p for p in url.path.split("/") if p]
+        body = self.read_body()
+        try:
+            if not parts:
+                return self.reply(200, {"name": "es-standin", "cluster_name": "standin", "tagline": "You Know, for Search",
+                                        "version": {"number": "7.10.2", "build_flavor": "default"}})
+            if parts[-1] in ("_search", "_msearch"):
+                Handler.search_requests += 1
+                time.sleep(self.search_delay)
+            if parts[0] == "_msearch" or (len(parts) == 2 and parts[1] == "_msearch"):
+                return self.msearch(parts[0] if len(parts) == 2 else None, body)
+            index = self.indices.get(parts[0])
+            if index is None:
+                return self.not_found(parts[0])
+            if len(parts) == 1:
+                return self.reply(200, {index.name: {}})
+            if parts[1] == "_search":
+                return self.reply(200, index.search(json.loads(body or b"{}")))
+            if parts[1] == "_settings":
+                return self.reply(200, {index.name: {"settings": {"index": {"uuid": index.uuid, "creation_date": index.created}}}})
+            if parts[1] == "_doc" and len(parts) == 3:
+                doc = index.get(parts[2], _source_param(params))
+                return self.reply(200, doc) if doc else self.reply(404, {"_index": index.name, "_id": parts[2], "found": False})
+            if parts[1] == "_mget":
+                request = json.loads(body or b"{}")
+                ids = request.get("ids") or [d["_id"] for d in request.get("docs", [])]
+                source = _source_param(params)
+                docs = [index.get(str(i), source) or {"_index": index.name, "_id": str(i), "found": False} for i in ids]
+                return self.reply(200, {"docs": docs})
+            self.reply(400, {"error": f"unsupported endpoint {url.path}"})
+        except (ValueError, KeyError, TypeError) as e:
+            self.reply(400, {"error": {"type": "parsing_exception", "reason": repr(e)}, "status": 400})
+
+    def msearch(self, default_index: Optional[str], body: bytes) -> None:
+        lines = [json.loads(line) for line in body.decode("utf-8").splitlines() if line.strip()]
+        responses = []
+        for header, request in zip(lines[::2], lines[1::2]):
+            name = header.get("index", default_index)
+            name = name[0] if isinstance(name, list) else name
+            index = self.indices.get(name)
+            responses.append(index.search(request) if index else {"error": f"no such index [{name}]", "status": 404})
+        self.reply(200, {"took": 0, "responses": responses})
+
+    do_GET = do_POST = do_PUT = do_HEAD = route
+
+
+def serve(indices: List[StandInIndex], host: str = "localhost", port: int = 9200, search_delay: float = 0.0) -> ThreadingHTTPServer:
+    Handler.indices = {index.name: index for index in indices}
+    Handler.search_delay = search_delay
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Elasticsearch stand-in for load tests")
+    parser.add_argument("--wapo_path", required=False, type=str, default="pa5_data/wapo_test.jl", help="wapo jsonline file to index")
+    parser.add_argument("--index_name", required=False, type=str, default="wapo_docs_50k", help="name of the index")
+    parser.add_argument("--replicate", required=False, type=int, default=1, help="index every doc this many times to enlarge the corpus")
+    parser.add_argument("--port", required=False, type=int, default=9200, help="port to listen on")
+    parser.add_argument("--search_delay", required=False, type=float, default=0.0, help="seconds each search waits before its reply")
+    args = parser.parse_args()
+    index = StandInIndex.from_wapo(args.index_name, args.wapo_path, args.replicate)
+    server = serve([index], port=args.port, search_delay=args.search_delay)
+    print(f"ES stand-in serving {len(index.docs)} docs as [{args.index_name}] on port {args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
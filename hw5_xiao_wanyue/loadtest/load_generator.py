@@ -0,0 +1,186 @@
+#! /usr/bin/env python
+
+"""
+open-loop load generator for the Flask search app (hw5.py)
+requests are sent at a Poisson arrival rate with a query mix built from pa5_queries.json and topics2018.xml,
+latency is measured from the scheduled send time so that a slow server cannot hide its queueing delay.
+
+typical local setup (each in its own shell, from hw5_xiao_wanyue/):
+python -m loadtest.es_standin --wapo_path pa5_data/wapo_test.jl --replicate 1000
+python -m loadtest.stub_embedding --embedding fasttext
+python -m loadtest.stub_embedding --embedding sbert
+python hw5.py --top_k 100
+python -m loadtest.load_generator --rate 20 --duration 60 --output load.json
+"""
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+import argparse
+import itertools
+import json
+import random
+import re
+import threading
+import time
+
+import numpy as np  # type: ignore
+
+from utils import load_topic_queries
+
+HISTOGRAM_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, float("inf")]
+ROUTES = ("results", "next_page", "doc_data")
+
+
+class Mode(NamedTuple):
+    analyzer: str
+    embedding: str
+
+    def __str__(self):
+        return f"{self.analyzer}/{self.embedding}"
+
+
+class Sample(NamedTuple):
+    route: str
+    mode: str
+    latency_ms: float
+    ok: bool
+
+
+def load_query_mix(queries_path: str = "pa5_data/pa5_queries.json", topics_path: str = "pa5_data/topics2018.xml") -> List[str]:
+    """
+    keyword and natural language queries of pa5_queries.json plus the titles and descriptions of the TREC topics
+    """
+    mix = []
+    for query in load_topic_queries(queries_path).values():
+        mix += [query["kw"], query["nl"]]
+    with open(topics_path, "r", encoding="utf-8") as f:
+        topics = f.read()
+    # topics2018.xml is not well-formed xml (unclosed <num>, multiple roots), so pick the fields with regexes
+    mix += [" ".join(t.split()) for t in re.findall(r"<title>(.*?)</title>", topics, re.S)]
+    mix += [" ".join(d.split()) for d in re.findall(r"<desc>\s*Description:(.*?)</desc>", topics, re.S)]
+    return [q for q in mix if q]
+
+
+class LoadGenerator(object):
+    def __init__(self, base_url: str, queries: List[str], modes: List[Mode], route_mix: Dict[str, float], n_docs: int,
+                 timeout: float = 30.0, seed: int = 0):
+        self.base_url = base_url.rstrip("/")
+        self.queries = queries
+        self.modes = modes
+        self.routes, weights = zip(*route_mix.items())
+        self.weights = np.asarray(weights, dtype=float) / sum(weights)
+        self.n_docs = n_docs
+        self.timeout = timeout
+        self.rng = random.Random(seed)
+        self.samples: List[Sample] = []
+        self.lock = threading.Lock()
+
+    def _request(self, route: str, mode: Mode) -> Tuple[str, Optional[bytes]]:
+        query = self.rng.choice(self.queries)
+        if route == "results":
+            form = {"query": query, "page_num": 1, "true_sorting": "relevance", "true_analyzer": mode.analyzer,
+                    "true_embedding": mode.embedding, "true_date_top": "", "true_date_bottom": ""}
+            return "/results", urlencode(form).encode("utf-8")
+        if route == "next_page":
+            # the app round-trips the result list of the first page through the form
+            doc_results = [(str(i), 1.0, f"title {i}", "content ......", "2012/01/01") for i in range(24)]
+            form = {"query": query, "total_number": len(doc_results), "sort": "relevance", "analyzer": mode.analyzer,
+                    "embedding": mode.embedding, "true_date_top": "", "true_date_bottom": "", "doc_results": repr(doc_results)}
+            return f"/results/{self.rng.randint(2, 3)}", urlencode(form).encode("utf-8")
+        return f"/doc_data/{self.rng.randrange(self.n_docs)}", None
+
+    def fire(self, route: str, mode: Mode, scheduled: float) -> None:
+        path, data = self._request(route, mode)
+        ok = True
+        try:
+            with urlopen(Request(self.base_url + path, data=data), timeout=self.timeout) as response:
+                response.read()
+        except (HTTPError, URLError, OSError):
+            ok = False
+        latency_ms = (time.perf_counter() - scheduled) * 1000
+        with self.lock:
+            self.samples.append(Sample(route, "-" if route == "doc_data" else str(mode), latency_ms, ok))
+
+    def run(self, rate: float, duration: float, concurrency: int) -> float:
+        """
+        send requests at a Poisson arrival rate for duration seconds
+        :return: the wall time until the last response
+        """
+        modes = itertools.cycle(self.modes)
+        np_rng = np.random.default_rng(self.rng.randrange(1 << 30))
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            start = time.perf_counter()
+            next_time = start
+            while next_time - start < duration:
+                delay = next_time - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                route = self.routes[np_rng.choice(len(self.routes), p=self.weights)]
+                pool.submit(self.fire, route, next(modes), next_time)
+                next_time += np_rng.exponential(1.0 / rate)
+        return time.perf_counter() - start
+
+
+def summarize(samples: List[Sample], wall_time: float) -> Dict[str, Dict[str, Any]]:
+    groups = defaultdict(list)
+    for sample in samples:
+        groups[f"{sample.route} {sample.mode}"].append(sample)
+    report = {}
+    for name, group in sorted(groups.items()):
+        latencies = np.asarray([s.latency_ms for s in group if s.ok])
+        counts, _ = np.histogram(latencies, bins=[0] + HISTOGRAM_BUCKETS_MS) if len(latencies) else (np.zeros(len(HISTOGRAM_BUCKETS_MS)), None)
+        report[name] = {
+            "requests": len(group),
+            "errors": sum(not s.ok for s in group),
+            "qps": len(group) / wall_time,
+            "p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+            "p95_ms": float(np.percentile(latencies, 95)) if len(latencies) else None,
+            "p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else None,
+            "histogram_ms": {f"le_{b}": int(c) for b, c in zip(HISTOGRAM_BUCKETS_MS, counts)},
+        }
+    return report
+
+
+def print_report(report: Dict[str, Dict[str, Any]]) -> None:
+    print(f"{'route / mode':50s} {'reqs':>6s} {'errs':>5s} {'qps':>8s} {'p50 ms':>9s} {'p95 ms':>9s} {'p99 ms':>9s}")
+    for name, r in report.items():
+        p = ["{:9.1f}".format(r[k]) if r[k] is not None else "{:>9s}".format("-") for k in ("p50_ms", "p95_ms", "p99_ms")]
+        print(f"{name:50s} {r['requests']:6d} {r['errors']:5d} {r['qps']:8.2f} {' '.join(p)}")
+        nonzero = ", ".join(f"{k[3:]}:{v}" for k, v in r["histogram_ms"].items() if v)
+        print(f"{'':50s} histogram (<= ms: count) {nonzero}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="load generator for the Flask search app")
+    parser.add_argument("--url", required=False, type=str, default="http://127.0.0.1:5000", help="base url of the app")
+    parser.add_argument("--rate", required=False, type=float, default=10.0, help="mean arrival rate in requests per second")
+    parser.add_argument("--duration", required=False, type=float, default=30.0, help="duration of the test in seconds")
+    parser.add_argument("--concurrency", required=False, type=int, default=64, help="maximum number of in-flight requests")
+    parser.add_argument("--analyzers", required=False, type=str, nargs="+", default=["english_analyzer", "standard_analyzer"])
+    parser.add_argument("--embeddings", required=False, type=str, nargs="+", default=["bm25", "ft_vector", "sbert_vector"])
+    parser.add_argument("--route_mix", required=False, type=str, default="results=0.6,next_page=0.2,doc_data=0.2",
+                        help="relative weight of each route")
+    parser.add_argument("--n_docs", required=False, type=int, default=6, help="doc ids requested from /doc_data are drawn from [0, n_docs)")
+    parser.add_argument("--seed", required=False, type=int, default=0)
+    parser.add_argument("--output", required=False, type=str, default=None, help="write the report to this json file")
+    args = parser.parse_args()
+
+    route_mix = {route: float(weight) for route, weight in (item.split("=") for item in args.route_mix.split(","))}
+    unknown = set(route_mix) - set(ROUTES)
+    if unknown:
+        raise ValueError(f"unknown routes {unknown}, choose from {ROUTES}")
+    modes = [Mode(a, e) for a in args.analyzers for e in args.embeddings]
+    generator = LoadGenerator(args.url, load_query_mix(), modes, route_mix, args.n_docs, seed=args.seed)
+    wall_time = generator.run(args.rate, args.duration, args.concurrency)
+    report = summarize(generator.samples, wall_time)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"rate": args.rate, "duration": args.duration, "concurrency": args.concurrency, "routes": report}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+#! /usr/bin/env python
+
+"""
+stub embedding server for load tests
+it speaks the same protocol on the same port as embedding_service.server but returns deterministic pseudo-random vectors
+instead of loading a model, so the app can be load tested without fastText or SBERT
+
+python -m loadtest.stub_embedding --embedding fasttext --latency_ms 2
+"""
+from typing import List, Any
+import argparse
+import hashlib
+import time
+
+import numpy as np  # type: ignore
+import zmq
+
+from embedding_service import INV_PORT_EMBEDDING_MAPPING
+from embedding_service.server import Server, ServerMetrics
+
+EMBEDDING_DIMS = {"fasttext": 300, "sbert": 768}
+
+
+class StubEmbedding:
+    def __init__(self, dim: int, latency_ms: float = 0.0) -> None:
+        """
+        :param dim: dimension of the vectors
+        :param latency_ms: simulated compute time per text
+        """
+        self.dim = dim
+        self.latency_ms = latency_ms
+
+    def _single_encode_text(self, text: str) -> np.array:
+        seed = int.from_bytes(hashlib.md5(text.encode("utf-8")).digest()[:4], "little")
+        return np.random.default_rng(seed).standard_normal(self.dim)
+
+    def encode(self, texts: List[str], pooling: Any = None, batch_size: int = 256) -> np.ndarray:
+        if self.latency_ms:
+            time.sleep(self.latency_ms * len(texts) / 1000)
+        return np.vstack([self._single_encode_text(text) for text in texts])
+
+
+class StubServer(Server):
+    def __init__(self, embedding, port, num_workers=4, latency_ms=0.0):
+        self.zmq_context = zmq.Context()
+        self.port = port
+        self.num_workers = num_workers
+        self.encoder = StubEmbedding(EMBEDDING_DIMS[embedding], latency_ms)
+        self.metrics = ServerMetrics(embedding)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--embedding", required=True, type=str, help="name of the embedding type")
+    parser.add_argument("--num_workers", required=False, type=int, default=4, help="number of workers on the server")
+    parser.add_argument("--latency_ms", required=False, type=float, default=0.0, help="simulated compute time per text")
+    args = parser.parse_args()
+    server = StubServer(embedding=args.embedding, port=INV_PORT_EMBEDDING_MAPPING[args.embedding], num_workers=args.num_workers,
+                        latency_ms=args.latency_ms)
+    server.start()
+
+
+if __name__ == "__main__":
+    main()
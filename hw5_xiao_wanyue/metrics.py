@@ -1,12 +1,20 @@
 """
 implementation of precision@k, averaged precison and NDCG@k
 for this assignment you only need to use NDCG@k
+the batch_eval function scores a matrix of runs x ranks at many cutoffs in one pass
 """
-from typing import Sequence, NamedTuple, List
+from typing import Sequence, NamedTuple, List, Dict, Tuple, Optional, Iterable, Any
+from functools import lru_cache
 import warnings
+import json
 import math
+import os
 import numpy as np  # type: ignore
 
+# judgments of the whole corpus, built from its annotation field on the first load_qrels and kept next to it
+QRELS_PATH = "./pa5_data/qrels.json"
+CORPUS_PATH = "./pa5_data/subset_wapo_50k_sbert_ft_filtered.jl"
+
 
 def precision(relevance: Sequence[int], k: int = 20) -> float:
     """
@@ -27,7 +35,9 @@ def average_precision(relevance: Sequence[int]) -> float:
     relevant_items = np.count_nonzero(relevance)
     if not relevant_items:
         return 0.0
-    return (sum(precision(relevance, k) for k, rel in enumerate(relevance, 1) if rel) / relevant_items)
+    hits = np.asarray(relevance) != 0
+    ranks = np.arange(1, len(hits) + 1)
+    return float(np.sum(np.cumsum(hits)[hits] / ranks[hits]) / relevant_items)
 
 
 def dcg(relevance: Sequence[int], k: int = 20) -> float:
@@ -35,8 +45,8 @@ def dcg(relevance: Sequence[int], k: int = 20) -> float:
     if relevance_len < k:
         warnings.warn(
             f"sequence length is smaller than k ({k})! Reset k to maximum sequence length ({relevance_len})", SyntaxWarning,)
-    top_k = relevance[:k]
-    return sum(rel / math.log2(i + 1) for i, rel in enumerate(top_k, 1))
+    top_k = np.asarray(relevance[:k], dtype=float)
+    return float(np.sum(top_k / np.log2(np.arange(2, len(top_k) + 2))))
 
 
 def ndcg(relevance: Sequence[int], idea_relevance: Sequence[int], k: int = 20) -> float:
@@ -47,7 +57,7 @@ def ndcg(relevance: Sequence[int], idea_relevance: Sequence[int], k: int = 20) -
     top_k = relevance[:k]
     ideal_relevance_len = len(idea_relevance)
     if ideal_relevance_len < k:
-        idea_relevance += [0] * (k - ideal_relevance_len)
+        idea_relevance = list(idea_relevance) + [0] * (k - ideal_relevance_len)
     idea_relevance = idea_relevance[:k]
 
     try:
@@ -67,9 +77,241 @@ class Score(NamedTuple):
         return cls(average_precision(relevance), precision(relevance, top_k), ndcg(relevance, idea_relevance, top_k),)
 
 
+class BatchScore(NamedTuple):
+    # scores of every run at every cutoff, each array has shape (n_runs, len(cutoffs))
+    cutoffs: np.ndarray
+    ap: np.ndarray
+    prec: np.ndarray
+    ndcg: np.ndarray
+
+    def at(self, k: int) -> "BatchScore":
+        """
+        select the scores at a single cutoff
+        :param k: one of the cutoffs the batch was evaluated on
+        :return: a BatchScore whose arrays have shape (n_runs,)
+        """
+        col = int(np.flatnonzero(self.cutoffs == k)[0])
+        return BatchScore(self.cutoffs[col], self.ap[:, col], self.prec[:, col], self.ndcg[:, col])
+
+
+def _to_matrix(rows: Sequence[Sequence[int]], width: int) -> np.ndarray:
+    """
+    right-pad (with 0) or truncate a list of relevance lists into a dense (n_rows, width) matrix
+    """
+    matrix = np.zeros((len(rows), width), dtype=float)
+    for i, row in enumerate(rows):
+        row = np.asarray(row[:width], dtype=float)
+        matrix[i, : len(row)] = row
+    return matrix
+
+
+def batch_eval(relevance: Sequence[Sequence[int]], idea_relevance: Sequence[Sequence[int]], cutoffs: Optional[Iterable[int]] = None) -> BatchScore:
+    """
+    vectorized equivalent of calling Score.eval(relevance[i][:k], idea_relevance[i], k) for every run i and cutoff k
+    :param relevance: the relevance score (0, 1, 2) of each run, one row per run, rows may have different lengths
+    :param idea_relevance: the ideal relevance of the topic of each run, one row per run
+    :param cutoffs: the cutoffs to evaluate on, default every k from 1 to the longest run
+    :return: a BatchScore holding AP, P@k and NDCG@k of every run at every cutoff
+    """
+    if len(relevance) != len(idea_relevance):
+        raise ValueError("`relevance` and `idea_relevance` should have the same number of runs")
+    max_k = max((len(row) for row in relevance), default=0)
+    cutoffs = np.arange(1, max_k + 1) if cutoffs is None else np.asarray(sorted(set(cutoffs)), dtype=int)
+    if cutoffs.size == 0 or cutoffs[0] < 1:
+        raise ValueError("cutoffs should be positive integers")
+    width = int(cutoffs[-1])
+    cols = cutoffs - 1
+
+    rel = _to_matrix(relevance, width)
+    ideal = _to_matrix(idea_relevance, width)
+    ranks = np.arange(1, width + 1)
+    discount = 1.0 / np.log2(ranks + 1)
+
+    hits = rel != 0
+    hit_count = np.cumsum(hits, axis=1)
+    prec = hit_count / ranks
+    # AP@k: mean of P@i over the relevant ranks i <= k
+    ap_sum = np.cumsum(np.where(hits, prec, 0.0), axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ap = np.where(hit_count > 0, ap_sum / np.maximum(hit_count, 1), 0.0)
+        dcg_k = np.cumsum(rel * discount, axis=1)
+        idcg_k = np.cumsum(ideal * discount, axis=1)
+        ndcg_k = np.where(idcg_k > 0, dcg_k / np.where(idcg_k > 0, idcg_k, 1.0), 0.0)
+    return BatchScore(cutoffs, ap[:, cols], prec[:, cols], ndcg_k[:, cols])
+
+
+class Qrels(object):
+    """
+    relevance judgments precomputed as doc_id -> (topic_id, grade) and topic_id -> ideal relevance, loaded once
+    """
+
+    def __init__(self, judgments: Dict[str, Tuple[str, int]], ideal_relevance: Dict[str, List[int]], complete: bool = False):
+        """
+        :param complete: the judgments cover every annotated document of the corpus, the annotation of the hits is then
+                         never parsed
+        """
+        self.judgments = judgments
+        self.ideal_relevance = ideal_relevance
+        self.complete = complete
+
+    @staticmethod
+    def parse_annotation(annotation: Optional[str]) -> Optional[Tuple[str, int]]:
+        """
+        parse an annotation in the format of topic_id-relevance
+        :param annotation: annotation field of a wapo doc, may be empty
+        :return: (topic_id, grade) or None if the document is not annotated
+        """
+        if not annotation:
+            return None
+        topic_id, _, grade = annotation.rpartition("-")
+        if not topic_id or not grade.isdigit():
+            return None
+        return topic_id, int(grade)
+
+    @classmethod
+    def from_docs(cls, docs: Iterable[Dict[str, Any]], ideal_relevance: Dict[str, List[int]]) -> "Qrels":
+        """
+        build the judgments from all the wapo docs of the corpus (e.g. the generator of utils.load_clean_wapo_with_embedding)
+        """
+        judgments = {}
+        for doc in docs:
+            judgment = cls.parse_annotation(doc.get("annotation"))
+            if judgment is not None:
+                judgments[doc["doc_id"]] = judgment
+        return cls(judgments, ideal_relevance, complete=True)
+
+    @classmethod
+    def from_corpus(cls, corpus_path: str, ideal_relevance: Dict[str, List[int]]) -> "Qrels":
+        """
+        build the judgments from the corpus jsonl file, only the doc_id and annotation of each line are decoded
+        """
+        from doc_store import LazyDoc
+
+        with open(corpus_path, "rb") as f:
+            return cls.from_docs((LazyDoc(line) for line in f), ideal_relevance)
+
+    @classmethod
+    def from_json(cls, qrels_path: str, ideal_relevance_path: str, complete: bool = True) -> "Qrels":
+        """
+        :param complete: the file holds the judgments of the whole corpus, as written by load_qrels
+        """
+        with open(ideal_relevance_path, "r") as f:
+            ideal_relevance = json.load(f)
+        with open(qrels_path, "r") as f:
+            judgments = {doc_id: (topic_id, grade) for doc_id, (topic_id, grade) in json.load(f).items()}
+        return cls(judgments, ideal_relevance, complete)
+
+    def to_json(self, qrels_path: str) -> None:
+        with open(qrels_path, "w") as f:
+            json.dump(self.judgments, f)
+
+    def grade(self, doc_id: str, topic_id: str, annotation: Optional[str] = None) -> int:
+        """
+        relevance grade of a document for a topic, falls back to the annotation if the document is not in incomplete qrels
+        """
+        judgment = self.judgments.get(doc_id)
+        if judgment is None and not self.complete:
+            judgment = self.parse_annotation(annotation)
+        if judgment is None or judgment[0] != topic_id:
+            return 0
+        return judgment[1]
+
+    def relevance(self, doc_ids: Sequence[str], topic_id: str) -> List[int]:
+        return [self.grade(doc_id, topic_id) for doc_id in doc_ids]
+
+    def relevance_of_hits(self, response: Iterable[Any], topic_id: str) -> List[int]:
+        """
+        relevance grades of ES hits, each hit should have the doc_id and annotation fields
+        """
+        return [self.grade(getattr(hit, "doc_id", None), topic_id, getattr(hit, "annotation", None)) for hit in response]
+
+    def eval_runs(self, runs: Sequence[Tuple[str, Sequence[str]]], cutoffs: Optional[Iterable[int]] = None) -> BatchScore:
+        """
+        score many runs at once
+        :param runs: (topic_id, ranked doc ids) of each run
+        :param cutoffs: cutoffs to evaluate on, see batch_eval
+        :return: a BatchScore with one row per run
+        """
+        relevance = [self.relevance(doc_ids, topic_id) for topic_id, doc_ids in runs]
+        ideal = [self.ideal_relevance[topic_id] for topic_id, _ in runs]
+        return batch_eval(relevance, ideal, cutoffs)
+
+
+@lru_cache(maxsize=None)
+def load_qrels(ideal_relevance_path: str = "./pa5_data/ideal_relevance.json", qrels_path: str = QRELS_PATH,
+               corpus_path: str = CORPUS_PATH) -> Qrels:
+    """
+    load the qrels once per process
+    :param ideal_relevance_path: path to ideal_relevance.json
+    :param qrels_path: doc_id -> (topic_id, grade) json written by Qrels.to_json, built from corpus_path (and written)
+                       if it is missing or older than the corpus
+    :param corpus_path: wapo jsonline file the judgments are built from; if neither file exists the grades are parsed
+                        from the annotation field of the hits
+    """
+    corpus_mtime = os.path.getmtime(corpus_path) if os.path.exists(corpus_path) else None
+    if os.path.exists(qrels_path) and (corpus_mtime is None or os.path.getmtime(qrels_path) >= corpus_mtime):
+        return Qrels.from_json(qrels_path, ideal_relevance_path)
+    with open(ideal_relevance_path, "r") as f:
+        ideal_relevance = json.load(f)
+    if corpus_mtime is None:
+        warnings.warn(f"neither {qrels_path} nor {corpus_path} exists, the relevance is parsed from the annotation of the hits")
+        return Qrels({}, ideal_relevance)
+    qrels = Qrels.from_corpus(corpus_path, ideal_relevance)
+    qrels.to_json(qrels_path)
+    return qrels
+
+
+def _reference_score(relevance: Sequence[int], idea_relevance: Sequence[int], k: int) -> Score:
+    """
+    the original loop implementation of Score.eval, kept as the reference of _parity_check
+    """
+    relevance = [int(rel) for rel in relevance]  # plain ints, a numpy grade divided by a zero IDCG gives inf instead of raising
+    def prec_at(i: int) -> float:
+        return sum(1 for rel in relevance[:i] if rel) / i
+
+    def dcg_at(rels: Sequence[int]) -> float:
+        return sum(rel / math.log2(i + 1) for i, rel in enumerate(rels[:k], 1))
+
+    relevant_items = sum(1 for rel in relevance if rel)
+    ap = sum(prec_at(i) for i, rel in enumerate(relevance, 1) if rel) / relevant_items if relevant_items else 0.0
+    ideal = [int(rel) for rel in idea_relevance] + [0] * max(0, k - len(idea_relevance))
+    try:
+        ndcg_k = dcg_at(relevance) / dcg_at(ideal)
+    except ZeroDivisionError:
+        ndcg_k = 0.0
+    return Score(ap, prec_at(k), ndcg_k)
+
+
+def _parity_check(n_runs: int = 200, max_len: int = 60, seed: int = 0) -> None:
+    """
+    check Score.eval and batch_eval against the reference loops on hand-computed cases and on random runs
+    """
+    # (relevance, ideal relevance, k, expected AP, P@k, NDCG@k): k beyond the hits, no relevant hit, no relevant doc at all
+    cases = [([2, 0, 1], [2, 1, 1], 5, (1 + 2 / 3) / 2, 2 / 5, 2.5 / (2 + 1 / math.log2(3) + 0.5)),
+             ([0, 0], [1], 3, 0.0, 0.0, 0.0),
+             ([1, 0], [], 2, 1.0, 0.5, 0.0)]
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for relevance, ideal, k, *expected in cases:
+            assert np.allclose(_reference_score(relevance, ideal, k), expected), (relevance, ideal, k)
+            assert np.allclose(Score.eval(relevance, ideal, k), expected), (relevance, ideal, k)
+            batch = batch_eval([relevance], [ideal], [k])
+            assert np.allclose([batch.ap[0, 0], batch.prec[0, 0], batch.ndcg[0, 0]], expected), (relevance, ideal, k)
+
+        rng = np.random.default_rng(seed)
+        relevance = [list(rng.choice(3, size=rng.integers(1, max_len), p=[0.6, 0.25, 0.15])) for _ in range(n_runs)]
+        ideal = [sorted(rng.choice(3, size=rng.integers(0, max_len)), reverse=True) for _ in range(n_runs)]
+        cutoffs = [1, 5, 10, 20, 50]
+        batch = batch_eval(relevance, ideal, cutoffs)
+        for i in range(n_runs):
+            for j, k in enumerate(cutoffs):
+                expected = _reference_score(relevance[i][:k], ideal[i], k)
+                assert np.allclose(Score.eval(relevance[i][:k], list(ideal[i]), k), expected), (i, k)
+                assert np.isclose(batch.ap[i, j], expected.ap), (i, k, "ap")
+                assert np.isclose(batch.prec[i, j], expected.prec), (i, k, "prec")
+                assert np.isclose(batch.ndcg[i, j], expected.ndcg), (i, k, "ndcg")
+    print(f"Score.eval and batch_eval match the reference on {len(cases)} hand-computed cases and {n_runs} runs x {len(cutoffs)} cutoffs")
+
+
 if __name__ == "__main__":
-    # rel = [3,3,3,2,2,1,0,0]
-    # true = [3,2,3,0,1,2]
-    # print(dcg(true, 6)/dcg(rel, 6))
-    # print(dcg(rel, 6))
-    pass
\ No newline at end of file
+    _parity_check()
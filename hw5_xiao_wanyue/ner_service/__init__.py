@@ -0,0 +1,2 @@
+# port of the NER server, next to the embedding servers (see embedding_service/__init__.py)
+NER_PORT = 8090
@@ -0,0 +1,69 @@
+"""
+NER client, same protocol as embedding_service.client
+"""
+from typing import List, Optional
+import itertools
+import json
+import time
+import uuid
+
+import zmq
+
+from budget import current as current_budget
+from ner_service import NER_PORT
+
+
+class NERServerError(Exception):
+    """
+    the server answered with an error instead of entities, e.g. "overloaded"
+    """
+
+
+class NERClient(object):
+    """
+    a client is meant to be kept and reused by one thread, the replies are matched to the requests by id so that the late
+    reply of a request that timed out is never taken for the reply of the next one
+    """
+
+    def __init__(self, host: str = "localhost", timeout_ms: float = 5000):
+        """
+        :param host: host of the NER server
+        :param timeout_ms: timeout of the requests sent outside of a budgeted search
+        """
+        self.timeout_ms = timeout_ms
+        self.zmq_context = zmq.Context()
+        self.socket = self.zmq_context.socket(zmq.DEALER)
+        self.socket.connect(f"tcp://{host}:{NER_PORT}")
+        self.identity = uuid.uuid4().hex[:8]
+        self.request_ids = itertools.count()
+
+    def tag(self, texts: List[str], timeout_ms: Optional[float] = None) -> List[List[str]]:
+        """
+        extract the named entities of each text
+        Raises TimeoutError if the server does not answer within timeout_ms, and NERServerError if it rejects the request.
+        :param timeout_ms: default the remaining time of the active budget.Budget (BudgetExceeded if none is left), or
+                           self.timeout_ms outside of a budgeted search
+        """
+        if not isinstance(texts, list):
+            raise ValueError("Argument `texts` should be List[str]")
+        if timeout_ms is None:
+            budget = current_budget()
+            timeout_ms = budget.check("the entity lookup") if budget is not None else self.timeout_ms
+        request_id = f"{self.identity}-{next(self.request_ids)}"
+        deadline = time.time() + timeout_ms / 1000
+        self.socket.send_string(json.dumps({"type": "tag", "id": request_id, "texts": texts, "deadline": deadline}))
+        while True:
+            if not self.socket.poll(max(0, int((deadline - time.time()) * 1000))):
+                self.socket.setsockopt(zmq.LINGER, 0)  # do not block terminate() on the unanswered request
+                raise TimeoutError(f"NER request not answered within {timeout_ms} ms")
+            frames = self.socket.recv_multipart()
+            if len(frames) == 2 and frames[0].decode("utf-8") == request_id:
+                break  # other replies are late ones of requests that timed out
+        result = json.loads(frames[1].decode("utf-8"))
+        if isinstance(result, dict) and "error" in result:
+            raise NERServerError(result["error"])
+        return result
+
+    def terminate(self):
+        self.socket.close()
+        self.zmq_context.term()
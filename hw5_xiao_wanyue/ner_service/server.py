@@ -0,0 +1,76 @@
+#! /usr/bin/env python
+
+"""
+NER server
+the tagger is loaded once and shared by all workers, it follows the same ROUTER/DEALER layout as embedding_service.server
+the workers mostly wait for the predict call batching their requests (see ner_service.tagger), so there are more of them
+than cores
+"""
+from typing import List
+import argparse
+import json
+import sys
+import time
+import logging
+
+import zmq
+
+from embedding_service.server import Server as EmbeddingServer, ServerMetrics, Worker as EmbeddingWorker
+from ner_service.tagger import NERTagger
+from ner_service import NER_PORT
+from instrumentation import REGISTRY
+
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(stream=sys.stdout)
+handler.setLevel(level=logging.INFO)
+logger.addHandler(handler)
+logger.setLevel(logging.INFO)
+
+
+class Server(EmbeddingServer):
+    def __init__(self, model, port, num_workers=8, batch_window_ms=2.0):
+        self.zmq_context = zmq.Context()
+        self.port = port
+        self.num_workers = num_workers
+        self.encoder = NERTagger(model_name=model, batch_window_ms=batch_window_ms)  # shared by the workers, named as in the embedding server
+        self.metrics = ServerMetrics("ner")
+
+    def make_worker(self, _id):
+        return Worker(self.zmq_context, self.encoder, _id, self.metrics)
+
+
+class Worker(EmbeddingWorker):
+    """
+    Workers accept tagging requests from front facing server.
+    """
+
+    def compute(self, request):
+        _type = request.get("type")
+        self.metrics.requests.inc(type=str(_type))
+        if _type == "tag":
+            st = time.perf_counter()
+            result = self.tag(request)
+            self.metrics.compute.observe(time.perf_counter() - st)
+            self.metrics.texts.inc(len(request["texts"]))
+            return result
+        if _type == "metrics":
+            return REGISTRY.render(prefix="embedding_")
+        return
+
+    def tag(self, data):
+        texts: List[str] = data["texts"]
+        return json.dumps(self.encoder.tag(texts))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", required=False, type=str, default="ner", help="name of the flair NER model")
+    parser.add_argument("--num_workers", required=False, type=int, default=8, help="number of workers on the server, at most this many requests share a batch")
+    parser.add_argument("--batch_window_ms", required=False, type=float, default=2.0, help="time a request waits for others to join its batch")
+    args = parser.parse_args()
+    server = Server(model=args.model, port=NER_PORT, num_workers=args.num_workers, batch_window_ms=args.batch_window_ms)
+    server.start()
+
+
+if __name__ == "__main__":
+    main()
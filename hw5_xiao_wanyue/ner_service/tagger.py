@@ -0,0 +1,102 @@
+"""
+wrapper for loading the flair NER model and tagging queries
+it will be called by the NER server
+the texts of the requests tagged concurrently by the server workers are batched into one predict call (micro-batching): the
+first request opens a batch and waits batch_window_ms for others to join it, then tags all their texts at once
+"""
+from typing import List, Dict, Optional
+from collections import OrderedDict
+from concurrent.futures import Future
+import threading
+import time
+
+from flair.data import Sentence
+from flair.models import SequenceTagger
+
+
+class _Batch(object):
+    """
+    texts of the requests waiting for the same predict call, the future gets the entities of each text
+    """
+
+    def __init__(self):
+        self.texts: "OrderedDict[str, None]" = OrderedDict()
+        self.future: "Future[Dict[str, List[str]]]" = Future()
+
+
+class NERTagger:
+    def __init__(self, model_name: str = "ner", cache_size: int = 10000, mini_batch_size: int = 32, batch_window_ms: float = 2.0) -> None:
+        """
+        wrapper for the flair sequence tagger (https://github.com/flairNLP/flair), the model is loaded once
+        :param model_name: pretrained flair model name
+        :param cache_size: number of query texts whose entities are kept in memory
+        :param mini_batch_size: batch size used by flair when tagging many texts at once
+        :param batch_window_ms: time a request waits for concurrent requests to join its predict call, 0 tags right away
+        """
+        self.tagger = SequenceTagger.load(model_name)
+        self.cache_size = cache_size
+        self.mini_batch_size = mini_batch_size
+        self.batch_window_ms = batch_window_ms
+        self.cache: "OrderedDict[str, List[str]]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.batch: Optional[_Batch] = None  # the batch open for new texts
+        print("Model loaded Successfully !")
+
+    def tag(self, texts: List[str]) -> List[List[str]]:
+        """
+        extract the named entities of each text, cached texts are not tagged again and the rest are tagged in one batch
+        :param texts: query texts
+        :return: a list of entity strings for each text
+        """
+        entities: Dict[str, List[str]] = {}
+        with self.lock:
+            for text in texts:
+                if text in self.cache:
+                    self.cache.move_to_end(text)  # least recently used first
+                    entities[text] = self.cache[text]
+        missing = [t for t in texts if t not in entities]
+        if missing:
+            entities.update(self.batched_predict(missing))
+        return [list(entities[text]) for text in texts]
+
+    def batched_predict(self, texts: List[str]) -> Dict[str, List[str]]:
+        """
+        tag texts in the batch of the concurrent requests, the request opening the batch runs its predict call
+        :return: the entities of each text (and of the other texts of the batch)
+        """
+        with self.lock:
+            batch = self.batch
+            leader = batch is None
+            if leader:
+                batch = self.batch = _Batch()
+            batch.texts.update(OrderedDict.fromkeys(texts))
+        if not leader:
+            return batch.future.result()
+        if self.batch_window_ms > 0:
+            time.sleep(self.batch_window_ms / 1000)
+        with self.lock:
+            self.batch = None  # the requests arriving from now on open the next batch
+        try:
+            batch.future.set_result(self.predict(list(batch.texts)))
+        except Exception as e:
+            batch.future.set_exception(e)
+        return batch.future.result()
+
+    def predict(self, texts: List[str]) -> Dict[str, List[str]]:
+        """
+        tag texts in one flair call and cache their entities
+        """
+        sentences = [Sentence(text) for text in texts]
+        self.tagger.predict(sentences, mini_batch_size=self.mini_batch_size)
+        entities = {text: [entity.text for entity in sentence.get_spans("ner")] for text, sentence in zip(texts, sentences)}
+        with self.lock:
+            for text, found in entities.items():
+                self.cache[text] = found
+                self.cache.move_to_end(text)
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return entities
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,201 @@
+"""
+multi-vector (paragraph level) retrieval
+every document is split into paragraphs of a few sentences (as for the sup_simCSE_para_* fields) and each paragraph gets its
+own vector. all the paragraph vectors are stored in one flat (paragraphs x dim) array, the paragraphs of document i are the
+rows doc_offsets[i]:doc_offsets[i + 1]. a document is scored by late interaction: the maximum cosine similarity between the
+query and its paragraphs.
+
+python paragraph_index.py --wapo_path pa5_data/wapo_docs.jl --output pa5_data/paragraph_index --embedding sbert
+set PARAGRAPH_INDEX_DIR to serve another index than the default one
+"""
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple
+import argparse
+import json
+import os
+import re
+import time
+
+import numpy as np  # type: ignore
+
+PARAGRAPH_INDEX_DIR = os.environ.get("PARAGRAPH_INDEX_DIR", "./pa5_data/paragraph_index")
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+def split_paragraphs(text: str, sentences_per_paragraph: int = 3) -> List[str]:
+    """
+    windows of consecutive sentences, the sentences are split on end punctuation followed by a space
+    """
+    sentences = [s for s in SENTENCE_END.split(text.strip()) if s]
+    return [" ".join(sentences[i:i + sentences_per_paragraph]) for i in range(0, len(sentences), sentences_per_paragraph)]
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.clip(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12, None)
+
+
+class ParagraphIndex(object):
+    def __init__(self, vectors: np.ndarray, doc_offsets: np.ndarray, doc_ids: np.ndarray, embedding: str):
+        """
+        :param vectors: (paragraphs x dim) unit vectors of all the paragraphs
+        :param doc_offsets: (documents + 1) start row of the paragraphs of each document
+        :param doc_ids: ES ids of the documents, sorted
+        :param embedding: embedding type (server) that encoded the paragraphs, the query must be encoded by the same one
+        """
+        self.vectors = vectors
+        self.doc_offsets = doc_offsets
+        self.doc_ids = doc_ids
+        self.embedding = embedding
+
+    @classmethod
+    def build(cls, docs: Iterable[Tuple[int, List[np.ndarray]]], embedding: str) -> "ParagraphIndex":
+        """
+        :param docs: (ES id, paragraph vectors) of each document, in increasing id order
+        """
+        doc_ids, counts, vectors = [], [], []
+        for doc_id, paragraph_vectors in docs:
+            doc_ids.append(doc_id)
+            counts.append(len(paragraph_vectors))
+            vectors.extend(paragraph_vectors)
+        doc_offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=doc_offsets[1:])
+        return cls(_normalize(np.asarray(vectors, dtype=np.float32)), doc_offsets, np.asarray(doc_ids, dtype=np.int64), embedding)
+
+    def save(self, index_dir: str) -> None:
+        os.makedirs(index_dir, exist_ok=True)
+        np.save(os.path.join(index_dir, "vectors.npy"), self.vectors)
+        np.save(os.path.join(index_dir, "doc_offsets.npy"), self.doc_offsets)
+        np.save(os.path.join(index_dir, "doc_ids.npy"), self.doc_ids)
+        with open(os.path.join(index_dir, "meta.json"), "w") as f:
+            json.dump({"embedding": self.embedding, "dim": int(self.vectors.shape[1])}, f)
+
+    @classmethod
+    def load(cls, index_dir: str) -> "ParagraphIndex":
+        """
+        the arrays are memory-mapped, the operating system keeps the hot part of the vectors in memory
+        """
+        with open(os.path.join(index_dir, "meta.json")) as f:
+            meta = json.load(f)
+        arrays = [np.load(os.path.join(index_dir, name), mmap_mode="r") for name in ("vectors.npy", "doc_offsets.npy", "doc_ids.npy")]
+        return cls(*arrays, embedding=meta["embedding"])
+
+    def rows_of(self, doc_ids: Sequence) -> np.ndarray:
+        """
+        :return: row of each ES id in doc_ids, -1 if the document is not in the index
+        """
+        ids = np.asarray([int(doc_id) for doc_id in doc_ids], dtype=np.int64)
+        rows = np.searchsorted(self.doc_ids, ids)
+        rows[rows == len(self.doc_ids)] = 0
+        found = len(self.doc_ids) > 0 and self.doc_ids[rows] == ids
+        return np.where(found, rows, -1)
+
+    def maxsim(self, query: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        late interaction score of documents: for each query vector the best matching paragraph, summed over the query vectors
+        :param query: (dim,) or (query vectors x dim)
+        :param rows: rows of the documents to score (e.g. from rows_of), default every document
+        :return: score of each document, -inf for documents without paragraphs
+        """
+        query = _normalize(np.atleast_2d(np.asarray(query, dtype=np.float32)))
+        if rows is None:
+            rows = np.arange(len(self.doc_ids))
+        order = np.argsort(rows, kind="stable")
+        sorted_rows = rows[order]
+        starts, ends = self.doc_offsets[sorted_rows], self.doc_offsets[sorted_rows + 1]
+        lengths = ends - starts
+        sims = np.empty((int(lengths.sum()), query.shape[0]), dtype=np.float32)
+
+        # one matrix product per run of adjacent documents instead of gathering the paragraphs into a copy
+        breaks = np.flatnonzero(starts[1:] != ends[:-1]) + 1
+        run_first = np.r_[0, breaks]
+        run_last = np.r_[breaks, len(sorted_rows)] - 1
+        out = 0
+        for first, last in zip(run_first, run_last):
+            lo, hi = starts[first], ends[last]
+            np.dot(self.vectors[lo:hi], query.T, out=sims[out:out + hi - lo])
+            out += hi - lo
+
+        scores = np.full(len(sorted_rows), -np.inf, dtype=np.float32)
+        nonempty = lengths > 0
+        if nonempty.any():
+            sim_starts = (np.cumsum(lengths) - lengths)[nonempty]
+            scores[nonempty] = np.maximum.reduceat(sims, sim_starts, axis=0).sum(axis=1)
+        result = np.empty_like(scores)
+        result[order] = scores
+        return result
+
+    def rerank(self, query: np.ndarray, doc_ids: Sequence) -> List[Tuple[str, float]]:
+        """
+        :return: (ES id, score) of the documents sorted by maxsim, documents missing from the index come last
+        """
+        rows = self.rows_of(doc_ids)
+        scores = np.full(len(rows), -np.inf, dtype=np.float32)
+        present = rows >= 0
+        if present.any():
+            scores[present] = self.maxsim(query, rows[present])
+        order = np.argsort(-scores, kind="stable")
+        return [(str(doc_ids[i]), float(scores[i])) for i in order]
+
+    def search(self, query: np.ndarray, k: int) -> List[Tuple[str, float]]:
+        """
+        standalone retrieval over the whole index
+        :return: (ES id, score) of the top k documents
+        """
+        scores = self.maxsim(query)
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(str(self.doc_ids[i]), float(scores[i])) for i in top if np.isfinite(scores[i])]
+
+
+def read_field(wapo_path: str, field: str, limit: Optional[int] = None) -> Iterator[Tuple[int, List[np.ndarray]]]:
+    """
+    paragraph vectors already computed offline, stored in the corpus as a list of vectors per document
+    """
+    from utils import load_clean_wapo_with_embedding
+
+    for i, doc in enumerate(load_clean_wapo_with_embedding(wapo_path)):
+        if limit is not None and i >= limit:
+            break
+        yield i, [np.asarray(vector, dtype=np.float32) for vector in doc.get(field) or []]
+
+
+def encode_corpus(wapo_path: str, embedding: str, sentences_per_paragraph: int = 3, limit: Optional[int] = None
+                  ) -> Iterator[Tuple[int, List[np.ndarray]]]:
+    """
+    split every document of the corpus into paragraphs and encode them with the embedding server
+    :return: (ES id, i.e. line number, paragraph vectors) of each document
+    """
+    from embedding_service.client import EmbeddingClient
+    from utils import load_clean_wapo_with_embedding
+
+    encoder = EmbeddingClient(host="localhost", embedding_type=embedding)
+    for i, doc in enumerate(load_clean_wapo_with_embedding(wapo_path)):
+        if limit is not None and i >= limit:
+            break
+        paragraphs = split_paragraphs(doc["content_str"], sentences_per_paragraph) or [doc["title"]]
+        yield i, list(encoder.encode(paragraphs, pooling="mean", batch_size=64))
+    encoder.terminate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="build the paragraph index of a corpus")
+    parser.add_argument("--wapo_path", required=True, type=str, help="path to the processed wapo jsonline file, in the order it was indexed")
+    parser.add_argument("--output", required=False, type=str, default=PARAGRAPH_INDEX_DIR, help="directory of the index")
+    parser.add_argument("--embedding", required=False, type=str, default="sbert", help="embedding server encoding the paragraphs")
+    parser.add_argument("--field", required=False, type=str, default=None, help="read precomputed paragraph vectors from this field instead of encoding")
+    parser.add_argument("--sentences_per_paragraph", required=False, type=int, default=3, help="sentences in each paragraph")
+    parser.add_argument("--limit", required=False, type=int, default=None, help="only index the first documents")
+    args = parser.parse_args()
+
+    st = time.time()
+    if args.field:
+        docs = read_field(args.wapo_path, args.field, args.limit)
+    else:
+        docs = encode_corpus(args.wapo_path, args.embedding, args.sentences_per_paragraph, args.limit)
+    index = ParagraphIndex.build(docs, args.embedding)
+    index.save(args.output)
+    print(f"Indexed {len(index.vectors)} paragraphs of {len(index.doc_ids)} documents in {time.time() - st:.2f} seconds")
+
+
+if __name__ == "__main__":
+    main()
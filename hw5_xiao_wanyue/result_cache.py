@@ -0,0 +1,135 @@
+"""
+in-memory cache of search results for the /results page
+entries are evicted least-recently-used once the cache exceeds its memory budget or once they are older than the ttl,
+and the whole cache is dropped when the index behind the index name (or alias) changes
+"""
+from typing import Any, Callable, Hashable, Optional, Tuple
+from collections import OrderedDict
+import sys
+import threading
+import time
+
+from instrumentation import REGISTRY
+
+CACHE_LOOKUPS = REGISTRY.counter("result_cache_lookups_total", "result cache lookups", ["cache", "result"])
+CACHE_BYTES = REGISTRY.gauge("result_cache_bytes", "estimated size of the cached results", ["cache"])
+
+
+def normalize_query(query_text: str) -> str:
+    return " ".join(query_text.lower().split())
+
+
+def estimate_size(obj: Any) -> int:
+    """
+    rough deep size of the cached values (lists and tuples of strings and numbers)
+    """
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (list, tuple)):
+        size += sum(estimate_size(item) for item in obj)
+    elif isinstance(obj, dict):
+        size += sum(estimate_size(k) + estimate_size(v) for k, v in obj.items())
+    return size
+
+
+class ResultCache(object):
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, ttl: float = 600.0, version_check_interval: float = 30.0,
+                 index_version: Optional[Callable[[], str]] = None, name: str = "results"):
+        """
+        :param max_bytes: memory budget of the cached values
+        :param ttl: seconds after which an entry expires
+        :param version_check_interval: seconds between two checks of the index version
+        :param index_version: returns the current version of the index, e.g. run_cache.get_index_version,
+                              a new version drops every entry
+        :param name: label of the cache in the metrics
+        """
+        self.name = name
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.version_check_interval = version_check_interval
+        self.index_version = index_version
+        self.entries: "OrderedDict[Hashable, Tuple[float, int, Any]]" = OrderedDict()
+        self.bytes = 0
+        self.version: Optional[str] = None
+        self.version_checked = 0.0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(query_text: str, analyzer: str, embedding: str, sort: str, start_date: Optional[str], end_date: Optional[str]) -> Tuple:
+        return normalize_query(query_text), analyzer, embedding, sort, (start_date or "").strip(), (end_date or "").strip()
+
+    def _check_version(self) -> None:
+        now = time.time()
+        if self.index_version is None or now - self.version_checked < self.version_check_interval:
+            return
+        self.version_checked = now
+        try:
+            version = self.index_version()
+        except Exception:
+            return  # keep serving the cache if ES cannot be reached, the search itself will report the error
+        if version != self.version:
+            with self.lock:
+                if self.version is not None:
+                    self._clear()
+                self.version = version
+
+    def _clear(self) -> None:
+        self.entries.clear()
+        self.bytes = 0
+        CACHE_BYTES.set(0, cache=self.name)
+
+    def clear(self) -> None:
+        with self.lock:
+            self._clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        """
+        whether an unexpired entry is cached, unlike get it is not counted as a lookup and does not refresh the entry
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry is not None and time.time() - entry[0] <= self.ttl
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        self._check_version()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry[0] > self.ttl:
+                self.bytes -= entry[1]
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                CACHE_LOOKUPS.inc(cache=self.name, result="miss")
+                return None
+            self.entries.move_to_end(key)
+            CACHE_LOOKUPS.inc(cache=self.name, result="hit")
+            return entry[2]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self.entries[key] = (time.time(), size, value)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted, _) = self.entries.popitem(last=False)
+                self.bytes -= evicted
+            CACHE_BYTES.set(self.bytes, cache=self.name)
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any], cacheable: Optional[Callable[[Any], bool]] = None) -> Any:
+        """
+        :param cacheable: a computed value is only cached if cacheable(value) is true, default always
+        """
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            if cacheable is None or cacheable(value):
+                self.put(key, value)
+        return value
+
+
+if __name__ == "__main__":
+    pass
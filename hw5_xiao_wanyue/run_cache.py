@@ -0,0 +1,136 @@
+"""
+on-disk cache of retrieval runs
+each run is stored as a TREC run file (topic Q0 doc_id rank score tag) and indexed by a manifest keyed by the retrieval parameters,
+the judgments of the retrieved docs are kept next to the runs so that cached runs can be scored without Elasticsearch
+"""
+from typing import Dict, List, NamedTuple, Optional, Any, Iterable
+import hashlib
+import json
+import os
+import time
+
+from metrics import Qrels
+
+
+class RunEntry(NamedTuple):
+    doc_id: str
+    score: float
+
+
+class RunKey(NamedTuple):
+    # everything that determines the ranking of a run
+    index_name: str
+    index_version: str
+    query_text: str
+    analyzer: str
+    search_type: str
+    vector_name: str
+    k: int
+    encoder: str = ""  # EncoderProvider.tag of the query embeddings, empty for a pure BM25 run
+
+    def digest(self) -> str:
+        return hashlib.sha1(json.dumps(self._asdict(), sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def get_index_version(index_name: str, using: str = "default") -> str:
+    """
+    identify the current build of an index by its uuid and creation date, a rebuilt index gets a new version
+    """
+    from elasticsearch_dsl import Index  # type: ignore
+    from es_service.connection import request_timeout
+
+    settings = Index(index_name, using=using).get_settings(request_timeout=request_timeout("admin", using))
+    index_settings = next(iter(settings.values()))["settings"]["index"]
+    return f"{index_settings['uuid']}-{index_settings['creation_date']}"
+
+
+class RunCache(object):
+    MANIFEST = "manifest.json"
+    JUDGMENTS = "judgments.json"
+
+    def __init__(self, cache_dir: str = "./run_cache"):
+        """
+        :param cache_dir: directory holding the run files, the manifest and the judgments of the cached docs
+        """
+        self.cache_dir = cache_dir
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.manifest: Dict[str, Dict[str, Any]] = self._load_json(self.MANIFEST)
+        self.judgments: Dict[str, List[Any]] = self._load_json(self.JUDGMENTS)
+
+    def _load_json(self, name: str) -> Dict:
+        path = os.path.join(self.cache_dir, name)
+        if not os.path.exists(path):
+            return {}
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def _dump_json(self, name: str, obj: Dict) -> None:
+        # write to a temporary file first so that an interrupted run never leaves a truncated manifest
+        path = os.path.join(self.cache_dir, name)
+        with open(path + ".tmp", "w") as f:
+            json.dump(obj, f)
+        os.replace(path + ".tmp", path)
+
+    def get(self, key: RunKey) -> Optional[List[RunEntry]]:
+        entry = self.manifest.get(key.digest())
+        if entry is None:
+            return None
+        run_path = os.path.join(self.cache_dir, entry["run_file"])
+        if not os.path.exists(run_path):
+            return None
+        with open(run_path, "r") as f:
+            return [RunEntry(doc_id, float(score)) for _, _, doc_id, _, score, _ in (line.split() for line in f)]
+
+    def put(self, key: RunKey, topic_id: str, response: Iterable[Any], tag: Optional[str] = None) -> List[RunEntry]:
+        """
+        store the hits of an ES response as a TREC run
+        :param key: retrieval parameters of the run
+        :param topic_id: topic id written in the first column of the run file
+        :param response: ES hits with the doc_id and annotation fields
+        :param tag: run tag, default search_type_vector_name
+        :return: the cached run
+        """
+        digest = key.digest()
+        tag = tag or f"{key.search_type}_{key.vector_name}"
+        run = []
+        for hit in response:
+            run.append(RunEntry(hit.doc_id, float(hit.meta.score)))
+            judgment = Qrels.parse_annotation(getattr(hit, "annotation", None))
+            if judgment is not None:
+                self.judgments[hit.doc_id] = list(judgment)
+
+        run_file = f"{digest}.run"
+        with open(os.path.join(self.cache_dir, run_file), "w") as f:
+            for rank, entry in enumerate(run, 1):
+                f.write(f"{topic_id} Q0 {entry.doc_id} {rank} {entry.score:.6f} {tag}\n")
+        self.manifest[digest] = {"key": key._asdict(), "topic_id": topic_id, "run_file": run_file, "created": time.time()}
+        self._dump_json(self.JUDGMENTS, self.judgments)
+        self._dump_json(self.MANIFEST, self.manifest)
+        return run
+
+    def invalidate(self, index_name: Optional[str] = None) -> int:
+        """
+        drop cached runs, e.g. after the index is rebuilt
+        :param index_name: only drop the runs of this index, default drop everything
+        :return: number of dropped runs
+        """
+        dropped = [d for d, entry in self.manifest.items() if index_name is None or entry["key"]["index_name"] == index_name]
+        for digest in dropped:
+            run_path = os.path.join(self.cache_dir, self.manifest.pop(digest)["run_file"])
+            if os.path.exists(run_path):
+                os.remove(run_path)
+        if index_name is None:
+            self.judgments = {}
+            self._dump_json(self.JUDGMENTS, self.judgments)
+        self._dump_json(self.MANIFEST, self.manifest)
+        return len(dropped)
+
+    def qrels(self, ideal_relevance: Dict[str, List[int]]) -> Qrels:
+        """
+        qrels covering every cached doc, used to score cached runs offline
+        """
+        return Qrels({doc_id: (topic_id, grade) for doc_id, (topic_id, grade) in self.judgments.items()}, ideal_relevance)
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+production serving mode for the Flask app in hw5.py
+runs the app under gunicorn with several worker processes instead of the Flask development server (debug mode and reloader).
+the app is imported once in the master process (preload), so the spell corrector vocabulary is loaded and the result cache
+warmed before fork and shared copy-on-write by the workers; each worker opens its own ES connections after fork, and its ES
+and embedding clients run on an asyncio loop started after fork.
+
+python serve.py --workers 4 --threads 16 --bind 0.0.0.0:8000 --index_name wapo_docs_50k --top_k 100
+"""
+import argparse
+import multiprocessing
+
+from gunicorn.app.base import BaseApplication  # type: ignore
+
+
+class HW5Application(BaseApplication):
+    def __init__(self, app_args: argparse.Namespace, options: dict):
+        self.app_args = app_args
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        import hw5
+        hw5.args = self.app_args
+        return hw5.app
+
+
+def main():
+    import hw5
+    parser = hw5.build_parser()
+    parser.add_argument("--bind", required=False, type=str, default="127.0.0.1:8000", help="address to listen on")
+    parser.add_argument("--workers", required=False, type=int, default=multiprocessing.cpu_count(), help="number of worker processes")
+    parser.add_argument("--threads", required=False, type=int, default=16, help="request threads per worker")
+    parser.add_argument("--sync_clients", action='store_true', help="keep the blocking ES and embedding clients (one connection per request thread)")
+    args = parser.parse_args()
+    if args.es_maxsize is None:
+        args.es_maxsize = args.threads  # one ES connection per request thread of a worker
+    hw5.args = args
+    # load the vocabulary and the search code once in the master, the forked workers share them copy-on-write
+    hw5.warm_up(report=args.startup_report, connect=False)
+    if not args.no_result_cache:
+        hw5.enable_result_cache(args.cache_mb, args.cache_ttl, warm_up=False)
+        if not args.no_warm_up:
+            hw5.warm_result_cache()  # once, every worker starts with the cached results
+    hw5.close_search_backend()  # the workers must not share the sockets of the connections of the master
+
+    def post_fork(server, worker):
+        hw5.load_search_backend()
+        if not args.sync_clients:
+            hw5.enable_async_io()
+
+    options = {
+        "bind": args.bind,
+        "workers": args.workers,
+        "threads": args.threads,
+        "worker_class": "gthread",
+        "preload_app": True,
+        "post_fork": post_fork,
+        "timeout": 120,
+        "keepalive": 5,
+    }
+    HW5Application(args, options).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+prefix autocomplete over the corpus vocabulary, ranked by word frequency
+the words are kept in a lexicographically sorted array, so the completions of a prefix are one contiguous range found by
+binary search. small ranges are ranked on the fly, the top completions of every prefix with a large range are precomputed.
+all arrays are saved as .npy files (the words as one utf-8 blob plus offsets) and memory-mapped when loaded.
+
+python suggest.py --output pa5_data/suggest_index
+"""
+from typing import Dict, List, Tuple
+import argparse
+import os
+import time
+
+import numpy as np  # type: ignore
+
+SUGGEST_INDEX_DIR = "./pa5_data/suggest_index"
+FILES = ("words.npy", "offsets.npy", "counts.npy", "prefixes.npy", "prefix_offsets.npy", "prefix_top.npy")
+
+
+def _pack(words: List[bytes]) -> Tuple[np.ndarray, np.ndarray]:
+    offsets = np.zeros(len(words) + 1, dtype=np.int64)
+    np.cumsum([len(word) for word in words], out=offsets[1:])
+    return np.frombuffer(b"".join(words), dtype=np.uint8), offsets
+
+
+def build_index(vocabulary: Dict[str, int], output_dir: str = SUGGEST_INDEX_DIR, top_k: int = 10, max_range: int = 256) -> None:
+    """
+    :param vocabulary: word counts
+    :param top_k: completions precomputed per prefix, the largest k served
+    :param max_range: prefixes matching more words than this get precomputed completions
+    """
+    words = sorted(word.encode("utf-8") for word in vocabulary)
+    counts = np.array([vocabulary[word.decode("utf-8")] for word in words], dtype=np.int64)
+
+    # heavy prefixes, level by level: the words of a prefix are contiguous, a light prefix has no heavy extension
+    heavy: List[Tuple[bytes, np.ndarray]] = []
+    ranges = [(0, len(words))]
+    depth = 1
+    while ranges:
+        next_ranges = []
+        for lo, hi in ranges:
+            start = lo
+            while start < hi:
+                if len(words[start]) < depth:
+                    start += 1
+                    continue
+                prefix = words[start][:depth]
+                end = start
+                while end < hi and words[end][:depth] == prefix:
+                    end += 1
+                if end - start > max_range:
+                    top = start + np.argsort(-counts[start:end], kind="stable")[:top_k]
+                    heavy.append((prefix, top))
+                    next_ranges.append((start, end))
+                start = end
+        ranges = next_ranges
+        depth += 1
+    heavy.sort(key=lambda item: item[0])
+
+    os.makedirs(output_dir, exist_ok=True)
+    blob, offsets = _pack(words)
+    prefix_blob, prefix_offsets = _pack([prefix for prefix, _ in heavy])
+    prefix_top = np.full((len(heavy), top_k), -1, dtype=np.int32)
+    for i, (_, top) in enumerate(heavy):
+        prefix_top[i, :len(top)] = top
+    for name, array in zip(FILES, (blob, offsets, counts, prefix_blob, prefix_offsets, prefix_top)):
+        np.save(os.path.join(output_dir, name), array)
+
+
+class Suggester(object):
+    def __init__(self, index_dir: str = SUGGEST_INDEX_DIR):
+        """
+        memory-map an index written by build_index
+        """
+        arrays = [np.load(os.path.join(index_dir, name), mmap_mode="r") for name in FILES]
+        self.words, self.offsets, self.counts, self.prefixes, self.prefix_offsets, self.prefix_top = arrays
+        self.n_words = len(self.offsets) - 1
+        self.top_k = self.prefix_top.shape[1]
+
+    @staticmethod
+    def _get(blob: np.ndarray, offsets: np.ndarray, i: int) -> bytes:
+        return blob[offsets[i]:offsets[i + 1]].tobytes()
+
+    def word(self, i: int) -> str:
+        return self._get(self.words, self.offsets, i).decode("utf-8")
+
+    def _bisect(self, blob: np.ndarray, offsets: np.ndarray, n: int, key: bytes) -> int:
+        # first index whose item is >= key
+        lo, hi = 0, n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._get(blob, offsets, mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def prefix_range(self, prefix: bytes) -> Tuple[int, int]:
+        """
+        [lo, hi) indices of the words starting with prefix
+        """
+        lo = self._bisect(self.words, self.offsets, self.n_words, prefix)
+        # every word starting with prefix is < prefix + 0xff since the utf-8 bytes of a word never contain 0xff
+        hi = self._bisect(self.words, self.offsets, self.n_words, prefix + b"\xff")
+        return lo, hi
+
+    def suggest(self, prefix: str, k: int = 10) -> List[Tuple[str, int]]:
+        """
+        :return: (word, count) of the k most frequent words starting with prefix
+        """
+        key = prefix.lower().strip().encode("utf-8")
+        if not key:
+            return []
+        lo, hi = self.prefix_range(key)
+        if hi - lo == 0:
+            return []
+        n_prefixes = len(self.prefix_offsets) - 1
+        i = self._bisect(self.prefixes, self.prefix_offsets, n_prefixes, key)
+        if i < n_prefixes and self._get(self.prefixes, self.prefix_offsets, i) == key and k <= self.top_k:
+            top = [j for j in self.prefix_top[i, :k] if j >= 0]
+        else:
+            top = lo + np.argsort(-self.counts[lo:hi], kind="stable")[:k]
+        return [(self.word(j), int(self.counts[j])) for j in top]
+
+
+def load_suggester(index_dir: str = SUGGEST_INDEX_DIR) -> Suggester:
+    """
+    memory-map the index, building it from the spell corrector vocabulary if it does not exist yet
+    """
+    if not os.path.exists(os.path.join(index_dir, FILES[-1])):
+        from spell_corrector import load_vocabulary
+        build_index(load_vocabulary(), index_dir)
+    return Suggester(index_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="build the prefix index of /suggest from the vocabulary")
+    parser.add_argument("--output", required=False, type=str, default=SUGGEST_INDEX_DIR, help="directory of the index")
+    parser.add_argument("--top_k", required=False, type=int, default=10, help="completions precomputed per prefix")
+    parser.add_argument("--max_range", required=False, type=int, default=256, help="prefixes matching more words get precomputed completions")
+    args = parser.parse_args()
+
+    from spell_corrector import load_vocabulary
+    st = time.time()
+    vocabulary = load_vocabulary()
+    build_index(vocabulary, args.output, args.top_k, args.max_range)
+    print(f"Indexed {len(vocabulary)} words in {time.time() - st:.2f} seconds")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+sparse inverted index of the dominant LDA topics of the documents
+every document keeps its few strongest topics of the topic_feature distribution. the index maps each topic to the
+documents where it is dominant (with the topic weight), and each document to its dominant topics. a query is mapped to
+topics, explicitly or inferred from the topics of its top BM25 documents, and the vector search only scores the documents
+of these topics instead of the whole index.
+
+built while loading ES (python load_es_index.py ... --topic_index pa5_data/topic_index) or from the corpus alone:
+python topic_index.py --wapo_path pa5_data/all_embeddings_wapo.jl --output pa5_data/topic_index
+"""
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+import argparse
+import os
+import time
+
+import numpy as np  # type: ignore
+
+TOPIC_INDEX_DIR = os.environ.get("TOPIC_INDEX_DIR", "./pa5_data/topic_index")
+TOPIC_FIELD = "topic_feature"
+FILES = ("doc_ids.npy", "doc_offsets.npy", "doc_topics.npy", "doc_weights.npy", "topic_offsets.npy", "posting_rows.npy",
+         "posting_weights.npy")
+
+
+class TopicFilter(NamedTuple):
+    """
+    restriction of the vector search to the documents of some topics
+    topics: explicit LDA topic ids, if empty the topics are inferred from the top feedback_docs BM25 documents of the query
+    n_topics: number of inferred topics
+    max_candidates: documents kept, the ones with the largest topic weights
+    """
+    topics: Tuple[int, ...] = ()
+    n_topics: int = 2
+    feedback_docs: int = 10
+    max_candidates: int = 5000
+
+    def tag(self) -> str:
+        topics = "+".join(str(topic) for topic in self.topics) or f"infer{self.n_topics}@{self.feedback_docs}"
+        return f"topics-{topics}-{self.max_candidates}"
+
+
+class TopicIndexBuilder(object):
+    def __init__(self, n_dominant: int = 3, min_weight: float = 0.1, field: str = TOPIC_FIELD):
+        """
+        :param n_dominant: topics kept per document
+        :param min_weight: topics with a smaller weight in the document are not kept
+        :param field: field of the topic distribution in the corpus documents
+        """
+        self.n_dominant = n_dominant
+        self.min_weight = min_weight
+        self.field = field
+        self.n_topics = 0
+        self.doc_ids: List[int] = []
+        self.counts: List[int] = []
+        self.topics: List[np.ndarray] = []
+        self.weights: List[np.ndarray] = []
+
+    def add(self, doc_id: int, topic_vector: Sequence[float]) -> None:
+        vector = np.asarray(topic_vector if topic_vector is not None else [], dtype=np.float32)
+        self.n_topics = max(self.n_topics, len(vector))
+        top = np.argsort(-vector, kind="stable")[:self.n_dominant]
+        top = top[vector[top] >= self.min_weight]
+        self.doc_ids.append(doc_id)
+        self.counts.append(len(top))
+        self.topics.append(top.astype(np.int32))
+        self.weights.append(vector[top])
+
+    def tap(self, docs: Iterable[Dict]) -> Iterator[Dict]:
+        """
+        add the documents as they are streamed to another consumer (e.g. the ES bulk load), the ES id is the position
+        """
+        for i, doc in enumerate(docs):
+            self.add(i, doc.get(self.field))
+            yield doc
+
+    def build(self) -> "TopicIndex":
+        order = np.argsort(self.doc_ids, kind="stable")
+        counts = np.asarray(self.counts, dtype=np.int64)[order]
+        doc_offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=doc_offsets[1:])
+        doc_topics = np.concatenate([self.topics[i] for i in order] + [np.zeros(0, dtype=np.int32)])
+        doc_weights = np.concatenate([self.weights[i] for i in order] + [np.zeros(0, dtype=np.float32)])
+
+        # postings: the (row, weight) entries grouped by topic, the heaviest first
+        rows = np.repeat(np.arange(len(counts), dtype=np.int32), counts)
+        postings = np.lexsort((-doc_weights, doc_topics))
+        topic_offsets = np.zeros(self.n_topics + 1, dtype=np.int64)
+        np.cumsum(np.bincount(doc_topics, minlength=self.n_topics), out=topic_offsets[1:])
+        return TopicIndex(np.asarray(self.doc_ids, dtype=np.int64)[order], doc_offsets, doc_topics, doc_weights, topic_offsets,
+                          rows[postings], doc_weights[postings])
+
+
+class TopicIndex(object):
+    def __init__(self, doc_ids: np.ndarray, doc_offsets: np.ndarray, doc_topics: np.ndarray, doc_weights: np.ndarray,
+                 topic_offsets: np.ndarray, posting_rows: np.ndarray, posting_weights: np.ndarray):
+        """
+        :param doc_ids: ES ids of the documents, sorted
+        :param doc_offsets: (documents + 1) start of the dominant topics of each document in doc_topics/doc_weights
+        :param topic_offsets: (topics + 1) start of the postings of each topic in posting_rows/posting_weights
+        :param posting_rows: row in doc_ids of each posting
+        """
+        self.doc_ids = doc_ids
+        self.doc_offsets = doc_offsets
+        self.doc_topics = doc_topics
+        self.doc_weights = doc_weights
+        self.topic_offsets = topic_offsets
+        self.posting_rows = posting_rows
+        self.posting_weights = posting_weights
+        self.n_topics = len(topic_offsets) - 1
+
+    def save(self, index_dir: str) -> None:
+        os.makedirs(index_dir, exist_ok=True)
+        arrays = (self.doc_ids, self.doc_offsets, self.doc_topics, self.doc_weights, self.topic_offsets, self.posting_rows,
+                  self.posting_weights)
+        for name, array in zip(FILES, arrays):
+            np.save(os.path.join(index_dir, name), array)
+
+    @classmethod
+    def load(cls, index_dir: str) -> "TopicIndex":
+        return cls(*[np.load(os.path.join(index_dir, name), mmap_mode="r") for name in FILES])
+
+    def topics_of(self, doc_ids: Sequence) -> Dict[int, float]:
+        """
+        :return: summed weight of each dominant topic of the documents
+        """
+        ids = np.asarray([int(doc_id) for doc_id in doc_ids], dtype=np.int64)
+        rows = np.searchsorted(self.doc_ids, ids)
+        rows = rows[(rows < len(self.doc_ids)) & (self.doc_ids[np.minimum(rows, len(self.doc_ids) - 1)] == ids)]
+        weights = np.zeros(self.n_topics, dtype=np.float64)
+        for row in rows:
+            lo, hi = self.doc_offsets[row], self.doc_offsets[row + 1]
+            np.add.at(weights, self.doc_topics[lo:hi], self.doc_weights[lo:hi])
+        return {int(topic): float(weights[topic]) for topic in np.flatnonzero(weights)}
+
+    def infer_topics(self, feedback_ids: Sequence, n_topics: int) -> Dict[int, float]:
+        """
+        topics of a query: the strongest dominant topics of its top ranked documents
+        """
+        weights = self.topics_of(feedback_ids)
+        return dict(sorted(weights.items(), key=lambda item: -item[1])[:n_topics])
+
+    def candidates(self, topics: Dict[int, float], max_candidates: int) -> List[str]:
+        """
+        :param topics: weight of each topic of the query
+        :return: ES ids of the documents of the topics, at most max_candidates with the largest summed topic weight
+        """
+        topics = {topic: weight for topic, weight in topics.items() if 0 <= topic < self.n_topics}
+        if not topics or max_candidates <= 0:
+            return []
+        rows = np.concatenate([self.posting_rows[self.topic_offsets[t]:self.topic_offsets[t + 1]] for t in topics])
+        weights = np.concatenate([self.posting_weights[self.topic_offsets[t]:self.topic_offsets[t + 1]] * w for t, w in topics.items()])
+        scores = np.bincount(rows, weights=weights, minlength=len(self.doc_ids))
+        hits = np.flatnonzero(scores)
+        if len(hits) > max_candidates:
+            hits = hits[np.argpartition(-scores[hits], max_candidates - 1)[:max_candidates]]
+        return [str(doc_id) for doc_id in self.doc_ids[np.sort(hits)]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="build the topic inverted index of a corpus")
+    parser.add_argument("--wapo_path", required=True, type=str, help="path to the processed wapo jsonline file, in the order it was indexed")
+    parser.add_argument("--output", required=False, type=str, default=TOPIC_INDEX_DIR, help="directory of the index")
+    parser.add_argument("--n_dominant", required=False, type=int, default=3, help="topics kept per document")
+    parser.add_argument("--min_weight", required=False, type=float, default=0.1, help="smallest weight of a kept topic")
+    args = parser.parse_args()
+
+    from utils import load_clean_wapo_with_embedding
+    st = time.time()
+    builder = TopicIndexBuilder(args.n_dominant, args.min_weight)
+    for _ in builder.tap(load_clean_wapo_with_embedding(args.wapo_path)):
+        pass
+    index = builder.build()
+    index.save(args.output)
+    print(f"Indexed {len(index.doc_topics)} topics of {len(index.doc_ids)} documents over {index.n_topics} topics in {time.time() - st:.2f} seconds")
+
+
+if __name__ == "__main__":
+    main()